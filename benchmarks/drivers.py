@@ -0,0 +1,94 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import asyncio
+import time
+from typing import Callable, Dict, List
+
+import click
+from sqlalchemy import select, text
+from sqlalchemy.engine import Connection
+
+from chai_api.db_definitions import Base, NetatmoDevice, NetatmoReading, db_engine, db_async_engine, SYNC_DRIVERS, ASYNC_DRIVERS
+from chai_api.db_definitions import TEST_DATABASE, configuration_for_tests
+
+# the readings of a device over many years, generated by the database itself to keep the set-up fast
+INSERT_READINGS = """
+INSERT INTO netatmoreading (netatmoid, roomid, start, "end", reading)
+SELECT 1, 2, timestamptz '2020-01-01' + index * interval '5 minutes',
+       timestamptz '2020-01-01' + (index + 1) * interval '5 minutes', 18 + random() * 5
+FROM generate_series(1, CAST(:rows AS integer)) AS index
+"""
+
+
+def _fetch(connection: Connection, rows: int, repeat: int) -> List[float]:
+    """
+    Time fetching all readings of a device, as /heating/historic/ does.
+    :param connection: A connection with an open transaction, in which the readings are stored in a temporary table.
+    :param rows: The number of readings to store.
+    :param repeat: The number of times the readings are fetched.
+    :return: The time each fetch took in seconds.
+    """
+    connection.execute(text("SET LOCAL search_path TO pg_temp"))
+    Base.metadata.create_all(connection, tables=[NetatmoDevice.__table__, NetatmoReading.__table__])
+    connection.execute(NetatmoDevice.__table__.insert().values(id=1, refreshtoken="token"))
+    connection.execute(text(INSERT_READINGS), {"rows": rows})
+    query = select(NetatmoReading.start, NetatmoReading.reading).where(
+        NetatmoReading.netatmo_id == 1, NetatmoReading.room_id == 2
+    ).order_by(NetatmoReading.start)
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fetched = connection.execute(query).all()
+        timings.append(time.perf_counter() - started)
+        assert len(fetched) == rows
+    return timings
+
+
+def _sync(driver: str, rows: int, repeat: int) -> List[float]:
+    engine = db_engine(configuration_for_tests(driver))
+    try:
+        with engine.connect() as connection:
+            with connection.begin() as transaction:
+                timings = _fetch(connection, rows, repeat)
+                transaction.rollback()
+    finally:
+        engine.dispose()
+    return timings
+
+
+async def _async(driver: str, rows: int, repeat: int) -> List[float]:
+    engine = db_async_engine(configuration_for_tests(driver))
+    try:
+        async with engine.connect() as connection:
+            async with connection.begin():
+                timings = await connection.run_sync(_fetch, rows, repeat)
+                await connection.rollback()
+    finally:
+        await engine.dispose()
+    return timings
+
+
+@click.command()
+@click.option("--rows", default=200000, help="The number of readings to fetch.")
+@click.option("--repeat", default=3, help="The number of times the readings are fetched; the best time is kept.")
+def cli(rows, repeat):
+    if TEST_DATABASE is None:
+        click.echo("Set CHAI_TEST_DATABASE to user:password@server/database; nothing is stored in the database.")
+        return
+
+    runs: Dict[str, Callable[[], List[float]]] = {driver: (lambda driver=driver: _sync(driver, rows, repeat)) for driver in SYNC_DRIVERS}
+    runs.update({f"{driver} (asyncio)": (lambda driver=driver: asyncio.run(_async(driver, rows, repeat))) for driver in ASYNC_DRIVERS})
+
+    print(f"{'driver':<20}{'time (ms)':>12}{'rows/s':>14}")
+    for (name, run) in runs.items():
+        try:
+            best = min(run())
+        except (ValueError, ImportError) as err:
+            print(f"{name:<20}skipped: {err}")
+            continue
+        print(f"{name:<20}{best * 1000:>12.1f}{rows / best:>14,.0f}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,101 @@
+# pylint: disable=line-too-long, missing-module-docstring, protected-access
+
+import json
+import os
+import platform
+import sys
+import timeit
+from typing import Callable, Dict, Optional, Tuple
+
+import click
+import pendulum
+
+from chai_api import energy_loop
+
+BASELINE_PATH: str = os.path.join(os.path.dirname(os.path.realpath(__file__)), "energy_loop.json")
+
+
+def _london(text: str) -> pendulum.DateTime:
+    return pendulum.parse(text, tz="Europe/London")
+
+
+# the ranges to time as (start, end, limit); the slot mirrors how /heating/mode/ looks up the current price
+CASES: Dict[str, Tuple[pendulum.DateTime, pendulum.DateTime, Optional[int]]] = {
+    "slot": (_london("2023-06-14T10:10"), _london("2023-06-14T10:10"), 1),
+    "day": (_london("2023-06-14T00:00"), _london("2023-06-15T00:00"), None),
+    "day-bst-start": (_london("2023-03-26T00:00"), _london("2023-03-27T00:00"), None),
+    "day-bst-end": (_london("2023-10-29T00:00"), _london("2023-10-30T00:00"), None),
+    "day-leap": (_london("2024-02-29T00:00"), _london("2024-03-01T00:00"), None),
+    "month": (_london("2023-02-03T10:30"), _london("2023-03-03T10:30"), None),
+    "year": (_london("2023-01-01T00:00"), _london("2024-01-01T00:00"), None),
+    "year-leap": (_london("2024-01-01T00:00"), _london("2025-01-01T00:00"), None),
+    "multi-year": (_london("2021-07-01T12:00"), _london("2025-07-01T12:00"), None),
+}
+
+
+def _functions(start: pendulum.DateTime, end: pendulum.DateTime, limit: Optional[int]) -> Dict[str, Callable]:
+    """
+    The functions to time for a single range.
+    _get_values only accepts ranges within a single year, so it is given the part of the range in the first year.
+    :param start: The start date of the range.
+    :param end: The end date of the range.
+    :param limit: The maximum number of values in the range.
+    :return: The functions to time, keyed by their name.
+    """
+    year_end = min(end, start.end_of("year"))
+    return {
+        "_get_values": lambda: energy_loop._get_values(start, year_end),
+        "get_price_series": lambda: energy_loop.get_price_series(start, end, limit),
+        "get_energy_values": lambda: energy_loop.get_energy_values(start, end, limit),
+    }
+
+
+def _time(function: Callable, repeat: int) -> float:
+    """
+    Time a function, taking the best of several repeats to suppress noise from the rest of the system.
+    :param function: The function to time.
+    :param repeat: The number of repeats.
+    :return: The time of a single call in microseconds.
+    """
+    timer = timeit.Timer(function)
+    (number, _) = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+@click.command()
+@click.option("--repeat", default=5, help="The number of times each function is timed; the best time is kept.")
+@click.option("--only", default=None, help="Only time the cases whose name contains this text.")
+@click.option("--baseline", default=BASELINE_PATH, help="The JSON file with the baseline timings.")
+@click.option("--save", is_flag=True, help="Store the timings as the new baseline instead of comparing against it.")
+def cli(repeat, only, baseline, save):
+    previous = {}
+    if not save and os.path.isfile(baseline):
+        with open(baseline, encoding="utf-8") as file:
+            previous = json.load(file)["timings"]
+
+    timings: Dict[str, Dict[str, float]] = {}
+    print(f"{'case':<16}{'function':<20}{'time (µs)':>14}{'baseline (µs)':>16}{'change':>10}")
+    for (name, (start, end, limit)) in CASES.items():
+        if only is not None and only not in name:
+            continue
+        timings[name] = {}
+        for (function_name, function) in _functions(start, end, limit).items():
+            timings[name][function_name] = elapsed = _time(function, repeat)
+            reference = previous.get(name, {}).get(function_name, None)
+            compared = f"{reference:>16.1f}{elapsed / reference - 1:>+10.0%}" if reference else f"{'-':>16}{'-':>10}"
+            print(f"{name:<16}{function_name:<20}{elapsed:>14.1f}{compared}")
+
+    if save:
+        with open(baseline, "w", encoding="utf-8") as file:
+            json.dump({
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "recorded": pendulum.now("UTC").to_iso8601_string(),
+                "timings": timings,
+            }, file, indent=2)
+            file.write("\n")
+        print(f"baseline written to {baseline}")
+
+
+if __name__ == "__main__":
+    cli()
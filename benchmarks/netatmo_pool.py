@@ -0,0 +1,88 @@
+# pylint: disable=line-too-long, missing-module-docstring, too-few-public-methods
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+import click
+
+from chai_api.db_definitions import NetatmoDevice
+from chai_api.netatmo_pool import NetatmoClientPool
+
+
+class DelayedClient:
+    """
+    A stand-in for the Netatmo client with a fixed round trip: a new client first fetches an access token with its
+    refresh token, which takes a round trip of its own, before it sets the valve.
+    """
+
+    def __init__(self, refresh_token: str, delay: float):
+        self.refresh_token = refresh_token
+        self.delay = delay
+        self.access_token = None
+
+    def set_device(self) -> None:
+        if self.access_token is None:
+            time.sleep(self.delay)
+            self.access_token = f"access-{self.refresh_token}"
+        time.sleep(self.delay)
+
+
+def fresh_call(delay: float) -> Callable[[NetatmoDevice], None]:
+    """ The previous way of calling Netatmo: a new client for every call. """
+    def call(device: NetatmoDevice) -> None:
+        DelayedClient(device.refreshToken, delay).set_device()
+    return call
+
+
+def pooled_call(delay: float) -> Callable[[NetatmoDevice], None]:
+    """ The same call with the client of the device taken from the pool. """
+    pool = NetatmoClientPool(lambda refresh_token: DelayedClient(refresh_token, delay))
+
+    def call(device: NetatmoDevice) -> None:
+        with pool.client(device) as client:
+            client.set_device()
+    return call
+
+
+def run(call: Callable[[NetatmoDevice], None], devices: List[NetatmoDevice], runs: int, workers: int) -> List[float]:
+    """
+    Time a number of cron runs, each of which calls Netatmo once for every device.
+    :param call: The call to make for a device.
+    :param devices: The devices to call for.
+    :param runs: The number of cron runs.
+    :param workers: The number of devices called at the same time.
+    :return: The latency of each call, in seconds.
+    """
+    def timed(device: NetatmoDevice) -> float:
+        started = time.perf_counter()
+        call(device)
+        return time.perf_counter() - started
+
+    latencies = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in range(runs):
+            latencies.extend(executor.map(timed, devices))
+    return latencies
+
+
+@click.command()
+@click.option("--homes", default=20, help="The number of homes called in each cron run.")
+@click.option("--runs", default=5, help="The number of cron runs, of which only the first creates pooled clients.")
+@click.option("--delay", default=0.02, help="The number of seconds of each round trip to Netatmo.")
+@click.option("--workers", default=4, help="The number of homes called at the same time.")
+def cli(homes, runs, delay, workers):
+    devices = [NetatmoDevice(id=index, refreshToken=f"token{index}") for index in range(homes)]
+
+    print(f"{'clients':<8}{'mean (ms)':>12}{'p95 (ms)':>12}{'total (s)':>12}")
+    for (name, call) in (("fresh", fresh_call(delay)), ("pooled", pooled_call(delay))):
+        started = time.perf_counter()
+        latencies = sorted(run(call, devices, runs, workers))
+        total = time.perf_counter() - started
+        mean = sum(latencies) / len(latencies) * 1e3
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1e3
+        print(f"{name:<8}{mean:>12.1f}{p95:>12.1f}{total:>12.2f}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,83 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import timeit
+from typing import Callable, Dict, Tuple
+
+import click
+import pendulum
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from chai_api.db_definitions import Log, NetatmoReading
+from chai_api.responses import LogEntry
+
+
+def _engine(rows: int) -> Engine:
+    """
+    Create an in-memory SQLite database with the given number of readings and log entries.
+    SQLite keeps the cost of the database itself low, so that the timings show the cost of building the rows.
+    :param rows: The number of readings and of log entries.
+    :return: The engine of the database.
+    """
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    NetatmoReading.__table__.create(engine)
+    Log.__table__.create(engine)
+    start = pendulum.datetime(2023, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(NetatmoReading.__table__.insert(), [{
+            "netatmoid": 1, "roomid": 2, "start": start.add(minutes=5 * index), "end": start.add(minutes=5 * index + 5),
+            "reading": 20.0 + index % 7 / 10
+        } for index in range(rows)])
+        connection.execute(Log.__table__.insert(), [{
+            "homeid": 1, "timestamp": start.add(minutes=index), "category": "SETPOINT_MODE", "parameters": ["auto", index]
+        } for index in range(rows)])
+    return engine
+
+
+def _functions(engine: Engine) -> Dict[Tuple[str, str], Callable]:
+    """
+    The functions to time, each fetching and serialising all rows of a table in a session of its own, as a request does.
+    :param engine: The engine of the database to read from.
+    :return: The functions to time, keyed by their table and approach.
+    """
+    def orm_readings():
+        with Session(engine) as session:
+            return [{"timestamp": entry.start.isoformat(), "value": entry.reading} for entry in session.query(NetatmoReading).all()]
+
+    def core_readings():
+        with Session(engine) as session:
+            return [{"timestamp": start.isoformat(), "value": reading} for (start, reading) in session.execute(
+                select(NetatmoReading.start, NetatmoReading.reading)
+            )]
+
+    def orm_logs():
+        with Session(engine) as session:
+            return [LogEntry(entry.timestamp, entry.category, entry.parameters).to_dict() for entry in session.query(Log).all()]
+
+    def core_logs():
+        with Session(engine) as session:
+            return [LogEntry(*row).to_dict() for row in session.execute(select(Log.timestamp, Log.category, Log.parameters))]
+
+    return {
+        ("NetatmoReading", "orm"): orm_readings, ("NetatmoReading", "core"): core_readings,
+        ("Log", "orm"): orm_logs, ("Log", "core"): core_logs,
+    }
+
+
+@click.command()
+@click.option("--rows", default=10000, help="The number of readings and of log entries.")
+@click.option("--repeat", default=5, help="The number of times each function is timed; the best time is kept.")
+def cli(rows, repeat):
+    functions = _functions(_engine(rows))
+    timings: Dict[Tuple[str, str], float] = {}
+    print(f"{'table':<16}{'approach':<10}{'per row (µs)':>14}{'speed-up':>10}")
+    for ((table, approach), function) in functions.items():
+        timings[(table, approach)] = elapsed = min(timeit.repeat(function, repeat=repeat, number=1)) / rows * 1e6
+        speedup = f"{timings[(table, 'orm')] / elapsed:>9.1f}x" if approach == "core" else f"{'-':>10}"
+        print(f"{table:<16}{approach:<10}{elapsed:>14.2f}{speedup}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,86 @@
+# pylint: disable=line-too-long, missing-module-docstring, protected-access
+
+import math
+import timeit
+from array import array
+from calendar import isleap
+
+import click
+import pendulum
+
+from chai_api import energy_loop
+
+
+def nested_values(start_date: pendulum.DateTime, end_date: pendulum.DateTime) -> list:
+    """
+    The previous way of assembling a range: look up every day as a list, flatten it twice, and trim the ends.
+    :param start_date: The start date of the range, in the Europe/London timezone.
+    :param end_date: The end date of the range, in the Europe/London timezone.
+    :return: The half-hourly values in the range.
+    """
+    requests = []
+    if start_date.year == end_date.year:
+        requests.append((start_date, end_date))
+    else:
+        middle_date = start_date
+        while middle_date.year < end_date.year:
+            requests.append((middle_date, middle_date.end_of("year")))
+            middle_date = middle_date.end_of("year").add(microseconds=1)
+        requests.append((middle_date, end_date))
+
+    result = [energy_loop._get_values(start, end) for (start, end) in requests]
+    result = [day_value for sublist in result for day_value in sublist]
+
+    minutes_between = start_date.start_of("day").diff(start_date).in_minutes()
+    start_values_to_drop = math.floor(minutes_between / 30)
+    result[0] = result[0][start_values_to_drop:]
+
+    minutes_between = (end_date.end_of("day").diff(end_date).in_seconds() + 1) / 60
+    end_values_to_drop = math.floor(minutes_between / 30)
+    result[-1] = result[-1][0:len(result[-1]) - min(len(result[-1]), end_values_to_drop)]
+
+    return [day_value for sublist in result for day_value in sublist]
+
+
+def stored_values(start_date: pendulum.DateTime, end_date: pendulum.DateTime) -> array:
+    """
+    The same range served from the contiguous price store.
+    :param start_date: The start date of the range, in the Europe/London timezone.
+    :param end_date: The end date of the range, in the Europe/London timezone.
+    :return: The half-hourly values in the range.
+    """
+    result = array("d")
+    for year in range(start_date.year, end_date.year + 1):
+        first_day = start_date.day_of_year if year == start_date.year else 1
+        last_day = end_date.day_of_year if year == end_date.year else (366 if isleap(year) else 365)
+        result.extend(energy_loop._get_slice(year, first_day, last_day))
+
+    minutes_between = start_date.start_of("day").diff(start_date).in_minutes()
+    start_values_to_drop = math.floor(minutes_between / 30)
+    minutes_between = (end_date.end_of("day").diff(end_date).in_seconds() + 1) / 60
+    end_values_to_drop = math.floor(minutes_between / 30)
+
+    return result[start_values_to_drop:max(start_values_to_drop, len(result) - end_values_to_drop)]
+
+
+@click.command()
+@click.option("--number", default=200, help="The number of calls to time for each range.")
+def cli(number):
+    start = pendulum.datetime(2023, 2, 3, 10, 30, tz="Europe/London")
+    ranges = {
+        "day": start.add(days=1),
+        "week": start.add(weeks=1),
+        "month": start.add(months=1),
+        "year": start.add(years=1),
+    }
+
+    print(f"{'range':<8}{'nested (µs)':>16}{'store (µs)':>16}{'speedup':>10}")
+    for (name, end) in ranges.items():
+        assert list(nested_values(start, end)) == list(stored_values(start, end))
+        nested = timeit.timeit(lambda: nested_values(start, end), number=number) / number * 1e6  # noqa: B023
+        stored = timeit.timeit(lambda: stored_values(start, end), number=number) / number * 1e6  # noqa: B023
+        print(f"{name:<8}{nested:>16.1f}{stored:>16.1f}{nested / stored:>9.1f}x")
+
+
+if __name__ == "__main__":
+    cli()
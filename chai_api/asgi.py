@@ -0,0 +1,247 @@
+# pylint: disable=line-too-long, missing-module-docstring
+# pylint: disable=too-few-public-methods, missing-function-docstring
+
+import asyncio
+import io
+import time
+import unittest
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, TypeVar
+
+import falcon
+import falcon.asgi
+import ujson as json
+from falcon_auth import FalconAuthMiddleware
+from requests.exceptions import Timeout
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.util import await_only, greenlet_spawn
+
+from chai_api.db_definitions import NetatmoDevice
+from chai_api.netatmo_pool import NetatmoClientPool
+
+T = TypeVar("T")
+
+# the number of seconds to wait for Netatmo before the request fails with a gateway timeout
+NETATMO_TIMEOUT = 10.0
+
+# the methods of which the body is read before the resource is called
+BODY_METHODS = ("POST", "PUT", "PATCH")
+
+_UNSET = object()
+
+
+class AsyncSessionMiddleware:
+    """
+    Give every request its own asyncio database session, which is committed when the request succeeds.
+    """
+
+    def __init__(self, engine: AsyncEngine):
+        self.sessions = sessionmaker(engine, class_=AsyncSession)
+
+    async def process_request(self, req: falcon.asgi.Request, resp: falcon.asgi.Response):  # noqa
+        req.context.session = self.sessions()
+
+    async def process_response(self, req: falcon.asgi.Request, resp: falcon.asgi.Response, resource, req_succeeded: bool):  # noqa
+        session: Optional[AsyncSession] = req.context.get("session", None)
+        if session is None:
+            return
+        try:
+            if req_succeeded:
+                await session.commit()
+            else:
+                await session.rollback()
+        finally:
+            await session.close()
+
+
+class AsyncAuthMiddleware(FalconAuthMiddleware):
+    """
+    The token authorisation middleware for the ASGI app; tokens are only read from the headers, so nothing is awaited.
+    """
+
+    async def process_resource(self, req, resp, resource, *args, **kwargs):  # pylint: disable=invalid-overridden-method
+        super().process_resource(req, resp, resource, *args, **kwargs)
+
+
+class _SyncRequest:
+    """
+    The request of the ASGI app as the resources expect it: with a synchronous session, and with a body that has been
+    read already. Everything else is taken from the ASGI request.
+    """
+
+    def __init__(self, req: falcon.asgi.Request, session: Session, body: bytes):
+        self._req = req
+        self._body = body
+        self.context = falcon.Context()
+        self.context.update(req.context)
+        self.context.session = session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._req, name)
+
+    @property
+    def bounded_stream(self) -> io.BytesIO:
+        return io.BytesIO(self._body)
+
+    def get_media(self, default_when_empty: Any = _UNSET) -> Any:
+        if not self._body:
+            if default_when_empty is _UNSET:
+                raise falcon.MediaNotFoundError(falcon.MEDIA_JSON)
+            return default_when_empty
+        try:
+            return json.loads(self._body)
+        except ValueError as err:
+            raise falcon.MediaMalformedError(falcon.MEDIA_JSON) from err
+
+    media = property(get_media)
+
+
+async def _stream(chunks: Iterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    Stream the chunks of a synchronous response, which may read from the database while it is streamed.
+    :param chunks: The chunks of the response.
+    :return: The chunks, each produced where the synchronous database calls are allowed.
+    """
+    chunks = iter(chunks)
+    try:
+        while (chunk := await greenlet_spawn(next, chunks, None)) is not None:
+            yield chunk
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            await greenlet_spawn(close)
+
+
+class SyncResource:
+    """
+    Serve a synchronous resource from the ASGI app.
+    A responder of the resource with an asyncio counterpart, e.g. `on_get_async` for `on_get`, is served by that
+    counterpart, which is given the ASGI request and its asyncio session as they are. This is the case for the most
+    requested endpoints: the prices and the heating mode.
+    The other responders are run on the asyncio session of the request, where each database call is awaited without
+    blocking the event loop. Calls that are not made to the database block the event loop for as long as they take,
+    so slow calls, such as those to Netatmo, should be made in a thread with `in_thread`.
+    """
+
+    def __init__(self, resource: Any):
+        self.resource = resource
+        for method in ("get", "put", "post", "delete"):
+            native = getattr(resource, f"on_{method}_async", None)
+            responder = getattr(resource, f"on_{method}", None)
+            if native is not None:
+                setattr(self, f"on_{method}", self._wrap_async(native))
+            elif responder is not None:
+                setattr(self, f"on_{method}", self._wrap(responder))
+
+    @staticmethod
+    def _wrap(responder: Callable[..., None]) -> Callable[..., Any]:
+        async def respond(req: falcon.asgi.Request, resp: falcon.asgi.Response, **kwargs):
+            body = await req.stream.read() if req.method in BODY_METHODS else b""
+            session: AsyncSession = req.context.session
+            await session.run_sync(lambda sync_session: responder(_SyncRequest(req, sync_session, body), resp, **kwargs))
+            _stream_asynchronously(resp)
+        return respond
+
+    @staticmethod
+    def _wrap_async(responder: Callable[..., Awaitable[None]]) -> Callable[..., Any]:
+        async def respond(req: falcon.asgi.Request, resp: falcon.asgi.Response, **kwargs):
+            await responder(req, resp, **kwargs)
+            _stream_asynchronously(resp)
+        return respond
+
+
+def _stream_asynchronously(resp: falcon.asgi.Response) -> None:
+    """ Turn the synchronous stream of a response, if any, into the asynchronous stream that the ASGI app sends. """
+    if resp.stream is not None and not hasattr(resp.stream, "__aiter__"):
+        resp.stream = _stream(resp.stream)
+
+
+def in_thread(timeout: float = NETATMO_TIMEOUT) -> Callable[[Callable[[], T]], T]:
+    """
+    Make calls in a thread of their own, so that the event loop keeps serving other requests in the meantime.
+    Only to be used by resources served by `SyncResource`. A call that is given up on keeps running until it finishes,
+    so anything it should have to itself, such as a pooled Netatmo client, should be borrowed within the call.
+    :param timeout: The number of seconds after which a call is given up on, and Timeout is raised.
+    :return: A function that makes a call in a thread and returns its result.
+    """
+    def call(function: Callable[[], T]) -> T:
+        try:
+            return await_only(asyncio.wait_for(asyncio.to_thread(function), timeout))
+        except asyncio.TimeoutError as err:
+            raise Timeout(f"no response within {timeout} seconds") from err
+    return call
+
+
+def create_app(resources: Dict[str, Any], engine: AsyncEngine, auth_middleware: Optional[FalconAuthMiddleware],
+               error_handler: Callable[..., None], sink: Callable[..., None]) -> falcon.asgi.App:
+    """
+    Create the ASGI app, which serves the same resources as the WSGI app.
+    :param resources: The resources to serve, keyed by their route.
+    :param engine: The asyncio database engine the sessions of the requests use.
+    :param auth_middleware: The token authorisation middleware to use, if any.
+    :param error_handler: The handler of unexpected exceptions.
+    :param sink: The responder for unknown routes.
+    :return: The ASGI app.
+    """
+    middleware = [AsyncSessionMiddleware(engine)]
+    if auth_middleware is not None:
+        middleware.insert(0, AsyncAuthMiddleware(auth_middleware.backend, auth_middleware.exempt_routes,
+                                                 auth_middleware.exempt_methods))
+    app = falcon.asgi.App(middleware=middleware)
+    for (route, resource) in resources.items():
+        app.add_route(route, SyncResource(resource))
+
+    async def handle_error(req, resp, exception, params):
+        error_handler(req, resp, exception, params)
+
+    async def handle_sink(req, resp, **kwargs):
+        sink(req, resp, **kwargs)
+
+    app.add_error_handler(Exception, handle_error)
+    app.add_sink(handle_sink)
+    return app
+
+
+class AsgiTests(unittest.TestCase):
+    """
+    Tests to ensure that synchronous resources get the request as they expect it, and that slow calls are given up on.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def testMedia(self):
+        import falcon.testing  # pylint: disable=import-outside-toplevel
+        req = falcon.testing.create_asgi_req()
+        self.assertEqual(_SyncRequest(req, None, b"").get_media(default_when_empty=[]), [])
+        self.assertEqual(_SyncRequest(req, None, b'{"label": "home"}').media, {"label": "home"})
+        self.assertRaises(falcon.MediaMalformedError, _SyncRequest(req, None, b"{").get_media)
+        self.assertRaises(falcon.MediaNotFoundError, _SyncRequest(req, None, b"").get_media)
+
+    def testTimeout(self):
+        call = in_thread(0.05)
+        self.assertEqual(asyncio.run(greenlet_spawn(call, lambda: 1)), 1)
+        self.assertRaises(Timeout, asyncio.run, greenlet_spawn(call, lambda: time.sleep(0.5)))
+
+    def testTimeoutKeepsClient(self):
+        pool = NetatmoClientPool(lambda refresh_token: SimpleNamespace(refresh_token=refresh_token))
+        device = NetatmoDevice(id=1, refreshToken="token")
+        order = []
+
+        def use(name: str, seconds: float):
+            with pool.client(device):
+                time.sleep(seconds)
+                order.append(name)
+
+        async def give_up():
+            with self.assertRaises(Timeout):
+                await greenlet_spawn(in_thread(0.05), lambda: use("slow", 0.3))
+            await asyncio.to_thread(use, "next", 0)
+
+        # the client is only used again once the call that was given up on has finished with it
+        asyncio.run(give_up())
+        self.assertEqual(order, ["slow", "next"])
+
+
+if __name__ == "__main__":
+    unittest.main()
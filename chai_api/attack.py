@@ -2,28 +2,30 @@
 # pylint: disable=no-member, c-extension-no-member, too-few-public-methods
 # pylint: disable=missing-class-docstring, missing-function-docstring
 
-import shelve
-
 import falcon
 import pendulum
 from dacite import from_dict, DaciteError, Config
 from falcon import Request, Response
+from pendulum import DateTime, parse
 
+from chai_api.attack_store import AttackStore
 from chai_api.energy_loop import PriceAttack
 from chai_api.expected import AttackPut
+from chai_api.utilities import parse_bool
 
 
 class AttackResource:
-    shelve_db: str = ""
+    attack_store: AttackStore
 
-    def __init__(self, shelve_location):
-        self.shelve_db = shelve_location
+    def __init__(self, attack_store: AttackStore):
+        self.attack_store = attack_store
 
     def on_put(self, req: Request, resp: Response):  # noqa
         try:
             options = req.params
             options.update(req.get_media(default_when_empty=[]))  # noqa
-            request: AttackPut = from_dict(AttackPut, options, config=Config(cast=[int, float]))
+            request: AttackPut = from_dict(AttackPut, options, config=Config({DateTime: parse, bool: parse_bool},
+                                                                             cast=[int, float]))
 
             if request.duration <= 0:
                 resp.content_type = falcon.MEDIA_TEXT
@@ -37,13 +39,22 @@ class AttackResource:
                 resp.text = "the duration should be a multiple of 30"
                 return
 
-            now = pendulum.now().set(second=0, microsecond=0)
-            next_slot_start = now.add(minutes=30 - now.minute % 30)
-            attack_end = next_slot_start.add(minutes=request.duration)
+            if request.start is not None and (request.start.minute % 30 != 0 or request.start.second != 0
+                                              or request.start.microsecond != 0):
+                resp.content_type = falcon.MEDIA_TEXT
+                resp.status = falcon.HTTP_BAD_REQUEST
+                resp.text = "the start should be at the start of a half hour slot"
+                return
+
+            if request.start is None:
+                now = pendulum.now().set(second=0, microsecond=0)
+                attack_start = now.add(minutes=30 - now.minute % 30)
+            else:
+                attack_start = request.start
+            attack_end = attack_start.add(minutes=request.duration)
 
-            with shelve.open(self.shelve_db) as db:
-                db["attack"] = PriceAttack(request.modifier, next_slot_start, attack_end)
-                print(db["attack"])
+            attack = PriceAttack(request.modifier, attack_start, attack_end)
+            self.attack_store.add_attack(attack, replace=not request.overlap)
 
             resp.status = falcon.HTTP_CREATED
         except DaciteError as err:
@@ -0,0 +1,150 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import os
+import shelve
+import tempfile
+import threading
+import time
+import unittest
+from typing import Optional, Dict, List, Hashable
+
+import pendulum
+
+from chai_api.attack_store import AttackStore, ShelveAttackStore
+from chai_api.energy_loop import PriceAttack
+
+
+class AttackCache(AttackStore):
+    """
+    Keep the attacks of another attack store in memory.
+    The underlying store is only read again when it has been written to, either by this process (tracked with a
+    generation counter) or by another process (tracked with the version of the store). The version is checked at most
+    once every `ttl` seconds.
+    """
+    store: AttackStore
+    ttl: float
+    generation: int = 0
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, store: AttackStore, ttl: float = 5.0):
+        self.store = store
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._attacks: List[PriceAttack] = []
+        self._loaded_generation: Optional[int] = None
+        self._loaded_version: Hashable = None
+        self._checked_at: float = 0.0
+
+    def _get_all(self, count: bool = True) -> List[PriceAttack]:
+        """
+        Get the attacks, reading them from the underlying store again when it has changed.
+        :param count: Whether to count this as a hit or a miss of the cache.
+        :return: All attacks.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._loaded_generation == self.generation:
+                if now - self._checked_at < self.ttl:
+                    self.hits += count
+                    return self._attacks
+                version = self.store.version()
+                if version == self._loaded_version:
+                    self.hits += count
+                    self._checked_at = now
+                    return self._attacks
+            else:
+                version = self.store.version()
+
+            self.misses += count
+            self._attacks = self.store.get_attacks()
+            self._loaded_generation = self.generation
+            self._loaded_version = version
+            self._checked_at = now
+            return self._attacks
+
+    def get_attacks(self, start_date: Optional[pendulum.DateTime] = None,
+                    end_date: Optional[pendulum.DateTime] = None) -> List[PriceAttack]:
+        return [attack for attack in self._get_all() if attack.overlaps(start_date, end_date)]
+
+    def add_attack(self, attack: PriceAttack, replace: bool = True) -> None:
+        with self._lock:
+            self.store.add_attack(attack, replace)
+            self.generation += 1
+
+    def version(self) -> Hashable:
+        # a version probe is not a read of the attacks, so it does not count towards the hits and misses
+        self._get_all(count=False)
+        return self._loaded_version
+
+    def stats(self) -> Dict[str, int]:
+        """ The hit and miss counters of the cache, and the current generation. """
+        return {"hits": self.hits, "misses": self.misses, "generation": self.generation}
+
+
+class AttackCacheTests(unittest.TestCase):
+    """
+    Tests to ensure that the attack cache only reads the underlying store when it has changed.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.shelve_db = os.path.join(self.directory.name, "attack")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testLocalWrite(self):
+        cache = AttackCache(ShelveAttackStore(self.shelve_db), ttl=60)
+        self.assertEqual(cache.get_attacks(), [])
+        self.assertEqual(cache.get_attacks(), [])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        attack = PriceAttack(1.5, pendulum.parse("2022-01-01T00:00"), pendulum.parse("2022-01-01T01:00"))
+        cache.add_attack(attack)
+        self.assertEqual(cache.get_attacks(), [attack])
+        self.assertEqual(cache.get_attacks(pendulum.parse("2022-01-01T01:00")), [])
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def testExternalWrite(self):
+        cache = AttackCache(ShelveAttackStore(self.shelve_db), ttl=0)
+        self.assertEqual(cache.get_attacks(), [])
+
+        # a database written by an older version of the API server, and by another process
+        attack = PriceAttack(2, pendulum.parse("2022-01-01T00:00"), pendulum.parse("2022-01-01T01:00"))
+        with shelve.open(self.shelve_db) as db:
+            db["attack"] = attack
+        os.utime(f"{self.shelve_db}.dat" if os.path.exists(f"{self.shelve_db}.dat") else self.shelve_db,
+                 ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+
+        self.assertEqual(cache.get_attacks(), [attack])
+        self.assertEqual(cache.get_attacks(), [attack])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def testVersion(self):
+        cache = AttackCache(ShelveAttackStore(self.shelve_db), ttl=60)
+        first = cache.version()
+        self.assertEqual(cache.version(), first)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+        cache.add_attack(PriceAttack(1.5, pendulum.parse("2022-01-01T00:00"), pendulum.parse("2022-01-01T01:00")))
+        self.assertNotEqual(cache.version(), first)
+        cache.get_attacks()
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def testOverlappingAttacks(self):
+        store = ShelveAttackStore(self.shelve_db)
+        first = PriceAttack(2, pendulum.parse("2022-01-01T00:00"), pendulum.parse("2022-01-01T02:00"))
+        second = PriceAttack(3, pendulum.parse("2022-01-01T01:00"), pendulum.parse("2022-01-01T03:00"))
+        store.add_attack(first)
+        store.add_attack(second, replace=False)
+        self.assertEqual(store.get_attacks(pendulum.parse("2022-01-01T01:30"), pendulum.parse("2022-01-01T02:30")),
+                         [first, second])
+        store.add_attack(second)
+        self.assertEqual(store.get_attacks(), [second])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import abc
+import os
+import shelve
+import threading
+from typing import Optional, List, Hashable
+
+import pendulum
+from sqlalchemy import select, update, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+from chai_api.db_definitions import Attack
+from chai_api.energy_loop import PriceAttack
+
+
+class AttackStore(abc.ABC):
+    """
+    A place where price attacks are kept, shared by the API server processes and the heating cron.
+    Several attacks can be stored at the same time; when they overlap their modifiers are multiplied.
+    """
+
+    @abc.abstractmethod
+    def get_attacks(self, start_date: Optional[pendulum.DateTime] = None,
+                    end_date: Optional[pendulum.DateTime] = None) -> List[PriceAttack]:
+        """
+        Get the stored attacks that overlap with the given range.
+        :param start_date: The start of the range (inclusive), or None to not restrict the start.
+        :param end_date: The end of the range (exclusive), or None to not restrict the end.
+        :return: The attacks that affect at least part of the range, in the order they were added.
+        """
+
+    @abc.abstractmethod
+    def add_attack(self, attack: PriceAttack, replace: bool = True) -> None:
+        """
+        Store a new attack.
+        :param attack: The attack to store.
+        :param replace: Whether the new attack replaces all stored attacks, or is added alongside them.
+        """
+
+    @abc.abstractmethod
+    def version(self) -> Hashable:
+        """
+        Get a value that changes whenever the stored attacks change, for any process that shares this store.
+        """
+
+
+class ShelveAttackStore(AttackStore):
+    """ Keep the attacks in a local shelve database, which can only be shared by processes on the same host. """
+    shelve_db: str
+
+    def __init__(self, shelve_db: str):
+        self.shelve_db = shelve_db
+        self._lock = threading.Lock()
+
+    def get_attacks(self, start_date: Optional[pendulum.DateTime] = None,
+                    end_date: Optional[pendulum.DateTime] = None) -> List[PriceAttack]:
+        with self._lock, shelve.open(self.shelve_db) as db:
+            attacks = db.get("attacks", None)
+            if attacks is None:  # databases written before several attacks were supported hold a single attack
+                attacks = [db["attack"]] if "attack" in db else []
+        return [attack for attack in attacks if attack.overlaps(start_date, end_date)]
+
+    def add_attack(self, attack: PriceAttack, replace: bool = True) -> None:
+        with self._lock, shelve.open(self.shelve_db) as db:
+            attacks = [] if replace else db.get("attacks", [db["attack"]] if "attack" in db else [])
+            db["attacks"] = attacks + [attack]
+            if "attack" in db:
+                del db["attack"]
+
+    def version(self) -> Hashable:
+        # depending on the dbm implementation shelve adds .db, .dat or .dir to the file name, or nothing at all
+        mtimes = []
+        for suffix in ("", ".db", ".dat", ".dir"):
+            try:
+                mtimes.append(os.stat(f"{self.shelve_db}{suffix}").st_mtime_ns)
+            except FileNotFoundError:
+                pass
+        return max(mtimes, default=None)
+
+
+class DatabaseAttackStore(AttackStore):
+    """ Keep the attacks in the attack table, so that every worker on every host sees the same attacks. """
+
+    def __init__(self, engine: Engine):
+        self._sessions = sessionmaker(engine)
+
+    def get_attacks(self, start_date: Optional[pendulum.DateTime] = None,
+                    end_date: Optional[pendulum.DateTime] = None) -> List[PriceAttack]:
+        query = select(
+            Attack.modifier, Attack.start, Attack.end
+        ).where(
+            Attack.cancelled_at.is_(None)
+        ).order_by(
+            Attack.id
+        )
+
+        # an attack overlaps when it ends after the start of the range and starts before the end of the range
+        if start_date is not None:
+            query = query.where(Attack.end > start_date)
+        if end_date is not None:
+            query = query.where(Attack.start < end_date)
+
+        with self._sessions() as session:
+            return [PriceAttack(modifier, pendulum.instance(start), pendulum.instance(end))
+                    for (modifier, start, end) in session.execute(query)]
+
+    def add_attack(self, attack: PriceAttack, replace: bool = True) -> None:
+        with self._sessions() as session:
+            now = pendulum.now()
+            if replace:
+                session.execute(update(Attack).where(Attack.cancelled_at.is_(None)).values(cancelled_at=now))
+            # noinspection PyTypeChecker
+            session.add(Attack(modifier=attack.modifier, start=attack.start_date, end=attack.end_date, created_at=now))
+            session.commit()
+
+    def version(self) -> Hashable:
+        # attacks are only ever added or cancelled, both of which change one of these values
+        with self._sessions() as session:
+            return tuple(session.execute(select(func.max(Attack.id), func.count(Attack.cancelled_at))).one())
+
+
+def create_attack_store(kind: str, shelve_db: str = "", engine: Optional[Engine] = None) -> AttackStore:
+    """
+    Create the attack store of the given kind.
+    :param kind: Either "shelve" or "database".
+    :param shelve_db: The path to the shelve database, used by the shelve store.
+    :param engine: The database engine, used by the database store.
+    :return: The attack store.
+    """
+    if kind == "shelve":
+        return ShelveAttackStore(shelve_db)
+    if kind == "database":
+        if engine is None:
+            raise ValueError("A database engine is required to store attacks in the database.")
+        return DatabaseAttackStore(engine)
+    raise ValueError(f"Unknown attack store '{kind}', expected 'shelve' or 'database'.")
@@ -1,17 +1,38 @@
 # pylint: disable=line-too-long, missing-module-docstring, too-few-public-methods, missing-class-docstring
 # pylint: disable=singleton-comparison
 
+import asyncio
+import hashlib
+import hmac
+import os
+import re
+import threading
+import time
+import unittest
 from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Optional
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import pendulum
 
 from sqlalchemy import Column, Boolean, String, Integer, Float, DateTime, ForeignKey, TIMESTAMP, Index, JSON
-from sqlalchemy import and_
-from sqlalchemy import create_engine
-from sqlalchemy.engine import Engine
-from sqlalchemy.orm import aliased
+from sqlalchemy import create_engine, event, select, text
+from sqlalchemy.dialects import registry
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import NoSuchModuleError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.orm import scoped_session, Session, sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql import Select
+
+from chai_api.utilities import TTLCache
+
+
+# pg8000 is pure Python; psycopg2 and psycopg (version 3, which requires SQLAlchemy 2) are implemented in C
+SYNC_DRIVERS = ("pg8000", "psycopg2", "psycopg")
+ASYNC_DRIVERS = ("asyncpg",)
 
 
 @dataclass
@@ -21,16 +42,150 @@ class Configuration:
     password: str
     database: str = "chai"
     enable_debugging: bool = False
+    pool_size: int = 5  # the number of connections kept open
+    max_overflow: int = 10  # the number of connections opened on top of the pool when it is exhausted
+    pool_recycle: int = 1800  # the number of seconds after which a connection is replaced, or -1 to never replace it
+    pool_pre_ping: bool = True  # test a connection before using it, so connections broken by a restart are replaced
+    statement_timeout: Optional[int] = None  # the number of milliseconds after which a statement is cancelled
+    pgbouncer: bool = False  # connect through PgBouncer in transaction pooling mode, which pools the connections
+    driver: str = "pg8000"  # the PostgreSQL driver, one of SYNC_DRIVERS, or of ASYNC_DRIVERS for an asyncio engine
+
+
+def _engine_arguments(config: Configuration, drivers: Tuple[str, ...]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Get the URL and the arguments to create an engine with.
+    :param config: The configuration to use to initialise the database engine.
+    :param drivers: The drivers the engine can use.
+    :return: The URL of the database and the keyword arguments for creating the engine.
+    """
+    if config.driver not in drivers:
+        raise ValueError(f"the database driver '{config.driver}' cannot be used here, use one of {', '.join(drivers)}")
+    if not _has_dialect(config.driver):
+        raise ValueError(f"the database driver '{config.driver}' is not supported by this version of SQLAlchemy")
+
+    target = f"postgresql+{config.driver}://{config.username}:{config.password}@{config.server}/{config.database}"
+    arguments: Dict[str, Any] = {"echo": config.enable_debugging, "future": True}
+    connect_args: Dict[str, Any] = {}
+    if config.driver in ("pg8000", "psycopg2"):
+        arguments["client_encoding"] = "utf8"
+
+    if config.pgbouncer:
+        arguments["poolclass"] = NullPool
+        # prepared statements are kept per server connection, which PgBouncer hands to a different client each time
+        if config.driver == "psycopg":
+            connect_args["prepare_threshold"] = None
+        elif config.driver == "asyncpg":
+            connect_args["statement_cache_size"] = 0
+            target += "?prepared_statement_cache_size=0"
+    else:
+        arguments.update(pool_size=config.pool_size, max_overflow=config.max_overflow,
+                         pool_recycle=config.pool_recycle, pool_pre_ping=config.pool_pre_ping)
+        if config.statement_timeout is not None:
+            timeout = int(config.statement_timeout)
+            if config.driver == "pg8000":
+                connect_args["startup_params"] = {"options": f"-c statement_timeout={timeout}"}
+            elif config.driver == "asyncpg":
+                connect_args["server_settings"] = {"statement_timeout": str(timeout)}
+            else:
+                connect_args["options"] = f"-c statement_timeout={timeout}"
+
+    arguments["connect_args"] = connect_args
+    return target, arguments
+
+
+def _has_dialect(driver: str) -> bool:
+    """ Whether SQLAlchemy has a dialect for a PostgreSQL driver. """
+    try:
+        registry.load(f"postgresql.{driver}")
+        return True
+    except NoSuchModuleError:
+        return False
+
+
+def _set_statement_timeout(engine: Engine, config: Configuration) -> None:
+    """ Set the statement timeout at the start of every transaction, for connections through PgBouncer. """
+    if config.pgbouncer and config.statement_timeout is not None:
+        event.listen(engine, "begin", lambda connection: connection.exec_driver_sql(
+            f"SET LOCAL statement_timeout = {int(config.statement_timeout)}"
+        ))
 
 
 def db_engine(config: Configuration):
     """
     Get a database engine.
+    When connecting through PgBouncer the connections are not pooled by the engine, and no state is kept on the server
+    side between transactions; the statement timeout is then set at the start of every transaction.
     :param config: The configuration to use to initialise the database engine.
     :return: A database engine connection.
     """
-    target = f"postgresql+pg8000://{config.username}:{config.password}@{config.server}/{config.database}"
-    return create_engine(target, echo=config.enable_debugging, future=True, client_encoding="utf8")
+    (target, arguments) = _engine_arguments(config, SYNC_DRIVERS)
+    engine = create_engine(target, **arguments)
+    _set_statement_timeout(engine, config)
+    return engine
+
+
+def db_async_engine(config: Configuration) -> AsyncEngine:
+    """
+    Get an asyncio database engine, which is configured the same way as a database engine.
+    :param config: The configuration to use to initialise the database engine, with an asyncio driver.
+    :return: An asyncio database engine.
+    """
+    (target, arguments) = _engine_arguments(config, ASYNC_DRIVERS)
+    engine = create_async_engine(target, **arguments)
+    _set_statement_timeout(engine.sync_engine, config)
+    return engine
+
+
+class PoolMetrics:
+    """
+    Count the connections made and handed out by the pool of an engine, and how long they are held.
+    """
+    connects: int = 0
+    checkouts: int = 0
+    invalidations: int = 0
+    held: float = 0.0
+    max_held: float = 0.0
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+
+    def _on_connect(self, *_):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, _, record, __):
+        record.info["checked_out_at"] = time.monotonic()
+        with self._lock:
+            self.checkouts += 1
+
+    def _on_checkin(self, _, record):
+        checked_out_at = record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            held = time.monotonic() - checked_out_at
+            with self._lock:
+                self.held += held
+                self.max_held = max(self.max_held, held)
+
+    def _on_invalidate(self, *_):
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """ The number of connections made, handed out, and invalidated, how long they are held, and the pool status. """
+        pool = self.engine.pool
+        return {
+            "connects": self.connects, "checkouts": self.checkouts, "invalidations": self.invalidations,
+            "mean_held_ms": round(self.held / self.checkouts * 1000, 1) if self.checkouts else 0.0,
+            "max_held_ms": round(self.max_held * 1000, 1),
+            "checked_out": pool.checkedout() if isinstance(pool, QueuePool) else None,
+            "size": pool.size() if isinstance(pool, QueuePool) else None,
+            "overflow": pool.overflow() if isinstance(pool, QueuePool) else None,
+        }
 
 
 @contextmanager
@@ -93,6 +248,7 @@ class Home(Base):
     revision = Column(TIMESTAMP(timezone=True), nullable=False)
     netatmoID = Column("netatmoid", Integer, ForeignKey("netatmodevice.id"), nullable=False)
     relay: NetatmoDevice = relationship("NetatmoDevice")
+    idxLatestHome = Index("ix_latest_home", label, revision.desc())
 
 
 class NetatmoReading(Base):
@@ -105,6 +261,7 @@ class NetatmoReading(Base):
     reading = Column(Float, nullable=False)
     relay: NetatmoDevice = relationship("NetatmoDevice", back_populates="readings")
     idxOneReading = Index("ix_one_reading", id, room_id, start, unique=True)
+    idxDeviceReading = Index("ix_device_reading", netatmo_id, room_id, start, unique=True, postgresql_include=["end", "reading"])
 
 
 class SetpointChange(Base):
@@ -119,6 +276,7 @@ class SetpointChange(Base):
     price = Column(Float)
     hidden = Column(Boolean, nullable=False)
     home: Home = relationship("Home")
+    idxVisibleSetpoint = Index("ix_visible_setpoint", home_id, expires_at, postgresql_where=hidden.is_(False))
 
 
 class Log(Base):
@@ -129,6 +287,7 @@ class Log(Base):
     category = Column(String, nullable=False)
     parameters = Column(JSON, nullable=False)
     home: Home = relationship("Home")
+    idxHomeLog = Index("ix_home_log", home_id, timestamp.desc(), category)
 
 
 class Schedule(Base):
@@ -139,6 +298,7 @@ class Schedule(Base):
     day = Column(Integer, nullable=False)
     schedule = Column(JSON, nullable=False)
     home: Home = relationship("Home")
+    idxDaySchedule = Index("ix_day_schedule", home_id, day, revision.desc())
 
 
 class Profile(Base):
@@ -158,6 +318,7 @@ class Profile(Base):
     prediction_banded = Column(JSON)
     home: Home = relationship("Home")
     setpointChange: SetpointChange = relationship("SetpointChange", lazy="selectin")
+    idxLatestProfile = Index("ix_latest_profile", home_id, profile_id, id.desc())
 
     def calculate_temperature(self, price: float):
         """
@@ -168,29 +329,283 @@ class Profile(Base):
         return round(max(7.0, min(30.0, price * self.mean2 + self.mean1)) * 2) / 2
 
 
-def get_home(label: str, session: Session, token: str) -> Optional[Home]:
+class Attack(Base):
+    __tablename__ = "attack"
+    id = Column(Integer, primary_key=True)
+    modifier = Column(Float, nullable=False)
+    start = Column(DateTime(timezone=True), nullable=False)
+    end = Column(DateTime(timezone=True), nullable=False)
+    created_at = Column("createdat", DateTime(timezone=True), nullable=False)
+    cancelled_at = Column("cancelledat", DateTime(timezone=True))  # set when replaced by a newer attack
+    idxActiveAttack = Index("ix_active_attack", start, end, postgresql_where=cancelled_at.is_(None))
+
+
+class ValveCommand(Base):
+    __tablename__ = "valvecommand"
+    home_id = Column("homeid", Integer, ForeignKey("home.id"), primary_key=True)
+    mode = Column(String, nullable=False)  # the heating mode option that was last sent to the valve of the home
+    temperature = Column(Float)  # the temperature that was last sent, if any
+    sent_at = Column("sentat", DateTime(timezone=True), nullable=False)
+    hold_until = Column("holduntil", DateTime(timezone=True), nullable=False)  # when the valve stops holding it
+    home: Home = relationship("Home")
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schemamigration"
+    version = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at = Column("appliedat", DateTime(timezone=True), nullable=False)
+
+
+def current_homes() -> Select:
+    """
+    Select the latest revision of every home, using the ix_latest_home index.
+    :return: A statement that selects one home per label.
+    """
+    return select(Home).distinct(Home.label).order_by(Home.label, Home.revision.desc())
+
+
+def current_schedules(home_id: int) -> Select:
+    """
+    Select the latest revision of the schedule of every day of a home, using the ix_day_schedule index.
+    :param home_id: The ID of the home to get the schedules for.
+    :return: A statement that selects one schedule per day.
+    """
+    return select(
+        Schedule
+    ).where(
+        Schedule.home_id == home_id
+    ).distinct(
+        Schedule.day
+    ).order_by(
+        Schedule.day, Schedule.revision.desc()
+    )
+
+
+def latest_home_query(label: str) -> Select:
+    """
+    Select the latest revision of a home, using the ix_latest_home index.
+    :param label: The label of the home.
+    :return: A statement that selects the ID, label, Netatmo device ID, revision, and token of the home.
+    """
+    return select(
+        Home.id, Home.label, Home.netatmoID, Home.revision, Home.token
+    ).where(
+        Home.label == label
+    ).order_by(
+        Home.revision.desc()
+    ).limit(1)
+
+
+@dataclass(frozen=True)
+class CurrentHome:
+    """ The latest revision of a home, detached from any session so that it can be cached. """
+    id: int
+    label: str
+    netatmoID: int
+    revision: datetime
+
+
+# the number of seconds a home is cached; an old token of a home stays valid for at most this long after a new revision
+HOME_TTL = 30
+
+# the latest revision of each home and the hash of its token, keyed by label
+home_cache: TTLCache[str, Tuple[CurrentHome, bytes]] = TTLCache(maxsize=1024, ttl=HOME_TTL)
+
+
+def _hash_token(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+def invalidate_home(label: Optional[str] = None) -> None:
+    """
+    Forget a cached home, e.g. because a new revision of it has been stored.
+    :param label: The label of the home to forget, or None to forget all homes.
+    """
+    if label is None:
+        home_cache.clear()
+    else:
+        home_cache.discard(label)
+
+
+def get_home(label: str, session: Session, token: str) -> Optional[CurrentHome]:
     """
     Get the home associated with a given label.
+    Homes are cached for a short while, so that most requests are authenticated without accessing the database.
+    A token that does not match the cached home is checked against the database, so that a new revision of a home
+    with a new token can be used right away.
     :param label: The label of the home to get.
     :param session: The database session to use.
     :param token: The token to use to verify the home access.
     :return: The home associated with the label.
     """
-    home_alias = aliased(Home)
-    home = session.query(
-        Home
-    ).outerjoin(
-        home_alias, and_(Home.label == home_alias.label, Home.revision < home_alias.revision)
-    ).filter(
-        home_alias.revision == None  # noqa: E711
-    ).filter(
-        Home.label == label
-    ).first()
+    token_hash = _hash_token(token)
+    entry = home_cache.get(label)
+    if entry is not None and hmac.compare_digest(token_hash, entry[1]):
+        return entry[0]
+
+    return _cache_home(label, session.execute(latest_home_query(label)).first(), token_hash)
+
+
+async def get_home_async(label: str, session: AsyncSession, token: str) -> Optional[CurrentHome]:
+    """
+    Get the home associated with a given label, in the same way as `get_home`, with an asyncio session.
+    :param label: The label of the home to get.
+    :param session: The asyncio database session to use.
+    :param token: The token to use to verify the home access.
+    :return: The home associated with the label.
+    """
+    token_hash = _hash_token(token)
+    entry = home_cache.get(label)
+    if entry is not None and hmac.compare_digest(token_hash, entry[1]):
+        return entry[0]
+
+    return _cache_home(label, (await session.execute(latest_home_query(label))).first(), token_hash)
+
+
+def _cache_home(label: str, row: Optional[Any], token_hash: bytes) -> Optional[CurrentHome]:
+    """
+    Cache the latest revision of a home, and check the token it was asked for with.
+    :param label: The label of the home.
+    :param row: The latest revision of the home, or None when there is no home with the label.
+    :param token_hash: The hash of the token to check.
+    :return: The home, or None when there is no home or the token does not match.
+    """
+    if row is None:
+        return None
 
-    if home and token == home.token:
-        return home
+    entry = (CurrentHome(row.id, row.label, row.netatmoID, row.revision), _hash_token(row.token))
+    home_cache.put(label, entry)
+    if hmac.compare_digest(token_hash, entry[1]):
+        return entry[0]
     return None
 
 
+class HomeCacheTests(unittest.TestCase):
+    """
+    Tests to ensure that cached homes are only returned for the right token, and that new revisions are picked up.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def testCache(self):
+        engine = create_engine("sqlite://")
+        Home.__table__.create(engine)
+        with Session(engine) as session:
+            session.add(Home(label="cached", token="first", revision=datetime(2023, 1, 1), netatmoID=1))
+            session.commit()
+            self.assertEqual(get_home("cached", session, "first").netatmoID, 1)
+            self.assertIsNone(get_home("cached", session, "wrong"))
+
+            # a hit does not need the database at all
+            self.assertEqual(get_home("cached", None, "first").label, "cached")  # type: ignore
+
+            session.add(Home(label="cached", token="second", revision=datetime(2023, 1, 2), netatmoID=2))
+            session.commit()
+            self.assertEqual(get_home("cached", session, "second").netatmoID, 2)
+            self.assertIsNone(get_home("cached", session, "first"))
+            invalidate_home("cached")
+            self.assertIsNone(home_cache.get("cached"))
+
+
+# a PostgreSQL database to test the drivers against, as user:password@server/database; nothing is stored in it
+TEST_DATABASE: Optional[str] = os.environ.get("CHAI_TEST_DATABASE", None)
+
+
+def configuration_for_tests(driver: str) -> Configuration:
+    """ The configuration of the test database for a driver. """
+    match = re.fullmatch(r"([^:@]+):([^@]*)@([^/]+)/(.+)", TEST_DATABASE or "")
+    if match is None:
+        raise ValueError("CHAI_TEST_DATABASE should be given as user:password@server/database")
+    return Configuration(match[3], match[1], match[2], match[4], driver=driver)
+
+
+def create_tables_for_tests(connection: Connection) -> None:
+    """
+    Create the tables in the temporary schema of a connection, with a home that has some of everything.
+    The tables disappear when the transaction of the connection is rolled back.
+    :param connection: A connection with an open transaction.
+    """
+    connection.execute(text("SET LOCAL search_path TO pg_temp"))
+    Base.metadata.create_all(connection, tables=[
+        NetatmoDevice.__table__, Home.__table__, NetatmoReading.__table__, SetpointChange.__table__,
+        Schedule.__table__, Profile.__table__, Log.__table__
+    ])
+    now = pendulum.now("UTC").start_of("minute")
+    connection.execute(NetatmoDevice.__table__.insert().values(id=1, refreshtoken="token"))
+    connection.execute(Home.__table__.insert().values(id=1, label="test", token="token", revision=now, netatmoid=1))
+    connection.execute(NetatmoReading.__table__.insert(), [{
+        "netatmoid": 1, "roomid": 2 + index % 2, "start": now.subtract(minutes=5 * index),
+        "end": now.subtract(minutes=5 * index - 5), "reading": 20.0 + index / 8
+    } for index in range(200)])
+    connection.execute(SetpointChange.__table__.insert().values(
+        id=1, homeid=1, changedat=now, expiresat=now.add(hours=1), duration=60, mode=1, temperature=21.5, price=12.3,
+        hidden=False
+    ))
+    connection.execute(Schedule.__table__.insert(), [
+        {"homeid": 1, "revision": now.subtract(days=revision), "day": day, "schedule": {"0": str(revision + 1)}}
+        for day in (1, 2, 4, 8, 16, 32, 64) for revision in range(3)
+    ])
+    connection.execute(Profile.__table__.insert(), [{
+        "profileid": profile, "homeid": 1, "setpointid": 1, "mean1": 23.0 + revision, "mean2": -0.05, "variance1": 1.0,
+        "variance2": 0.01, "noiseprecision": 0.1, "correlation1": 0.0, "correlation2": 0.0,
+        "confidence_region": [1.0, 2.0, 3.0] if revision else None
+    } for profile in range(1, 6) for revision in range(2)])
+    connection.execute(Log.__table__.insert(), [
+        {"homeid": 1, "timestamp": now.subtract(minutes=index), "category": "SETPOINT_MODE", "parameters": ["auto", index]}
+        for index in range(100)
+    ])
+
+
+@unittest.skipIf(TEST_DATABASE is None, "set CHAI_TEST_DATABASE to user:password@server/database to test the drivers")
+class DriverConformanceTests(unittest.TestCase):
+    """
+    Tests to ensure that every installed driver gives the same results for the queries of the endpoints.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    home = CurrentHome(1, "test", 1, pendulum.now())
+
+    def results(self, connection: Connection) -> List[List[tuple]]:
+        create_tables_for_tests(connection)
+        from chai_api.migrations import _queries  # pylint: disable=import-outside-toplevel
+        return [[tuple(row) for row in connection.execute(query)] for (query, _) in _queries(self.home).values()]
+
+    async def async_results(self, driver: str) -> List[List[tuple]]:
+        engine = db_async_engine(configuration_for_tests(driver))
+        try:
+            async with engine.connect() as connection:
+                async with connection.begin():
+                    results = await connection.run_sync(self.results)
+                    await connection.rollback()
+        finally:
+            await engine.dispose()
+        return results
+
+    def testDrivers(self):
+        results = {}
+        for driver in SYNC_DRIVERS:
+            try:
+                engine = db_engine(configuration_for_tests(driver))
+            except (ValueError, ImportError):
+                continue  # the driver is not installed, or not supported by this version of SQLAlchemy
+            with engine.connect() as connection:
+                with connection.begin() as transaction:
+                    results[driver] = self.results(connection)
+                    transaction.rollback()
+            engine.dispose()
+
+        for driver in ASYNC_DRIVERS:
+            try:
+                results[f"{driver} (asyncio)"] = asyncio.run(self.async_results(driver))
+            except (ValueError, ImportError):
+                continue
+
+        self.assertTrue(all(results["pg8000"]), "every query should return rows")
+        for (driver, result) in results.items():
+            self.assertEqual(result, results["pg8000"], f"{driver} returns different results")
+
+
 if __name__ == "__main__":
-    pass
+    unittest.main()
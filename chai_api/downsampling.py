@@ -0,0 +1,70 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import unittest
+from typing import List, Sequence
+
+
+def lttb(xs: Sequence[float], ys: Sequence[float], threshold: int) -> List[int]:
+    """
+    Select the points of a series that best preserve its shape with the Largest-Triangle-Three-Buckets algorithm.
+    The first and last points are always selected. The other points are split into buckets, and from each bucket the
+    point is selected that forms the largest triangle with the previously selected point and the mean of the next bucket.
+    :param xs: The x values of the points, in ascending order.
+    :param ys: The y values of the points.
+    :param threshold: The number of points to select.
+    :return: The indices of the selected points, in ascending order.
+    """
+    count = len(xs)
+    if threshold >= count:
+        return list(range(count))
+    if threshold < 3:
+        return [0, count - 1][:max(threshold, 0)]
+
+    every = (count - 2) / (threshold - 2)
+    selected = [0]
+    previous = 0
+    for bucket in range(threshold - 2):
+        # the mean of the next bucket, which is the last point for the last bucket
+        mean_start = int((bucket + 1) * every) + 1
+        mean_end = min(int((bucket + 2) * every) + 1, count)
+        mean_x = sum(xs[mean_start:mean_end]) / (mean_end - mean_start)
+        mean_y = sum(ys[mean_start:mean_end]) / (mean_end - mean_start)
+
+        (largest, largest_area) = (-1, -1.0)
+        for index in range(int(bucket * every) + 1, int((bucket + 1) * every) + 1):
+            area = abs((xs[previous] - mean_x) * (ys[index] - ys[previous]) - (xs[previous] - xs[index]) * (mean_y - ys[previous]))
+            if area > largest_area:
+                (largest, largest_area) = (index, area)
+
+        selected.append(largest)
+        previous = largest
+
+    selected.append(count - 1)
+    return selected
+
+
+class DownsamplingTests(unittest.TestCase):
+    """
+    Tests to ensure that downsampling keeps the requested number of points and the features of the series.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def testShape(self):
+        xs = list(range(1000))
+        ys = [20.0] * 1000
+        ys[437] = 30.0  # a single spike must survive downsampling
+        selected = lttb(xs, ys, 50)
+        self.assertEqual(len(selected), 50)
+        self.assertEqual(selected, sorted(set(selected)))
+        self.assertEqual((selected[0], selected[-1]), (0, 999))
+        self.assertIn(437, selected)
+
+    def testSmall(self):
+        self.assertEqual(lttb([0, 1, 2], [1, 2, 3], 5), [0, 1, 2])
+        self.assertEqual(lttb([0, 1, 2, 3], [1, 2, 3, 4], 2), [0, 3])
+        self.assertEqual(lttb([0, 1, 2, 3], [1, 2, 3, 4], 1), [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
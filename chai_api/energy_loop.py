@@ -1,13 +1,20 @@
 # pylint: disable=line-too-long, too-many-lines, missing-module-docstring
 
 import math
-import shelve
 import unittest
+from array import array
+from calendar import isleap
 from dataclasses import dataclass
-from typing import Union, List, Optional
+from datetime import date
+from functools import lru_cache
+from itertools import accumulate, chain
+from typing import Union, List, Optional, TYPE_CHECKING
 
 import pendulum
 
+if TYPE_CHECKING:
+    from chai_api.attack_store import AttackStore
+
 
 @dataclass
 class ElectricityPrice:  # pylint: disable=missing-class-docstring, missing-function-docstring
@@ -35,6 +42,48 @@ class PriceAttack:
     def get_modifier(self, date: pendulum.DateTime):
         return self.modifier if self.is_affected(date) else 1
 
+    def overlaps(self, start_date: Optional[pendulum.DateTime], end_date: Optional[pendulum.DateTime]):
+        return (start_date is None or start_date < self.end_date) and (end_date is None or self.start_date < end_date)
+
+    def apply(self, series: "PriceSeries") -> None:
+        """
+        Apply the modifier to every price in the series that falls within the attack, in place.
+        :param series: The series of prices to modify.
+        """
+        (first, last) = (series.index_of(self.start_date), series.index_of(self.end_date))
+        if first < last:
+            series.prices[first:last] = array("d", (price * self.modifier for price in series.prices[first:last]))
+
+
+@dataclass
+class PriceSeries:
+    """
+    A run of consecutive half-hourly prices, where the n-th price covers [start + n * step, start + (n + 1) * step).
+    Slot boundaries are kept as epoch seconds, so the series can be serialised without any DateTime instances.
+    """
+    start: int
+    prices: array
+    step: int = 1800
+
+    def __len__(self):
+        return len(self.prices)
+
+    def timestamps(self) -> range:
+        """ The epoch seconds at which each slot starts, followed by the end of the last slot. """
+        return range(self.start, self.start + (len(self.prices) + 1) * self.step, self.step)
+
+    def index_of(self, date: pendulum.DateTime) -> int:
+        """ The index of the first slot that starts at or after the given date, clamped to the series. """
+        offset = (date.int_timestamp - self.start) * 1_000_000 + date.microsecond
+        return min(max(0, -(-offset // (self.step * 1_000_000))), len(self.prices))
+
+    def to_prices(self) -> List["ElectricityPrice"]:
+        """ Convert the series into a list of ElectricityPrice instances in the Europe/London timezone. """
+        timezone = pendulum.timezone("Europe/London")
+        dates = [pendulum.from_timestamp(timestamp, tz=timezone) for timestamp in self.timestamps()]
+        return [ElectricityPrice(from_date=dates[index], to_date=dates[index + 1], price=price)
+                for (index, price) in enumerate(self.prices)]
+
 
 data_2019 = {
     1: [13.146, 14.7, 13.65, 12.348, 10.5, 10.416, 10.248, 8.988, 10.71, 10.332, 9.618, 10.71, 10.71, 10.71, 7.14, 7.14,
@@ -1268,20 +1317,19 @@ data_2019 = {
           24.15, 23.94, 23.52, 21.7035, 8.379, 7.98, 8.064, 7.875, 8.82, 6.909, 7.707, 6.867, 7.56, 8.19],
 }
 
+# the 2019 values as a single contiguous buffer, so that a range of days can be served as one slice
+# _day_offsets[day] is the index of the first value of that day, with _day_offsets[366] marking the end of the buffer
+_price_store = array("d", chain.from_iterable(data_2019[day] for day in range(1, 366)))
+_day_offsets = array("l", chain([0], accumulate((len(data_2019[day]) for day in range(1, 366)), initial=0)))
 
-def _get_values(start_date: pendulum.DateTime, end_date: pendulum.DateTime,
-                debug: bool = False) -> Union[List[List[float]], List[int]]:
+
+@lru_cache(maxsize=32)
+def _get_alignment(year: int) -> array:
     """
-    Get the energy values for the given date range – THE GIVEN DATE RANGE MUST BE WITHIN A SINGLE YEAR.
-    :param start_date: The start date of the values to fetch.
-    :param end_date: The end date of the values to fetch.
-    :param debug: Whether to return debug output (indices of records to fetch) or default output.
+    Get the alignment table for a given year, which maps every day of the year onto the day of 2019 to take values from.
+    :param year: The year to align with the 2019 dataset.
+    :return: The day of 2019 for each day of the year, indexed by day of the year (index 0 is unused).
     """
-    if start_date.year != end_date.year:
-        raise ValueError("The given date range must be within a single year.")
-    if end_date < start_date:
-        raise ValueError("The end date must be after or on the start date.")
-
     # Two complications make the task of grabbing cyclic data a more difficult problem than expected:
     #  - the requested date range could be for a leap year, and the data is only available from a non-leap year
     #  - during BST transitions the day does not have 48 entries; we need to align requests to match these transitions
@@ -1289,41 +1337,42 @@ def _get_values(start_date: pendulum.DateTime, end_date: pendulum.DateTime,
     # and consequently on which day the first Sunday of the year happens (BST transitions always happen on Sundays).
     # Leap years have an extra day *before* the first BST transition, but otherwise do not affect it.
 
-    first_day = start_date.start_of("year").day_of_week  # value of 0-6 where 0 is Sunday
+    first_day = date(year, 1, 1).isoweekday() % 7  # value of 0-6 where 0 is Sunday
     first_sunday = (7 - first_day) % 7 + 1  # the first Sunday will be the first_sunday-th day of January
     # the offset is the number of days to add to our retrieval from data_2019
     # this is to align the BST Sundays and ensures that the first BST Sunday for the given year fetches the 90th entry
     offset = 6 - (first_sunday % 7)
 
     # an error occurs when leap year and the offset is a 6 (which, with the extra day, adds an extra week)
-    if offset == 6 and start_date.is_leap_year():
+    if offset == 6 and isleap(year):
         offset -= 7
 
-    # idea: calculate days between and use this modulo 365 + 1 + offset
-    total_days = end_date.day_of_year - start_date.day_of_year
-    start_entry = offset + start_date.day_of_year
-    end_entry = start_entry + total_days
-    extra_end = None
-    extra_start = False
-
     # deal with the edge case where we need more days than there are available
     # there will be at most 7 extra required days, 1 from the leap year and up to 6 from the offset
-    # to handle this simply subtract 7 from the end and grab those from the end of the list
-    if start_entry == 0:
-        extra_start = True
-        start_entry = 1
-    if start_entry > 365:
-        start_entry -= 14
-        end_entry -= 14
-    if end_entry > 365:
-        extra_end = end_entry - 365
-        end_entry = 365
-
-    to_fetch = list(range(start_entry, end_entry + 1))
-    if extra_start:
-        to_fetch.insert(0, 364)
-    if extra_end is not None:
-        to_fetch.extend(range(365 - 13, 365 - 13 + extra_end))
+    # to handle this the day before the first entry is taken from the last week of the list (day 364),
+    # and days beyond the last entry are taken from two weeks earlier so the day of the week still matches
+    table = array("H", [0])
+    for day_of_year in range(1, (366 if isleap(year) else 365) + 1):
+        entry = offset + day_of_year
+        table.append(364 if entry == 0 else (entry - 14 if entry > 365 else entry))
+
+    return table
+
+
+def _get_values(start_date: pendulum.DateTime, end_date: pendulum.DateTime,
+                debug: bool = False) -> Union[List[List[float]], List[int]]:
+    """
+    Get the energy values for the given date range – THE GIVEN DATE RANGE MUST BE WITHIN A SINGLE YEAR.
+    :param start_date: The start date of the values to fetch.
+    :param end_date: The end date of the values to fetch.
+    :param debug: Whether to return debug output (indices of records to fetch) or default output.
+    """
+    if start_date.year != end_date.year:
+        raise ValueError("The given date range must be within a single year.")
+    if end_date < start_date:
+        raise ValueError("The end date must be after or on the start date.")
+
+    to_fetch = list(_get_alignment(start_date.year)[start_date.day_of_year:end_date.day_of_year + 1])
 
     if debug:
         return to_fetch
@@ -1332,84 +1381,105 @@ def _get_values(start_date: pendulum.DateTime, end_date: pendulum.DateTime,
     return [data_2019[fetch] for fetch in to_fetch]
 
 
-def get_energy_values(start_date: pendulum.DateTime, end_date: pendulum.DateTime,
-                      limit: Optional[int] = None, shelve_db: Optional[str] = None) -> List[ElectricityPrice]:
+def _get_slice(year: int, first_day: int, last_day: int) -> array:
+    """
+    Get the energy values for a range of days within a single year as a flat buffer.
+    The days are taken from the contiguous price store, so every run of consecutive days is copied as a single slice.
+    :param year: The year of the days to fetch.
+    :param first_day: The first day of the year to fetch (inclusive).
+    :param last_day: The last day of the year to fetch (inclusive).
+    :return: The half-hourly values of all the days in the range, in order.
+    """
+    to_fetch = _get_alignment(year)[first_day:last_day + 1]
+
+    result = array("d")
+    run_start = run_end = to_fetch[0]
+    for day in chain(to_fetch[1:], [None]):
+        if day == run_end + 1:
+            run_end = day
+            continue
+        result.extend(_price_store[_day_offsets[run_start]:_day_offsets[run_end + 1]])
+        run_start = run_end = day
+
+    return result
+
+
+def get_price_series(start_date: pendulum.DateTime, end_date: pendulum.DateTime,
+                     limit: Optional[int] = None, attack_store: Optional["AttackStore"] = None) -> PriceSeries:
     """
     Find and return the data corresponding with the given start (inclusive) and end date (exclusive).
     :param start_date: The start date of the range.
     :param end_date: The end date of the range.
     :param limit: The maximum number of values to return starting from the oldest.
-    :param shelve_db: The path to a shelve database to use for price attack information.
-    :return: A list of mock electricity values taken from the 2019 dataset
+    :param attack_store: The store to use for price attack information.
+    :return: A series of mock electricity values taken from the 2019 dataset
     """
 
+    if not end_date or not start_date:
+        raise ValueError("The start_date and end_date must be provided.")
+
+    # the instants are taken before converting, as converting a time within the hour repeated when the clocks go back
+    # may move it to the second occurrence of that hour
+    (start_timestamp, end_timestamp) = (start_date.int_timestamp, end_date.int_timestamp)
+
     # CAREFUL: for calculations we need to take account that the original source is in the Europe/London timezone.
-    #          If we forget to convert, the minutes between will be incorrect.
+    #          If we forget to convert, the days will be incorrect.
     start_date = start_date.in_timezone("Europe/London")
     end_date = end_date.in_timezone("Europe/London")
 
-    if not end_date or not start_date:
-        raise ValueError("The start_date and end_date must be provided.")
-
     if end_date < start_date:
         raise ValueError("The end date must be after or on the start date.")
 
     if limit is not None and limit < 0:
         raise ValueError("The limit must be greater than or equal to 0.")
 
-    # split this up into requests for individual years and concatenate the results
-    requests = []
-
-    if start_date.year == end_date.year:
-        requests.append((start_date, end_date))
-    else:
-        middle_date = start_date
-        while middle_date.year < end_date.year:
-            requests.append((middle_date, middle_date.end_of("year")))
-            middle_date = middle_date.end_of("year").add(microseconds=1)
-        requests.append((middle_date, end_date))
-
-    result = [_get_values(start, end) for (start, end) in requests]
-    result = [day_value for sublist in result for day_value in sublist]  # flatten the list of lists of lists
+    # split this up into the days of individual years and concatenate the results
+    result = array("d")
+    for year in range(start_date.year, end_date.year + 1):
+        first_day = start_date.day_of_year if year == start_date.year else 1
+        last_day = end_date.day_of_year if year == end_date.year else (366 if isleap(year) else 365)
+        result.extend(_get_slice(year, first_day, last_day))
 
     # we have the data for the entire range of dates, but we need to remove excess half hours from start and end
-    minutes_between = start_date.start_of("day").diff(start_date).in_minutes()
-
-    start_values_to_drop = math.floor(minutes_between / 30)
-    result[0] = result[0][start_values_to_drop:]
+    day_start = start_date.start_of("day").int_timestamp
+    start_values_to_drop = math.floor((start_timestamp - day_start) / 1800)
 
-    minutes_between = (end_date.end_of("day").diff(end_date).in_seconds() + 1) / 60
-    end_values_to_drop = math.floor(minutes_between / 30)
-    result[-1] = result[-1][0:len(result[-1]) - min(len(result[-1]), end_values_to_drop)]
+    day_end = end_date.end_of("day").int_timestamp + 1
+    end_values_to_drop = math.floor((day_end - end_timestamp) / 1800)
 
-    # all the data is ready; convert it into a nice response with start and end values
+    # round the report start date to the previous 30; every slot after it is a fixed 30 minutes (1800 seconds) later
+    report_start = day_start + 1800 * start_values_to_drop
 
-    # round the report start date to the previous 30
-    report_date = start_date.start_of("day").add(minutes=30 * start_values_to_drop)
-
-    # flatten to a list of values
-    result = [day_value for sublist in result for day_value in sublist]  # flatten the list of lists
+    # the number of slots starting before the end date, in microseconds to keep the arithmetic exact
+    until_end = (end_timestamp - report_start) * 1_000_000 + end_date.microsecond
+    slots = max(0, -(-until_end // 1_800_000_000))
 
     if limit is not None:
-        result = result[:limit]
+        slots = min(slots, limit)
+
+    series = PriceSeries(report_start, result[start_values_to_drop:start_values_to_drop + min(
+        slots, max(0, len(result) - end_values_to_drop - start_values_to_drop)
+    )])
 
-    response = []
-    attack: Optional[PriceAttack] = None
+    if attack_store is not None:
+        # overlapping attacks each apply their own modifier on top of the others
+        for attack in attack_store.get_attacks(start_date, end_date):
+            attack.apply(series)
 
-    if shelve_db is not None:
-        with shelve.open(shelve_db) as db:
-            try:
-                attack = db["attack"]  # noqa
-            except KeyError as _err:
-                pass
+    return series
 
-    while report_date < end_date and len(result) > 0:
-        modifier = 1 if attack is None else attack.get_modifier(report_date)
-        next_date = report_date.add(minutes=30)
-        response.append(ElectricityPrice(from_date=report_date, to_date=next_date, price=result.pop(0) * modifier))
-        report_date = next_date
 
-    return response
+def get_energy_values(start_date: pendulum.DateTime, end_date: pendulum.DateTime,
+                      limit: Optional[int] = None, attack_store: Optional["AttackStore"] = None) -> List[ElectricityPrice]:
+    """
+    Find and return the data corresponding with the given start (inclusive) and end date (exclusive).
+    :param start_date: The start date of the range.
+    :param end_date: The end date of the range.
+    :param limit: The maximum number of values to return starting from the oldest.
+    :param attack_store: The store to use for price attack information.
+    :return: A list of mock electricity values taken from the 2019 dataset
+    """
+    return get_price_series(start_date, end_date, limit, attack_store).to_prices()
 
 
 class EnergyLoopTests(unittest.TestCase):
@@ -1538,6 +1608,37 @@ class EnergyLoopTests(unittest.TestCase):
         values = get_energy_values(pendulum.parse("2022-12-31T10:00"), pendulum.parse("2023-01-01T00:00"))
         self.assertEqual(len(values), 28)
 
+    def testMultiYearAlignment(self):
+        start = pendulum.parse("2023-12-31T00:00", tz="Europe/London")
+        end = pendulum.parse("2025-01-01T00:00", tz="Europe/London")
+        series = get_price_series(start, end)
+        parts = [get_price_series(start, start.add(days=1)), get_price_series(start.add(days=1), end.add(days=-1)),
+                 get_price_series(end.add(days=-1), end)]
+        self.assertEqual(list(series.prices), [price for part in parts for price in part.prices])
+        self.assertEqual(list(_get_alignment(2024)[1:]), _get_values(start.add(days=1), end.add(days=-1), debug=True))
+
+    def testSeriesPartialSlots(self):
+        series = get_price_series(pendulum.parse("2021-07-22T00:10"), pendulum.parse("2021-07-22T01:00:01"))
+        self.assertEqual(len(series), 3)
+        self.assertEqual(series.start, pendulum.parse("2021-07-22T00:00").int_timestamp)
+        self.assertEqual(series.timestamps()[-1], pendulum.parse("2021-07-22T01:30").int_timestamp)
+
+    def testSeriesFallBack(self):
+        # the first 01:00 of the day the clocks go back, which may be moved to the second 01:00 when converted
+        first_one = pendulum.datetime(2024, 10, 27, 0, 0, tz="UTC").in_timezone("Europe/London")
+        start = pendulum.datetime(2024, 10, 27, 0, 30, tz="Europe/London")
+        self.assertEqual(len(get_energy_values(start, first_one)), 1)
+        self.assertEqual(len(get_energy_values(start.subtract(minutes=30), first_one.add(minutes=30))), 3)
+        series = get_price_series(first_one, first_one.add(hours=2))
+        self.assertEqual(len(series), 4)
+        self.assertEqual(series.start, first_one.int_timestamp)
+
+    def testAttackApplied(self):
+        series = get_price_series(pendulum.parse("2021-07-22T00:00"), pendulum.parse("2021-07-22T03:00"))
+        original = list(series.prices)
+        PriceAttack(2, pendulum.parse("2021-07-22T00:45"), pendulum.parse("2021-07-22T02:00")).apply(series)
+        self.assertEqual(list(series.prices), [price * (2 if index in (2, 3) else 1) for (index, price) in enumerate(original)])
+
 
 if __name__ == "__main__":
     get_energy_values(pendulum.parse("2018-03-31T00:59"), pendulum.parse("2018-03-31T01:31"))
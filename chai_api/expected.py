@@ -32,12 +32,28 @@ class HistoryOption(Enum):
     VALVE_STATUS = "valve_status"
 
 
+class HistoryDownsample(Enum):
+    BUCKET = "bucket"
+    LTTB = "lttb"
+
+
+class HistoryFormat(Enum):
+    JSON = "json"
+    NDJSON = "ndjson"
+
+
 @dataclass
 class HistoryGet:
     label: str
     source: HistoryOption
     start: Optional[DateTime]  # defaults to one week ago, or one week before end
     end: Optional[DateTime]
+    resolution: Optional[str]  # the width of a bucket, e.g. 15m, 1h, or 1d
+    max_points: Optional[int]
+    downsample: Optional[HistoryDownsample]  # defaults to buckets when a resolution or maximum number of points is given
+    format: Optional[HistoryFormat]  # defaults to a JSON list
+    limit: Optional[int]  # the number of readings in a page, when paging through the readings
+    cursor: Optional[str]  # the cursor of the next page, as returned by the previous page
 
     def __post_init__(self):
         if self.start is None:
@@ -53,12 +69,19 @@ class ScheduleGet:
     daymask: int
 
 
+class PricesFormat(Enum):
+    LIST = "list"
+    COLUMNAR = "columnar"
+    BINARY = "binary"
+
+
 @dataclass
 class PricesGet:
     start: Optional[DateTime]  # defaults to right now
     end: Optional[DateTime]
     limit: Optional[int]
     default_start: Optional[bool]
+    format: Optional[PricesFormat]  # defaults to the format preferred in the Accept header, or a list otherwise
 
     def __post_init__(self):
         if self.start is None:
@@ -95,6 +118,11 @@ class LogsPut:
     parameters: list
 
 
+@dataclass
+class ReadingsPut:
+    label: str
+
+
 @dataclass
 class ProfileGet:
     label: str
@@ -130,7 +158,11 @@ class XAIGet:
 class AttackPut:
     modifier: float
     duration: Optional[int]  # in minutes, must be multiple of 30
+    start: Optional[DateTime]  # defaults to the start of the next half hour slot
+    overlap: Optional[bool]  # whether to keep earlier attacks, which are replaced by default
 
     def __post_init__(self):
         if self.duration is None:
             self.duration = 60
+        if self.overlap is None:
+            self.overlap = False
@@ -2,11 +2,20 @@
 # # pylint: disable=no-member, c-extension-no-member, too-few-public-methods
 # # pylint: disable=missing-class-docstring, missing-function-docstring
 
+import asyncio
 import os
 import shelve
 import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Callable, Optional, Dict, List, Tuple
+from unittest import mock
 from requests.exceptions import Timeout
 
 import click
@@ -18,16 +27,32 @@ from chai_data_sources import NetatmoClient, SetpointMode, DeviceType, NetatmoEr
 from dacite import from_dict, DaciteError, Config
 from falcon import Request, Response
 from pushover_complete import PushoverAPI as Pushover
-from sqlalchemy import and_
-from sqlalchemy.orm import aliased, Session
+from sqlalchemy import select, true, update, JSON, and_, create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, sessionmaker, aliased
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql import Select
 from sqlalchemy.sql.expression import func
+from sqlalchemy.util import greenlet_spawn
 
+from chai_api import metrics
+from chai_api.attack_cache import AttackCache
+from chai_api.attack_store import AttackStore, create_attack_store
 from chai_api.db_definitions import NetatmoReading, NetatmoDevice, get_home, SetpointChange, Schedule, Profile, Home
+from chai_api.db_definitions import get_home_async
 from chai_api.db_definitions import db_engine_manager, db_session_manager, Configuration as DBConfiguration
-from chai_api.db_definitions import Log
+from chai_api.db_definitions import Log, ValveCommand, current_homes, Base, db_engine
+from chai_api.db_definitions import TEST_DATABASE, configuration_for_tests, create_tables_for_tests
 from chai_api.energy_loop import get_energy_values, ElectricityPrice
 from chai_api.expected import HeatingGet, HeatingPut
+from chai_api.netatmo_pool import NetatmoClientPool
 from chai_api.responses import HeatingMode, HeatingModeOption, ValveStatus
+from chai_api.schedule_index import get_schedule_index
+
+
+# the number of minutes for which a valve holds the temperature it is sent, after which it follows its own schedule
+VALVE_HOLD = 60
 
 
 class MissingPriceError(Exception):
@@ -62,16 +87,136 @@ class HeatingStatus:
     log: Optional[Log] = None
 
 
-def _get_heating_status(home_id: int, db_session: Session, shelve_db: str) -> HeatingStatus:
+@dataclass
+class HeatingSnapshot:
+    """ Everything that determines the heating status of a home at a given moment. """
+    now: pendulum.DateTime
+    setpoint_mode: Optional[int]  # the mode of the latest unexpired setpoint change, if any
+    setpoint_temperature: Optional[float]
+    setpoint_expires_at: Optional[datetime]
+    daymask: int  # the day of the week of `now`, e.g. 1 for Monday
+    schedule_revision: Optional[datetime]
+    schedule: Optional[Dict[str, int]]  # the latest schedule for the day of the week of `now`
+    profiles: List[Profile]  # the latest version of each profile; these are not part of the session
+    valve_percentage: Optional[float]
+    valve_temperature: Optional[float]
+
+
+def heating_snapshot_query(home_id: int, daymask: int) -> Select:
+    """
+    Select the state of a home that determines its heating status in a single statement.
+    :param home_id: The ID of the home to get the state for.
+    :param daymask: The day of the week to get the schedule for, e.g. 1 for Monday.
+    :return: A statement that selects the latest setpoint change, schedule, profiles, and valve readings of the home.
+    """
+    setpoint = select(
+        SetpointChange.mode, SetpointChange.temperature, SetpointChange.expires_at
+    ).where(
+        SetpointChange.home_id == home_id,
+        SetpointChange.hidden.is_(False),
+        SetpointChange.expires_at > func.current_timestamp()
+    ).order_by(
+        SetpointChange.id.desc()
+    ).limit(1).lateral("setpoint")
+
+    schedule = select(
+        Schedule.revision, Schedule.schedule
+    ).where(
+        Schedule.home_id == home_id, Schedule.day == daymask
+    ).order_by(
+        Schedule.revision.desc()
+    ).limit(1).lateral("day_schedule")
+
+    latest_profiles = select(
+        Profile.profile_id, Profile.mean1, Profile.mean2
+    ).where(
+        Profile.home_id == home_id
+    ).distinct(
+        Profile.profile_id
+    ).order_by(
+        Profile.profile_id, Profile.id.desc()
+    ).subquery("latest_profiles")
+    profiles = select(
+        func.json_agg(func.json_build_object(
+            "profile_id", latest_profiles.c.profile_id, "mean1", latest_profiles.c.mean1,
+            "mean2", latest_profiles.c.mean2
+        ), type_=JSON)
+    ).scalar_subquery()
+
+    def latest_reading(room_id: int):
+        return select(
+            NetatmoReading.reading
+        ).where(
+            NetatmoReading.netatmo_id == Home.netatmoID, NetatmoReading.room_id == room_id
+        ).order_by(
+            NetatmoReading.start.desc()
+        ).limit(1).scalar_subquery()
+
+    return select(
+        setpoint.c.mode, setpoint.c.temperature, setpoint.c.expires_at,
+        schedule.c.revision, schedule.c.schedule, profiles,
+        latest_reading(3),  # valve percentage
+        latest_reading(2),  # T3 valve temperature
+    ).select_from(
+        Home
+    ).outerjoin(
+        setpoint, true()
+    ).outerjoin(
+        schedule, true()
+    ).where(
+        Home.id == home_id
+    )
+
+
+def _snapshot_time() -> Tuple[pendulum.DateTime, int]:
+    """ The current time, and the daymask of the day of the week, e.g. 1 for Monday. """
+    now = pendulum.now("Europe/London")
+    day_of_week = now.day_of_week
+    day_of_week = day_of_week if day_of_week != 0 else 7
+    return now, 2 ** (day_of_week - 1)
+
+
+def _get_heating_snapshot(home_id: int, db_session: Session) -> HeatingSnapshot:
+    """
+    Fetch the state of a home that determines its heating status in a single statement.
+    :param home_id: The ID of the home to get the state for.
+    :param db_session: The database session to use when accessing DB information.
+    :return: The state of the home right now.
+    """
+    (now, daymask) = _snapshot_time()
+    return _to_snapshot(now, daymask, db_session.execute(heating_snapshot_query(home_id, daymask)).one())
+
+
+async def _get_heating_snapshot_async(home_id: int, db_session: AsyncSession) -> HeatingSnapshot:
+    """ The same as `_get_heating_snapshot`, with an asyncio session. """
+    (now, daymask) = _snapshot_time()
+    return _to_snapshot(now, daymask, (await db_session.execute(heating_snapshot_query(home_id, daymask))).one())
+
+
+def _to_snapshot(now: pendulum.DateTime, daymask: int, row: Any) -> HeatingSnapshot:
+    """ Turn a row selected by `heating_snapshot_query` into the state of a home. """
+    return HeatingSnapshot(
+        now, row[0], row[1], row[2], daymask, row[3], row[4],
+        [Profile(profile_id=entry["profile_id"], mean1=entry["mean1"], mean2=entry["mean2"]) for entry in row[5] or []],
+        row[6], row[7]
+    )
+
+
+def _get_heating_status(home_id: int, db_session: Optional[Session], attack_store: AttackStore,
+                        snapshot: Optional[HeatingSnapshot] = None) -> HeatingStatus:
     """
     Get the current heating status for the given home.
     :param home_id: The ID of the home to get the status for.
-    :param db_session: The database session to use when accessing DB information.
-    :param shelve_db: The path to the shelve database to use for pricing attacks.
+    :param db_session: The database session to use when accessing DB information, only used without a snapshot.
+    :param attack_store: The store to use for pricing attacks.
+    :param snapshot: The state of the home when it has already been fetched, otherwise it is fetched here.
     :return: The current heating status. The mode will be one out of the 4 available options. For each mode the
              target temperature to send to Netatmo devices is returned. The expires_at field is only set when the
              current heating status is not controlled by the AI (i.e. pure AUTO mode that isn't OVERRIDE).
     """
+    if snapshot is None:
+        snapshot = _get_heating_snapshot(home_id, db_session)
+
     # identify the heating status for the home by first looking for any setpoint changes,
     # and if there are none using the active profile to determine the desired temperature
 
@@ -82,82 +227,37 @@ def _get_heating_status(home_id: int, db_session: Session, shelve_db: str) -> He
     #   - if in auto mode, but without a target temperature: the user switched back to default auto mode
     # if it is not:
     #   - it must be in auto mode. The setpoint temperature is calculated as the current profile
-    active_setpoint = db_session.query(
-        SetpointChange
-    ).filter(
-        SetpointChange.hidden.is_(False)
-    ).filter(
-        SetpointChange.home_id == home_id
-    ).filter(
-        SetpointChange.expires_at > func.current_timestamp()
-    ).order_by(
-        SetpointChange.id.desc()
-    ).first()
-
-    if active_setpoint is not None and (active_setpoint.mode != 1 or active_setpoint.temperature is not None):
-        mode = HeatingModeOption.OVERRIDE if active_setpoint.mode == 1 else (
-            HeatingModeOption.ON if active_setpoint.mode == 2 else HeatingModeOption.OFF
+    if snapshot.setpoint_mode is not None and (snapshot.setpoint_mode != 1 or snapshot.setpoint_temperature is not None):
+        mode = HeatingModeOption.OVERRIDE if snapshot.setpoint_mode == 1 else (
+            HeatingModeOption.ON if snapshot.setpoint_mode == 2 else HeatingModeOption.OFF
         )
-        temperature = active_setpoint.temperature if active_setpoint.mode == 1 else (
-            30 if active_setpoint == 2 else 6
+        temperature = snapshot.setpoint_temperature if snapshot.setpoint_mode == 1 else (
+            30 if snapshot.setpoint_mode == 2 else 6
         )
-        return HeatingStatus(mode, temperature, active_setpoint.expires_at)
+        return HeatingStatus(mode, temperature, snapshot.setpoint_expires_at)
 
     # if we reach this point we know that the system is in auto mode, and we need to calculate the temperature
     # the system is in auto mode
     # grab the current profile for the home, grab the current cost, grab the profile parameters, and calculate
-    now = pendulum.now("Europe/London")
+    now = snapshot.now
 
-    # calculate the 15 min interval for the current time as well as the daymask for the day
+    # calculate the 15 min interval for the current time; the schedule for the day is part of the snapshot
     slot = now.hour * 4 + now.minute // 15
-    day_of_week = now.day_of_week
-    day_of_week = day_of_week if day_of_week != 0 else 7
-    daymask = 2 ** (day_of_week - 1)
 
     # get the cost for the current half hour slot
-    values: [ElectricityPrice] = get_energy_values(now, now, limit=1, shelve_db=shelve_db)  # get current elec price
+    values: [ElectricityPrice] = get_energy_values(now, now, limit=1, attack_store=attack_store)  # get current elec price
     if len(values) != 1:  # if there is no current price, return an error
         raise MissingPriceError
     price = values[0]
 
-    # find the schedule for the given day
-    schedule_alias = aliased(Schedule)
-    schedule = db_session.query(
-        Schedule
-    ).outerjoin(
-        schedule_alias, and_(
-            Schedule.home_id == schedule_alias.home_id,
-            Schedule.revision < schedule_alias.revision,
-            Schedule.day == schedule_alias.day)
-    ).filter(
-        schedule_alias.revision == None  # noqa: E711
-    ).filter(
-        Schedule.home_id == home_id
-    ).filter(
-        Schedule.day == daymask
-    ).first()
-
-    if schedule is None:
+    if snapshot.schedule is None:
         raise MissingScheduleError
 
-    # turn the schedule into a list of (int, int) in reversed order, e.g. [(43, 3), (27, 1), (0, 2)]
-    profiles_schedule = [(int(key), int(value)) for (key, value) in schedule.schedule.items()]
-    profiles_schedule.sort(key=lambda x: x[0], reverse=True)
-    # find the first profile with a slot less than or equal to the slot for the current datetime
-    current_profile = next(filter(lambda entry: entry[0] <= slot, profiles_schedule), None)
+    # the schedule is compiled once per revision into the profile for each slot of the day
+    current_profile = get_schedule_index(home_id, snapshot.daymask, snapshot.schedule_revision, snapshot.schedule)[slot]
 
-    # fetch this profile from the database
-    subquery = db_session.query(func.max(Profile.id)).filter(
-        Profile.home_id == home_id
-    ).group_by(Profile.profile_id).subquery()
-
-    profile = db_session.query(
-        Profile
-    ).filter(
-        Profile.id.in_(subquery)
-    ).filter(
-        Profile.profile_id == current_profile[1]
-    ).first()
+    # find this profile among the latest profiles of the home
+    profile = next((entry for entry in snapshot.profiles if entry.profile_id == current_profile), None)
 
     if profile is None:
         raise MissingProfileError
@@ -176,51 +276,125 @@ def _get_heating_status(home_id: int, db_session: Session, shelve_db: str) -> He
                              ]))
 
 
-def _set_netatmo_heating(label: str, target_status: HeatingStatus, db_session: Session,
-                         device: NetatmoDevice, client_id: str, client_secret: str) -> bool:
+def _store_refresh_token(engine: Engine, device_id: int, refresh_token: str) -> None:
     """
-    Set the Netatmo device to the desired temperature
-    :param device: The Netatmo device to manipulate.
-    :param temperature: The temperature to set the device to.
-    :param mode: The mode to set the device to.
+    Store the rotated refresh token of a Netatmo device in a session of its own, independent of any request.
+    :param engine: The database engine to store the token with.
+    :param device_id: The ID of the device.
+    :param refresh_token: The new refresh token of the device.
+    """
+    with Session(engine) as session:
+        session.execute(update(NetatmoDevice).where(NetatmoDevice.id == device_id).values({NetatmoDevice.refreshToken: refresh_token}))
+        session.commit()
+
+
+@lru_cache(maxsize=None)
+def _get_client_pool(client_id: str, client_secret: str, engine: Optional[Engine] = None) -> NetatmoClientPool:
+    """
+    Get the pool of Netatmo clients of this process for the given app credentials.
     :param client_id: The client ID to use when connecting to Netatmo.
     :param client_secret: The client secret to use when connecting to Netatmo.
-    :param db_session: The database session to use when accessing DB information.
-    :return: The current heating status.
+    :param engine: The synchronous engine rotated refresh tokens are stored with, or None to set them on the device.
+    :return: The pool of clients.
     """
-    client = NetatmoClient(
-        client_id=client_id,
-        client_secret=client_secret,
-        refresh_token=device.refreshToken
+    pool = NetatmoClientPool(
+        lambda refresh_token: NetatmoClient(client_id=client_id, client_secret=client_secret, refresh_token=refresh_token),
+        store_token=None if engine is None else lambda device_id, refresh_token: _store_refresh_token(engine, device_id, refresh_token)
     )
-    temperature = target_status.temperature
-    valve_mode = SetpointMode.MANUAL
+    metrics.register("netatmo_clients", pool.stats)
+    return pool
+
+
+def _get_valve_temperature(target_status: HeatingStatus) -> Optional[float]:
+    """
+    Get the temperature that is sent to a valve for the given heating status.
+    :param target_status: The heating status to send.
+    :return: The temperature, or None when the valve is turned off.
+    """
     if target_status.mode == HeatingModeOption.OFF:
-        valve_mode = SetpointMode.OFF
-        temperature = None
+        return None
     if target_status.mode == HeatingModeOption.ON:
-        valve_mode = SetpointMode.MANUAL
-        temperature = 30
+        return 30
+    return target_status.temperature
+
+
+def _is_valve_unchanged(target_status: HeatingStatus, command: Optional[ValveCommand],
+                        now: pendulum.DateTime, margin: int) -> bool:
+    """
+    Check whether the valve of a home already holds the given heating status, so it does not need to be sent again.
+    :param target_status: The heating status to send.
+    :param command: The last command sent to the valve of the home, if known.
+    :param now: The current time.
+    :param margin: The number of minutes before the valve stops holding the last command that it is sent again.
+    :return: True when the same mode and temperature were sent, and the valve holds them for longer than the margin.
+    """
+    if command is None:
+        return False
+    return (command.mode == target_status.mode.value and command.temperature == _get_valve_temperature(target_status)
+            and now.add(minutes=margin) < command.hold_until)
 
-    if temperature is not None:
-        temperature = temperature
+
+def _set_netatmo_heating(label: str, target_status: HeatingStatus, db_session: Session,
+                         device: NetatmoDevice, client_id: str, client_secret: str,
+                         home_id: Optional[int] = None, call: Optional[Callable[[Callable[[], Any]], Any]] = None,
+                         engine: Optional[Engine] = None) -> bool:
+    """
+    Set the Netatmo device to the desired temperature
+    :param label: The label of the home, used for logging.
+    :param target_status: The heating status to set the device to.
+    :param db_session: The database session to use when accessing DB information.
+    :param device: The Netatmo device to manipulate.
+    :param client_id: The client ID to use when connecting to Netatmo.
+    :param client_secret: The client secret to use when connecting to Netatmo.
+    :param home_id: The ID of the home, when given the command is recorded so that it is not needlessly repeated.
+    :param call: How the request to Netatmo is made, e.g. in another thread; it is made directly when None.
+    :param engine: The synchronous engine a rotated refresh token is stored with, also when the call is given up on;
+                   when None the token is set on the device and committed with the session.
+    :return: The current heating status.
+    """
+    temperature = _get_valve_temperature(target_status)
+    valve_mode = SetpointMode.OFF if target_status.mode == HeatingModeOption.OFF else SetpointMode.MANUAL
 
     print(f"setting '{label}' to {temperature}°C in mode {valve_mode}")
     if target_status.log is not None:
         db_session.add(target_status.log)
         db_session.commit()
-    return client.set_device(device=DeviceType.VALVE, mode=valve_mode, temperature=temperature, minutes=60)
+
+    # reuse the client of the device, and store the refresh token if Netatmo rotated it
+    refresh_token = device.refreshToken
+    sent_at = pendulum.now()
+
+    # the client is borrowed by the call itself, so that a call that is given up on keeps it until it has finished
+    def send():
+        with _get_client_pool(client_id, client_secret, engine).client(device) as client:
+            return client.set_device(device=DeviceType.VALVE, mode=valve_mode, temperature=temperature, minutes=VALVE_HOLD)
+
+    try:
+        result = send() if call is None else call(send)
+    finally:
+        # a rotated token is committed before a failure rolls the session back, as the old token no longer works
+        if device.refreshToken != refresh_token:
+            db_session.commit()
+
+    if home_id is not None:
+        db_session.merge(ValveCommand(home_id=home_id, mode=target_status.mode.value, temperature=temperature,
+                                      sent_at=sent_at, hold_until=sent_at.add(minutes=VALVE_HOLD)))
+        db_session.commit()
+    return result
 
 
 class HeatingResource:
     client_id: str = ""
     client_secret: str = ""
-    shelve_db: str = ""
+    attack_store: AttackStore
+    engine: Optional[Engine]  # the synchronous engine rotated refresh tokens are stored with
+    netatmo_call: Optional[Callable[[Callable[[], Any]], Any]] = None  # how requests to Netatmo are made
 
-    def __init__(self, client_id, client_secret, shelve_location):
+    def __init__(self, client_id, client_secret, attack_store: AttackStore, engine: Optional[Engine] = None):
         self.client_id = client_id
         self.client_secret = client_secret
-        self.shelve_db = shelve_location
+        self.attack_store = attack_store
+        self.engine = engine
 
     def on_get(self, req: Request, resp: Response):  # noqa
         try:
@@ -236,66 +410,79 @@ class HeatingResource:
                 resp.status = falcon.HTTP_BAD_REQUEST
                 return
 
-            valve_status = db_session.query(
-                NetatmoReading
-            ).filter(
-                NetatmoReading.netatmo_id == home.netatmoID
-            ).filter(
-                NetatmoReading.room_id == 3  # valve percentage
-            ).order_by(
-                NetatmoReading.start.desc()
-            ).first()
-
-            if valve_status is None:
-                resp.content_type = falcon.MEDIA_TEXT
-                resp.text = "no valve status available"
-                resp.status = falcon.HTTP_INTERNAL_SERVER_ERROR
-                return
+            # the readings, setpoint, schedule and profiles of the home are fetched in one go
+            self._respond_with_status(resp, home.id, _get_heating_snapshot(home.id, db_session))
+        except DaciteError as err:
+            resp.content_type = falcon.MEDIA_TEXT
+            resp.status = falcon.HTTP_BAD_REQUEST
+            resp.text = f"one or more of the parameters was not understood\n{err}"
 
-            valve_temperature = db_session.query(
-                NetatmoReading
-            ).filter(
-                NetatmoReading.netatmo_id == home.netatmoID
-            ).filter(
-                NetatmoReading.room_id == 2  # T3 valve temperature
-            ).order_by(
-                NetatmoReading.start.desc()
-            ).first()
-
-            if valve_temperature is None:
-                resp.content_type = falcon.MEDIA_TEXT
-                resp.text = "no temperature available"
-                resp.status = falcon.HTTP_INTERNAL_SERVER_ERROR
-                return
+    async def on_get_async(self, req: Request, resp: Response):  # noqa
+        """ The same as on_get for the ASGI app, which reads the database with the asyncio session of the request. """
+        try:
+            request: HeatingGet = from_dict(HeatingGet, req.params)  # noqa
+            db_session: AsyncSession = req.context.session
 
-            try:
-                heating_status = _get_heating_status(home.id, db_session, shelve_db=self.shelve_db)
-                resp.content_type = falcon.MEDIA_JSON
-                resp.status = falcon.HTTP_OK
-
-                target = heating_status.temperature
-                if heating_status.mode in (HeatingModeOption.ON, HeatingModeOption.OFF):
-                    target = None
-                resp.text = json.dumps(
-                    HeatingMode(
-                        valve_temperature.reading, heating_status.mode, valve_status.reading > 0,
-                        target=target, expires_at=heating_status.expires_at
-                    ).to_dict())
-            except (MissingPriceError, MissingScheduleError, MissingProfileError) as err:
+            home = await get_home_async(request.label, db_session, req.context.get("user", "anonymous"))
+
+            if home is None:
                 resp.content_type = falcon.MEDIA_TEXT
-                if isinstance(err, MissingPriceError):
-                    resp.text = "no electricity price available"
-                elif isinstance(err, MissingScheduleError):
-                    resp.text = "no schedule available for today"
-                elif isinstance(err, MissingProfileError):
-                    resp.text = "no profile available for today"
-                resp.status = falcon.HTTP_INTERNAL_SERVER_ERROR
+                resp.text = "unknown home label, or invalid home token"
+                resp.status = falcon.HTTP_BAD_REQUEST
                 return
+
+            self._respond_with_status(resp, home.id, await _get_heating_snapshot_async(home.id, db_session))
         except DaciteError as err:
             resp.content_type = falcon.MEDIA_TEXT
             resp.status = falcon.HTTP_BAD_REQUEST
             resp.text = f"one or more of the parameters was not understood\n{err}"
 
+    def _respond_with_status(self, resp: Response, home_id: int, snapshot: HeatingSnapshot) -> None:
+        """
+        Respond with the valve readings and the heating status of a home, which need no further database access.
+        :param resp: The response to fill in.
+        :param home_id: The ID of the home.
+        :param snapshot: The state of the home.
+        """
+        if snapshot.valve_percentage is None:
+            resp.content_type = falcon.MEDIA_TEXT
+            resp.text = "no valve status available"
+            resp.status = falcon.HTTP_INTERNAL_SERVER_ERROR
+            return
+
+        if snapshot.valve_temperature is None:
+            resp.content_type = falcon.MEDIA_TEXT
+            resp.text = "no temperature available"
+            resp.status = falcon.HTTP_INTERNAL_SERVER_ERROR
+            return
+
+        try:
+            heating_status = _get_heating_status(home_id, None, self.attack_store, snapshot)
+            resp.content_type = falcon.MEDIA_JSON
+            resp.status = falcon.HTTP_OK
+
+            target = heating_status.temperature
+            if heating_status.mode in (HeatingModeOption.ON, HeatingModeOption.OFF):
+                target = None
+            resp.text = json.dumps(
+                HeatingMode(
+                    snapshot.valve_temperature, heating_status.mode, snapshot.valve_percentage > 0,
+                    target=target, expires_at=heating_status.expires_at
+                ).to_dict())
+        except (MissingPriceError, MissingScheduleError, MissingProfileError) as err:
+            resp.content_type = falcon.MEDIA_TEXT
+            if isinstance(err, MissingPriceError):
+                resp.text = "no electricity price available"
+            elif isinstance(err, MissingScheduleError):
+                resp.text = "no schedule available for today"
+            elif isinstance(err, MissingProfileError):
+                resp.text = "no profile available for today"
+            resp.status = falcon.HTTP_INTERNAL_SERVER_ERROR
+        except ValueError as err:  # a stored schedule that cannot be compiled
+            resp.content_type = falcon.MEDIA_TEXT
+            resp.status = falcon.HTTP_BAD_REQUEST
+            resp.text = f"the schedule of the home for today is not valid\n{err}"
+
     def on_put(self, req: Request, resp: Response):  # noqa
         try:
             options = req.params
@@ -353,13 +540,13 @@ class HeatingResource:
 
             # noinspection PyTypeChecker
             setpoint_change = SetpointChange(
-                home=home,
+                home_id=home.id,
                 # ignore the warnings; DateTime is a datetime.datetime (compatible) instance
                 changed_at=changed_at,
                 expires_at=expires_at,
                 duration=duration,
                 mode=request.mode.get_id(),
-                price=get_energy_values(changed_at, changed_at, limit=1, shelve_db=self.shelve_db)[0].price,
+                price=get_energy_values(changed_at, changed_at, limit=1, attack_store=self.attack_store)[0].price,
                 temperature=request.target if request.mode == HeatingModeOption.AUTO else None,
                 hidden=request.hidden
             )
@@ -369,15 +556,17 @@ class HeatingResource:
 
             # when the request is not hidden it is processed and its new status is immediately applied
             if not request.hidden:
-                heating_status = _get_heating_status(home.id, db_session, shelve_db=self.shelve_db)
+                heating_status = _get_heating_status(home.id, db_session, attack_store=self.attack_store)
                 try:
                     _set_netatmo_heating(
-                        home.label, heating_status, db_session, home.relay, self.client_id, self.client_secret
+                        home.label, heating_status, db_session, db_session.get(NetatmoDevice, home.netatmoID),
+                        self.client_id, self.client_secret, home_id=home.id, call=self.netatmo_call, engine=self.engine
                     )
                 except Timeout:
                     resp.content_type = falcon.MEDIA_TEXT
                     resp.status = falcon.HTTP_GATEWAY_TIMEOUT
                     resp.text = f"unable to set the thermostat, the request timed out"
+                    return
 
                 print("set Netatmo heating")
 
@@ -393,6 +582,16 @@ class HeatingResource:
             resp.text = f"unable to manipulate the desired Netatmo valve\n{err}"
 
 
+def valve_reading_query(netatmo_id: int) -> Select:
+    """ Select the latest valve percentage of a Netatmo device, using the ix_device_reading index. """
+    return select(
+        NetatmoReading.reading
+    ).where(
+        NetatmoReading.netatmo_id == netatmo_id, NetatmoReading.room_id == 3  # valve percentage
+    ).order_by(
+        NetatmoReading.start.desc()
+    ).limit(1)
+
 
 class ValveResource:
     def on_get(self, req: Request, resp: Response):  # noqa
@@ -409,15 +608,7 @@ class ValveResource:
                 resp.status = falcon.HTTP_BAD_REQUEST
                 return
 
-            reading = db_session.query(
-                NetatmoReading
-            ).filter(
-                NetatmoReading.netatmo_id == home.netatmoID
-            ).filter(
-                NetatmoReading.room_id == 3  # valve percentage
-            ).order_by(
-                NetatmoReading.start.desc()
-            ).first()
+            reading = db_session.execute(valve_reading_query(home.netatmoID)).scalar()
 
             if reading is None:
                 resp.content_type = falcon.MEDIA_TEXT
@@ -426,7 +617,7 @@ class ValveResource:
                 return
 
             resp.content_type = falcon.MEDIA_JSON
-            resp.text = json.dumps(ValveStatus(open=reading.reading > 0).to_dict())
+            resp.text = json.dumps(ValveStatus(open=reading > 0).to_dict())
             resp.status = falcon.HTTP_OK
 
         except DaciteError as err:
@@ -435,14 +626,95 @@ class ValveResource:
             resp.text = f"one or more of the parameters was not understood\n{err}"
 
 
+@dataclass
+class HomeOutcome:
+    """ The outcome of setting the valve of a single home during a cron run. """
+    label: str
+    error: Optional[str]  # None when the valve was set or left unchanged
+    seconds: float
+    unchanged: bool = False  # whether the valve already held the heating status, so it was not sent again
+
+
+def _control_home(home: Tuple[int, str, int], db_session: Session, attack_store: AttackStore,
+                  client_id: str, client_secret: str, command: Optional[ValveCommand], margin: int) -> HomeOutcome:
+    """
+    Calculate the heating status of a single home and set its valve accordingly.
+    :param home: The ID, label, and Netatmo device ID of the home.
+    :param db_session: The database session of the worker that controls the home.
+    :param attack_store: The store to use for pricing attacks.
+    :param client_id: The client ID to use when connecting to Netatmo.
+    :param client_secret: The client secret to use when connecting to Netatmo.
+    :param command: The last command sent to the valve of the home, if known.
+    :param margin: The number of minutes before the valve stops holding the last command that it is sent again.
+    :return: The outcome for the home; this never raises so that one home cannot hold up the others.
+    """
+    (home_id, label, netatmo_id) = home
+    started = time.monotonic()
+    try:
+        # calculate the desired temperature point
+        status = _get_heating_status(home_id, db_session, attack_store=attack_store)
+        if _is_valve_unchanged(status, command, pendulum.now(), margin):
+            return HomeOutcome(label, None, time.monotonic() - started, unchanged=True)
+        # make the Netatmo call to change the temperature
+        device = db_session.get(NetatmoDevice, netatmo_id)
+        _set_netatmo_heating(label, status, db_session, device, client_id, client_secret, home_id=home_id,
+                             engine=db_session.get_bind())
+        db_session.commit()
+        return HomeOutcome(label, None, time.monotonic() - started)
+    except Exception as err:  # noqa
+        db_session.rollback()
+        return HomeOutcome(label, str(err) or type(err).__name__, time.monotonic() - started)
+
+
+def _control_homes(homes: List[Tuple[int, str, int]], sessions: sessionmaker, workers: int, attack_store: AttackStore,
+                   client_id: str, client_secret: str, commands: Dict[int, ValveCommand], margin: int) -> List[HomeOutcome]:
+    """
+    Control the valves of several homes at the same time.
+    :param homes: The ID, label, and Netatmo device ID of each home.
+    :param sessions: The factory of the database sessions of the workers.
+    :param workers: The number of homes to control at the same time.
+    :param attack_store: The store to use for pricing attacks.
+    :param client_id: The client ID to use when connecting to Netatmo.
+    :param client_secret: The client secret to use when connecting to Netatmo.
+    :param commands: The last command sent to the valve of each home, by the ID of the home.
+    :param margin: The number of minutes before the valve stops holding the last command that it is sent again.
+    :return: The outcome for each home, in the order of the homes.
+    """
+    # every worker thread controls its homes with its own session, which are all closed at the end of the run
+    worker = threading.local()
+    worker_sessions: List[Session] = []
+
+    def control(home: Tuple[int, str, int]) -> HomeOutcome:
+        if not hasattr(worker, "session"):
+            worker.session = sessions()
+            worker_sessions.append(worker.session)
+        return _control_home(home, worker.session, attack_store, client_id, client_secret,
+                             commands.get(home[0], None), margin)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="home") as executor:
+            return list(executor.map(control, homes))
+    finally:
+        for worker_session in worker_sessions:
+            worker_session.close()
+
+
+def _summarise(outcomes: List[HomeOutcome], seconds: float, workers: int) -> str:
+    """ Summarise the outcomes of a cron run in a single line. """
+    failed = [outcome.label for outcome in outcomes if outcome.error is not None]
+    unchanged = sum(1 for outcome in outcomes if outcome.unchanged)
+    return (f"set {len(outcomes) - len(failed) - unchanged} of {len(outcomes)} valves ({unchanged} unchanged) in "
+            f"{seconds:.1f}s using {workers} worker(s)" + (f"; failed for {', '.join(failed)}" if failed else ""))
+
+
 @click.command()
 @click.option("--config", default=None, help="The TOML configuration file.")
 @click.option("--notify", default=False, is_flag=True, help="Send Pushover notifications when valves are unreachable.")
-def cli(config, notify):  # pylint: disable=invalid-name
-    db_server = ""
-    db_name = ""
-    db_username = ""
-    db_password = ""
+@click.option("--workers", default=1, type=click.IntRange(min=1), help="The number of homes to control at the same time.")
+@click.option("--hold-margin", default=15, type=click.IntRange(min=0, max=VALVE_HOLD),
+              help="Send an unchanged temperature again when the valve holds it for fewer than this many minutes.")
+def cli(config, notify, workers, hold_margin):  # pylint: disable=invalid-name
+    db_config = DBConfiguration("", "", "")
     pushover_app = ""
     pushover_user = ""
     netatmo_id = ""
@@ -457,16 +729,27 @@ def cli(config, notify):  # pylint: disable=invalid-name
             try:
                 toml = tomli.load(file)
 
-                shelve_location = toml["server"]["shelve"]
-                with shelve.open(shelve_location) as shelve_db:
-                    shelve_db["test"] = "test"
-                    del shelve_db["test"]
+                attacks = str(toml["server"].get("attacks", "shelve"))
+                shelve_location = ""
+                if attacks == "shelve":
+                    shelve_location = toml["server"]["shelve"]
+                    with shelve.open(shelve_location) as shelve_db:
+                        shelve_db["test"] = "test"
+                        del shelve_db["test"]
 
                 if toml_db := toml["database"]:
-                    db_server = str(toml_db["server"])
-                    db_name = str(toml_db["dbname"])
-                    db_username = str(toml_db["user"])
-                    db_password = str(toml_db["pass"])
+                    db_config = DBConfiguration(
+                        server=str(toml_db["server"]), username=str(toml_db["user"]), password=str(toml_db["pass"]),
+                        database=str(toml_db["dbname"]),
+                        enable_debugging=bool(toml_db.get("debug", db_config.enable_debugging)),
+                        pool_size=int(toml_db.get("pool_size", db_config.pool_size)),
+                        max_overflow=int(toml_db.get("max_overflow", db_config.max_overflow)),
+                        pool_recycle=int(toml_db.get("pool_recycle", db_config.pool_recycle)),
+                        pool_pre_ping=bool(toml_db.get("pool_pre_ping", db_config.pool_pre_ping)),
+                        statement_timeout=toml_db.get("statement_timeout", db_config.statement_timeout),
+                        pgbouncer=bool(toml_db.get("pgbouncer", db_config.pgbouncer)),
+                        driver=str(toml_db.get("driver", db_config.driver))
+                    )
                 if toml_pushover := toml["pushover"]:
                     pushover_app = str(toml_pushover["app"])
                     pushover_user = str(toml_pushover["user"])
@@ -475,10 +758,10 @@ def cli(config, notify):  # pylint: disable=invalid-name
                     netatmo_secret = str(toml_netatmo["client_secret"])
 
                 main(
-                    db_server=db_server, db_name=db_name, db_username=db_username, db_password=db_password,
-                    pushover_app=pushover_app, pushover_user=pushover_user,
+                    db_config=db_config, pushover_app=pushover_app, pushover_user=pushover_user,
                     client_id=netatmo_id, client_secret=netatmo_secret,
-                    shelve_db=shelve_location, notify=notify
+                    attacks=attacks, shelve_db=shelve_location, notify=notify, workers=workers,
+                    hold_margin=hold_margin
                 )
 
             except tomli.TOMLDecodeError:
@@ -495,9 +778,21 @@ def cli(config, notify):  # pylint: disable=invalid-name
                 sys.exit(0)
 
 
-def main(*, db_server: str, db_name: str, db_username: str, db_password: str,
-         pushover_app: str, pushover_user: str, client_id: str, client_secret: str, shelve_db: str,
-         notify: bool = False):
+def _cap_workers(workers: int, db_config: DBConfiguration) -> int:
+    """
+    Cap the number of workers to the number of connections the engine can open, as every worker holds one. One
+    connection is left for the short sessions that store rotated refresh tokens, and that read the attacks.
+    :param workers: The number of workers asked for.
+    :param db_config: The configuration of the database engine.
+    :return: The number of workers to use.
+    """
+    if db_config.pgbouncer or db_config.max_overflow < 0:
+        return workers  # the connections are not pooled, or the pool opens as many as needed
+    return min(workers, max(1, db_config.pool_size + db_config.max_overflow - 1))
+
+
+def main(*, db_config: DBConfiguration, pushover_app: str, pushover_user: str, client_id: str, client_secret: str, shelve_db: str,
+         attacks: str = "shelve", notify: bool = False, workers: int = 1, hold_margin: int = 15):
 
     pushover = Pushover(pushover_app)
 
@@ -506,31 +801,202 @@ def main(*, db_server: str, db_name: str, db_username: str, db_password: str,
             print("sending Pushover message")
             pushover.send_message(pushover_user, message, title=title)
 
+    if (capped := _cap_workers(workers, db_config)) != workers:
+        print(f"using {capped} workers instead of {workers}, to stay within the connections of the database pool")
+        workers = capped
+
     # connect to the database
-    with db_engine_manager(DBConfiguration(db_server, db_username, db_password, db_name)) as db_engine:
+    with db_engine_manager(db_config) as db_engine:
+        attack_store = AttackCache(create_attack_store(attacks, shelve_db, db_engine))
         with db_session_manager(db_engine) as session:
             # fetch all active homes
-            home_alias = aliased(Home)
-            homes = session.query(
-                Home
-            ).outerjoin(
-                home_alias, and_(Home.label == home_alias.label, Home.revision < home_alias.revision)
-            ).filter(
-                home_alias.revision == None  # noqa: E711
+            homes: List[Tuple[int, str, int]] = session.execute(
+                current_homes().with_only_columns(Home.id, Home.label, Home.netatmoID)
             ).all()
 
-            for home in homes:
-                # calculate the desired temperature point
-                status = _get_heating_status(home.id, session, shelve_db=shelve_db)
-                # make the Netatmo call to change the temperature
-                try:
-                    _set_netatmo_heating(home.label, status, session, home.relay, client_id, client_secret)
-                    print(f"set the Netatmo valve for the property with the label {home.label}")
-                except Exception as _err:  # noqa
-                    if not notify:
-                        print(f"Failed to set Netatmo valve for the property with label {home.label} due to {_err}.")
-                        continue
-                    send_message(f"Failed to set Netatmo valve for the property with label {home.label} due to {_err}.")
+            # the last command sent to each valve, including those sent in earlier runs
+            commands = {command.home_id: command for command in session.query(
+                ValveCommand.home_id, ValveCommand.mode, ValveCommand.temperature, ValveCommand.hold_until
+            )}
+
+        started = time.monotonic()
+        outcomes = _control_homes(homes, sessionmaker(db_engine), workers, attack_store, client_id, client_secret,
+                                  commands, hold_margin)
+
+        for outcome in outcomes:
+            if outcome.unchanged:
+                print(f"the Netatmo valve for the property with the label {outcome.label} is unchanged")
+                continue
+            if outcome.error is None:
+                print(f"set the Netatmo valve for the property with the label {outcome.label} ({outcome.seconds:.2f}s)")
+                continue
+            message = f"Failed to set Netatmo valve for the property with label {outcome.label} due to {outcome.error}."
+            if not notify:
+                print(message)
+                continue
+            send_message(message)
+
+        print(_summarise(outcomes, time.monotonic() - started, workers))
+
+
+class HeatingTests(unittest.TestCase):
+    """
+    Tests to ensure that the cron only sends the commands it needs to, and that one home cannot hold up the others.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def testValveUnchanged(self):
+        now = pendulum.now()
+        status = HeatingStatus(HeatingModeOption.AUTO, 20.5, None)
+        command = ValveCommand(home_id=1, mode=HeatingModeOption.AUTO.value, temperature=20.5, hold_until=now.add(minutes=60))
+        self.assertTrue(_is_valve_unchanged(status, command, now, 15))
+        self.assertFalse(_is_valve_unchanged(status, None, now, 15))
+        self.assertFalse(_is_valve_unchanged(status, command, now.add(minutes=50), 15), "the hold is about to end")
+        self.assertFalse(_is_valve_unchanged(HeatingStatus(HeatingModeOption.AUTO, 21, None), command, now, 15))
+        self.assertFalse(_is_valve_unchanged(HeatingStatus(HeatingModeOption.OVERRIDE, 20.5, None), command, now, 15))
+
+        off = ValveCommand(home_id=1, mode=HeatingModeOption.OFF.value, temperature=None, hold_until=now.add(minutes=60))
+        self.assertTrue(_is_valve_unchanged(HeatingStatus(HeatingModeOption.OFF, 6, None), off, now, 15))
+
+    def testControlHomes(self):
+        engine = create_engine("sqlite://", future=True, poolclass=StaticPool, connect_args={"check_same_thread": False})
+        Base.metadata.create_all(engine, tables=[NetatmoDevice.__table__, Home.__table__, Log.__table__, ValveCommand.__table__])
+        with engine.begin() as connection:
+            connection.execute(NetatmoDevice.__table__.insert(), [{"id": index, "refreshtoken": f"token{index}"} for index in range(1, 4)])
+
+        def get_status(home_id: int, db_session: Session, attack_store: AttackStore) -> HeatingStatus:  # noqa
+            if home_id == 2:
+                raise MissingScheduleError
+            return HeatingStatus(HeatingModeOption.AUTO, 20 if home_id == 1 else 19, None)
+
+        sent = []
+
+        class Client:
+            def __init__(self, refresh_token: str):
+                self.refresh_token = refresh_token
+
+            def set_device(self, **kwargs):
+                sent.append((self.refresh_token, kwargs["temperature"]))
+
+        homes = [(1, "home1", 1), (2, "home2", 2), (3, "home3", 3)]
+        commands = {3: ValveCommand(home_id=3, mode=HeatingModeOption.AUTO.value, temperature=19,
+                                    hold_until=pendulum.now().add(minutes=VALVE_HOLD))}
+        with mock.patch(f"{__name__}._get_heating_status", get_status), \
+                mock.patch(f"{__name__}._get_client_pool", lambda client_id, client_secret, engine: NetatmoClientPool(Client)):
+            outcomes = _control_homes(homes, sessionmaker(engine), 3, None, "", "", commands, 15)
+
+        self.assertEqual([outcome.label for outcome in outcomes], ["home1", "home2", "home3"])
+        self.assertEqual([outcome.error for outcome in outcomes], [None, "MissingScheduleError", None])
+        self.assertEqual([outcome.unchanged for outcome in outcomes], [False, False, True])
+        self.assertEqual(sent, [("token1", 20)])
+        with Session(engine) as session:
+            self.assertEqual([(command.home_id, command.temperature) for command in session.query(ValveCommand)], [(1, 20)])
+
+        self.assertEqual(_summarise(outcomes, 1.25, 3), "set 1 of 3 valves (1 unchanged) in 1.2s using 3 worker(s); failed for home2")
+        self.assertEqual(_summarise(outcomes[:1], 0.5, 1), "set 1 of 1 valves (0 unchanged) in 0.5s using 1 worker(s)")
+
+    def testTimeoutRotation(self):
+        from chai_api.asgi import in_thread  # pylint: disable=import-outside-toplevel
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        engine = create_engine(f"sqlite:///{os.path.join(directory.name, 'tokens.db')}", future=True)
+        NetatmoDevice.__table__.create(engine)
+        with engine.begin() as connection:
+            connection.execute(NetatmoDevice.__table__.insert().values(id=1, refreshtoken="first"))
+
+        class SlowClient:
+            made = 0
+
+            def __init__(self, client_id: str, client_secret: str, refresh_token: str):  # noqa
+                SlowClient.made += 1
+                self.refresh_token = refresh_token
+
+            def set_device(self, **kwargs):  # noqa
+                time.sleep(0.3)
+                self.refresh_token = "second"  # Netatmo rotated the token while refreshing the access token
+
+        _get_client_pool.cache_clear()
+        try:
+            with mock.patch(f"{__name__}.NetatmoClient", SlowClient), Session(engine) as session:
+                device = session.get(NetatmoDevice, 1)
+                status = HeatingStatus(HeatingModeOption.AUTO, 20, None)
+                with self.assertRaises(Timeout):
+                    asyncio.run(greenlet_spawn(lambda: _set_netatmo_heating(
+                        "home", status, session, device, "", "", call=in_thread(0.05), engine=engine
+                    )))
+
+                # the call finished after it was given up on, and its rotated token was stored nonetheless
+                with Session(engine) as other:
+                    self.assertEqual(other.get(NetatmoDevice, 1).refreshToken, "second")
+                for token in ("first", "second"):
+                    with _get_client_pool("", "", engine).client(NetatmoDevice(id=1, refreshToken=token)) as client:
+                        self.assertEqual(client.refresh_token, "second")
+                self.assertEqual(SlowClient.made, 1)
+        finally:
+            _get_client_pool.cache_clear()
+            engine.dispose()
+            directory.cleanup()
+
+    def testInvalidSchedule(self):
+        now = pendulum.now()
+        price = ElectricityPrice(now, now.add(minutes=30), 0.25)
+        snapshot = HeatingSnapshot(now, None, None, None, 1, now, {"0": 1, "96": 2}, [], 50.0, 19.5)
+        resp = Response()
+        with mock.patch(f"{__name__}.get_energy_values", lambda *args, **kwargs: [price]):
+            HeatingResource("", "", None)._respond_with_status(resp, 1, snapshot)  # pylint: disable=protected-access
+        self.assertEqual((resp.status, resp.content_type), (falcon.HTTP_BAD_REQUEST, falcon.MEDIA_TEXT))
+        self.assertIn("slot 96", resp.text)
+
+    def testCapWorkers(self):
+        self.assertEqual(_cap_workers(8, DBConfiguration("", "", "")), 8)
+        self.assertEqual(_cap_workers(20, DBConfiguration("", "", "", pool_size=5, max_overflow=10)), 14)
+        self.assertEqual(_cap_workers(20, DBConfiguration("", "", "", pool_size=1, max_overflow=0)), 1)
+        self.assertEqual(_cap_workers(20, DBConfiguration("", "", "", pool_size=5, max_overflow=-1)), 20)
+        self.assertEqual(_cap_workers(20, DBConfiguration("", "", "", pgbouncer=True)), 20)
+
+    @unittest.skipIf(TEST_DATABASE is None, "set CHAI_TEST_DATABASE to user:password@server/database to test the snapshot")
+    def testSnapshot(self):
+        engine = db_engine(configuration_for_tests("pg8000"))
+        with engine.connect() as connection:
+            with connection.begin() as transaction:
+                create_tables_for_tests(connection)
+                now = pendulum.now("UTC")
+                connection.execute(SetpointChange.__table__.insert(), [
+                    {"id": 2, "homeid": 1, "changedat": now, "expiresat": now.add(hours=1), "duration": 60, "mode": 2,
+                     "temperature": None, "price": 12.3, "hidden": True},
+                    {"id": 3, "homeid": 1, "changedat": now, "expiresat": now.subtract(hours=1), "duration": 60, "mode": 3,
+                     "temperature": None, "price": 12.3, "hidden": False},
+                ])
+                session = Session(bind=connection)
+                snapshot = _get_heating_snapshot(1, session)
+
+                # the queries that the snapshot replaces, one for each part of the state of the home
+                setpoint = session.query(SetpointChange).filter(
+                    SetpointChange.hidden.is_(False), SetpointChange.home_id == 1,
+                    SetpointChange.expires_at > func.current_timestamp()
+                ).order_by(SetpointChange.id.desc()).first()
+                later = aliased(Schedule)
+                schedule = session.query(Schedule).outerjoin(later, and_(
+                    Schedule.home_id == later.home_id, Schedule.revision < later.revision, Schedule.day == later.day
+                )).filter(
+                    later.revision == None, Schedule.home_id == 1, Schedule.day == snapshot.daymask  # noqa: E711
+                ).first()
+                latest = select(func.max(Profile.id)).where(Profile.home_id == 1).group_by(Profile.profile_id)
+                profiles = session.query(Profile).filter(Profile.id.in_(latest)).all()
+                readings = [session.query(NetatmoReading.reading).filter(
+                    NetatmoReading.netatmo_id == 1, NetatmoReading.room_id == room_id
+                ).order_by(NetatmoReading.start.desc()).limit(1).scalar() for room_id in (3, 2)]
+
+                self.assertEqual((snapshot.setpoint_mode, snapshot.setpoint_temperature, snapshot.setpoint_expires_at),
+                                 (setpoint.mode, setpoint.temperature, setpoint.expires_at))
+                self.assertEqual((snapshot.schedule_revision, snapshot.schedule), (schedule.revision, schedule.schedule))
+                self.assertEqual(sorted((profile.profile_id, profile.mean1, profile.mean2) for profile in snapshot.profiles),
+                                 sorted((profile.profile_id, profile.mean1, profile.mean2) for profile in profiles))
+                self.assertEqual([snapshot.valve_percentage, snapshot.valve_temperature], readings)
+
+                session.close()
+                transaction.rollback()
+        engine.dispose()
 
 
 if __name__ == "__main__":
@@ -2,21 +2,167 @@
 # pylint: disable=no-member, c-extension-no-member, too-few-public-methods
 # pylint: disable=missing-class-docstring, missing-function-docstring
 
+import base64
+import binascii
+import math
+import re
+from datetime import datetime
+from typing import Iterator, List, Dict, Any, Optional, Tuple
+
 import falcon
+import pendulum
 import ujson as json
 from dacite import from_dict, DaciteError, Config
 from falcon import Request, Response
 from pendulum import DateTime, parse
+from sqlalchemy import select, func, or_, tuple_
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
 
 from chai_api.db_definitions import NetatmoReading, get_home
-from chai_api.expected import HistoryGet, HistoryOption
+from chai_api.downsampling import lttb
+from chai_api.expected import HistoryGet, HistoryOption, HistoryDownsample, HistoryFormat
+
+# the number of seconds in each unit of a resolution
+RESOLUTION_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+# the number of readings fetched and encoded together when streaming
+CHUNK_SIZE = 1000
+
+MEDIA_NDJSON = "application/x-ndjson"
+
+# the number of buckets per point from which the lowest and highest readings are downsampled with LTTB
+LTTB_BUCKETS_PER_POINT = 2
+
+
+def _parse_resolution(resolution: str) -> int:
+    """
+    Parse a resolution such as 15m, 1h, or 1d.
+    :param resolution: The resolution to parse.
+    :return: The resolution in seconds.
+    """
+    match = re.fullmatch(r"(\d+)([mhd])", resolution.strip())
+    if match is None or int(match[1]) == 0:
+        raise ValueError(f"the resolution '{resolution}' should be a positive number followed by m, h, or d, e.g. 15m")
+    return int(match[1]) * RESOLUTION_UNITS[match[2]]
+
+
+def _bucket_seconds(start: DateTime, end: Optional[DateTime], buckets: int, minimum: int = 60) -> int:
+    """
+    The width of the buckets that divide a range into at most the given number of buckets, in whole minutes.
+    :param start: The start of the range.
+    :param end: The end of the range, or None for now.
+    :param buckets: The maximum number of buckets.
+    :param minimum: The minimum width of the buckets in seconds.
+    :return: The width of the buckets in seconds.
+    """
+    end = pendulum.now() if end is None else end
+    span = max(0, end.int_timestamp - start.int_timestamp)
+    return max(minimum, math.ceil(span / buckets / 60) * 60)
+
+
+def _bucket(start: DateTime, seconds: int):
+    """ The index of the bucket of each reading, counting buckets of the given width from the start of the range. """
+    return func.floor((func.extract("epoch", NetatmoReading.start) - start.int_timestamp) / seconds).label("bucket")
+
+
+def reading_conditions(netatmo_id: int, room_id: int, start: DateTime, end: Optional[DateTime] = None) -> List[Any]:
+    """
+    The conditions that select the readings of a room of a device within a range, using the ix_device_reading index.
+    :param netatmo_id: The ID of the Netatmo device.
+    :param room_id: The room of the readings, 2 for the valve temperature and 3 for the valve percentage.
+    :param start: The start of the range (inclusive).
+    :param end: The end of the range (inclusive), or None for no end.
+    :return: The conditions to select the readings with.
+    """
+    conditions = [NetatmoReading.netatmo_id == netatmo_id, NetatmoReading.room_id == room_id, NetatmoReading.start >= start]
+    if end is not None:
+        conditions.append(NetatmoReading.end <= end)
+    return conditions
+
+
+def readings_query(netatmo_id: int, room_id: int, start: DateTime, end: Optional[DateTime] = None) -> Select:
+    """ Select the start and value of the readings of a room of a device within a range, in order. """
+    return select(
+        NetatmoReading.start, NetatmoReading.reading
+    ).where(
+        *reading_conditions(netatmo_id, room_id, start, end)
+    ).order_by(
+        NetatmoReading.start, NetatmoReading.id
+    )
+
+
+def _encode_cursor(start: datetime, reading_id: int) -> str:
+    """ Encode the position after a reading as an opaque cursor. """
+    return base64.urlsafe_b64encode(f"{start.isoformat()}|{reading_id}".encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> Tuple[DateTime, int]:
+    """ Decode a cursor into the start and ID of the last reading of the previous page. """
+    try:
+        (start, reading_id) = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return parse(start), int(reading_id)
+    except (binascii.Error, UnicodeError, ValueError) as err:
+        raise ValueError(f"the cursor '{cursor}' is not valid") from err
+
+
+def _encode(entries: List[Dict[str, Any]], ndjson: bool) -> bytes:
+    """ Encode readings as the items of a JSON list (without the brackets) or as JSON lines. """
+    if ndjson:
+        return "".join(f"{json.dumps(entry)}\n" for entry in entries).encode("utf-8")
+    return json.dumps(entries)[1:-1].encode("utf-8")
+
+
+def _stream(engine: Engine, query: Select, ndjson: bool) -> Iterator[bytes]:
+    """
+    Stream readings with a server-side cursor, so that only a chunk of readings is held in memory at any time.
+    The readings are fetched on a connection of their own, as the session of the request is closed before the
+    response is sent.
+    :param engine: The database engine to connect with.
+    :param query: The query selecting the start and reading of each reading, in order.
+    :param ndjson: Whether to stream JSON lines instead of a JSON list.
+    :return: The chunks of the response.
+    """
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, max_row_buffer=CHUNK_SIZE).execute(query)
+        if not ndjson:
+            yield b"["
+        first = True
+        for rows in result.partitions(CHUNK_SIZE):
+            encoded = _encode([{"timestamp": start.isoformat(), "value": reading} for (start, reading) in rows], ndjson)
+            yield encoded if first or ndjson else b"," + encoded
+            first = False
+        if not ndjson:
+            yield b"]"
 
 
 class HistoryResource:
     def on_get(self, req: Request, resp: Response):  # noqa
         try:
-            request: HistoryGet = from_dict(HistoryGet, req.params,
-                                            config=Config({DateTime: parse}, cast=[HistoryOption]))
+            request: HistoryGet = from_dict(HistoryGet, req.params, config=Config(
+                {DateTime: parse}, cast=[HistoryOption, HistoryDownsample, HistoryFormat, int]
+            ))
+
+            if request.max_points is not None and request.max_points < 1:
+                resp.content_type = falcon.MEDIA_TEXT
+                resp.status = falcon.HTTP_BAD_REQUEST
+                resp.text = "the maximum number of points should be 1 or more"
+                return
+            if request.downsample == HistoryDownsample.LTTB and request.max_points is None:
+                resp.content_type = falcon.MEDIA_TEXT
+                resp.status = falcon.HTTP_BAD_REQUEST
+                resp.text = "the maximum number of points is required to downsample with lttb"
+                return
+            if request.limit is not None and request.limit < 1:
+                resp.content_type = falcon.MEDIA_TEXT
+                resp.status = falcon.HTTP_BAD_REQUEST
+                resp.text = "the limit should be 1 or more"
+                return
+            if request.cursor is not None and request.limit is None:
+                resp.content_type = falcon.MEDIA_TEXT
+                resp.status = falcon.HTTP_BAD_REQUEST
+                resp.text = "a cursor can only be used together with a limit"
+                return
 
             db_session = req.context.session
 
@@ -29,26 +175,64 @@ class HistoryResource:
                 resp.status = falcon.HTTP_BAD_REQUEST
                 return
 
-            query = db_session.query(
-                NetatmoReading
-            ).filter(
-                NetatmoReading.netatmo_id == home.netatmoID
-            ).filter(
-                NetatmoReading.room_id == (2 if request.source == HistoryOption.TEMPERATURE else 3)
-            ).filter(
-                NetatmoReading.start >= request.start
-            )
+            room_id = 2 if request.source == HistoryOption.TEMPERATURE else 3
+            conditions = reading_conditions(home.netatmoID, room_id, request.start, request.end)
 
-            if request.end is not None:
-                query = query.filter(NetatmoReading.end <= request.end)
+            ndjson = request.format == HistoryFormat.NDJSON
+            resp.content_type = MEDIA_NDJSON if ndjson else falcon.MEDIA_JSON
+            resp.status = falcon.HTTP_OK
 
-            result: [NetatmoReading] = query.all()
+            if request.downsample == HistoryDownsample.LTTB:
+                # only the lowest and highest reading of a few buckets per point are fetched, however long the range
+                # is, which keeps the peaks and troughs that LTTB would select
+                seconds = _bucket_seconds(request.start, request.end, LTTB_BUCKETS_PER_POINT * request.max_points)
+                bucket = _bucket(request.start, seconds)
+                ranked = select(
+                    NetatmoReading.start, NetatmoReading.reading,
+                    func.row_number().over(partition_by=bucket, order_by=(NetatmoReading.reading, NetatmoReading.start)).label("low"),
+                    func.row_number().over(partition_by=bucket, order_by=(NetatmoReading.reading.desc(), NetatmoReading.start)).label("high")
+                ).where(*conditions).subquery("ranked")
+                rows = db_session.execute(
+                    select(ranked.c.start, ranked.c.reading).where(
+                        or_(ranked.c.low == 1, ranked.c.high == 1)
+                    ).order_by(ranked.c.start)
+                ).all()
+                selected = lttb([row[0].timestamp() for row in rows], [row[1] for row in rows], request.max_points)
+                response = [{"timestamp": rows[index][0].isoformat(), "value": rows[index][1]} for index in selected]
+            elif request.resolution is not None or request.max_points is not None:
+                # the buckets start at the start of the interval, so there are never more than max_points buckets
+                seconds = 60 if request.resolution is None else _parse_resolution(request.resolution)
+                if request.max_points is not None:
+                    seconds = _bucket_seconds(request.start, request.end, request.max_points, seconds)
 
-            response = [{"timestamp": entry.start.isoformat(), "value": entry.reading} for entry in result]
+                bucket = _bucket(request.start, seconds)
+                rows = db_session.execute(
+                    select(
+                        bucket, func.min(NetatmoReading.reading), func.avg(NetatmoReading.reading),
+                        func.max(NetatmoReading.reading)
+                    ).where(*conditions).group_by(bucket).order_by(bucket)
+                ).all()
+                response = [{
+                    "timestamp": request.start.add(seconds=int(index) * seconds).isoformat(),
+                    "value": mean, "min": minimum, "max": maximum
+                } for (index, minimum, mean, maximum) in rows]
+            elif request.limit is not None:
+                # a page of readings, continuing after the last reading of the previous page
+                if request.cursor is not None:
+                    conditions.append(tuple_(NetatmoReading.start, NetatmoReading.id) > _decode_cursor(request.cursor))
+                rows = db_session.execute(
+                    select(
+                        NetatmoReading.start, NetatmoReading.reading, NetatmoReading.id
+                    ).where(*conditions).order_by(NetatmoReading.start, NetatmoReading.id).limit(request.limit)
+                ).all()
+                if len(rows) == request.limit:
+                    resp.set_header("X-Next-Cursor", _encode_cursor(rows[-1][0], rows[-1][2]))
+                response = [{"timestamp": start.isoformat(), "value": reading} for (start, reading, _) in rows]
+            else:
+                resp.stream = _stream(db_session.get_bind(), readings_query(home.netatmoID, room_id, request.start, request.end), ndjson)
+                return
 
-            resp.content_type = falcon.MEDIA_JSON
-            resp.text = json.dumps(response)
-            resp.status = falcon.HTTP_OK
+            resp.data = _encode(response, ndjson) if ndjson else b"[" + _encode(response, ndjson) + b"]"
         except DaciteError as err:
             resp.content_type = falcon.MEDIA_TEXT
             resp.status = falcon.HTTP_BAD_REQUEST
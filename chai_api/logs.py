@@ -7,12 +7,30 @@ import ujson as json
 from dacite import from_dict, DaciteError, Config
 from falcon import Request, Response
 from pendulum import DateTime, parse
+from sqlalchemy import select
+from sqlalchemy.sql import Select
 
 from chai_api.db_definitions import Log, get_home
 from chai_api.expected import LogsGet, LogsPut
 from chai_api.responses import LogEntry
 
 
+def logs_query(home_id: int) -> Select:
+    """
+    Select the log entries of a home, newest first, using the ix_home_log index.
+    Only the columns that are returned are selected, so no Log entities are built.
+    :param home_id: The ID of the home.
+    :return: A statement that selects the timestamp, category, and parameters of each entry.
+    """
+    return select(
+        Log.timestamp, Log.category, Log.parameters
+    ).where(
+        Log.home_id == home_id
+    ).order_by(
+        Log.timestamp.desc()
+    )
+
+
 class LogsResource:
     def on_get(self, req: Request, resp: Response):  # noqa
         try:
@@ -29,33 +47,25 @@ class LogsResource:
                 resp.status = falcon.HTTP_BAD_REQUEST
                 return
 
-            query = db_session.query(
-                Log
-            ).filter(
-                Log.home_id == home.id
-            ).order_by(
-                Log.timestamp.desc()
-            )
+            query = logs_query(home.id)
 
             if request.start is not None:
-                query = query.filter(Log.timestamp >= request.start)
+                query = query.where(Log.timestamp >= request.start)
 
             if request.category is not None:
                 if "," in request.category:
                     categories = [category.strip() for category in request.category.split(",")]
-                    query = query.filter(Log.category.in_(categories))
+                    query = query.where(Log.category.in_(categories))
                 else:
-                    query = query.filter(Log.category == request.category)
+                    query = query.where(Log.category == request.category)
 
             if request.end is not None:
-                query = query.filter(Log.timestamp < request.end)
+                query = query.where(Log.timestamp < request.end)
 
             query = query.offset(request.skip)
             query = query.limit(request.limit)
 
-            result: [Log] = query.all()
-
-            response = [LogEntry(result.timestamp, result.category, result.parameters) for result in result]
+            response = [LogEntry(timestamp, category, parameters) for (timestamp, category, parameters) in db_session.execute(query)]
 
             resp.content_type = falcon.MEDIA_JSON
             resp.text = json.dumps([entry.to_dict() for entry in response])
@@ -81,7 +91,7 @@ class LogsResource:
                 return
 
             db_session.add(Log(
-                home=home, timestamp=request.timestamp,
+                home_id=home.id, timestamp=request.timestamp,
                 category=request.category, parameters=request.parameters
             ))
             db_session.commit()
@@ -8,7 +8,7 @@ import json
 import os
 import shelve
 import sys
-from typing import Optional, List
+from typing import Dict, Optional, List
 
 import click
 import falcon
@@ -27,14 +27,20 @@ except (ImportError, ModuleNotFoundError):
     def run_server(app: App, host: str, port: int):  # pylint: disable=missing-function-docstring
         HTTPServer((host, port), app).start()
 
+from chai_api import metrics, schedule_index
 from chai_api.attack import AttackResource
-from chai_api.db_definitions import db_engine, Configuration as DBConfiguration
+from chai_api.attack_cache import AttackCache
+from chai_api.attack_store import create_attack_store
+from chai_api.db_definitions import db_engine, db_async_engine, home_cache, Configuration as DBConfiguration, PoolMetrics
 from chai_api.heating import HeatingResource, ValveResource
 from chai_api.history import HistoryResource
 from chai_api.logs import LogsResource
+from chai_api.metrics import MetricsResource
 from chai_api.prices import PriceResource
+from chai_api.readings import ReadingsResource
 from chai_api.schedule import ScheduleResource
 from chai_api.profile import ProfileResource
+from chai_api.utilities import TTLCache
 from chai_api.xai import XAIRegionResource, XAIBandResource, XAIScatterResource, ConfigurationProfile
 from chai_api.xai import ProfileResetResource
 
@@ -54,6 +60,7 @@ class Configuration:  # pylint: disable=too-few-public-methods, too-many-instanc
     port: int = 8080
     bearer: Optional[str] = None  # when None this value should be ignored, a.k.a. open access
     shelve: str = ""
+    attack_store: str = "shelve"  # either "shelve" or "database"
     db_server: str = "127.0.0.1"
     db_name: str = "chai"
     db_username: str = ""
@@ -64,6 +71,15 @@ class Configuration:  # pylint: disable=too-few-public-methods, too-many-instanc
     netatmo_secret: str = ""
     api_debug: bool = False
     db_debug: bool = False
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    db_statement_timeout: Optional[int] = None
+    db_pgbouncer: bool = False
+    db_driver: str = "pg8000"
+    db_async_driver: str = "asyncpg"
+    asgi: bool = False
     profiles: List[ConfigurationProfile] = []
 
     def __str__(self):
@@ -90,7 +106,8 @@ class Sink:  # pylint: disable=missing-class-docstring, missing-function-docstri
 @click.option("--username", default=None, help="The username to access the database.")
 @click.option("--dbpass_file", default=None, help="The file containing the (single line) password for database access.")
 @click.option('--debug', is_flag=True, help="Provides debug output for the API server and the database when present.")
-def cli(config, host, port, bearer_file, dbserver, db, username, dbpass_file, debug):  # pylint: disable=invalid-name
+@click.option('--asgi', is_flag=True, help="Serve the API asynchronously with uvicorn, instead of with a WSGI server.")
+def cli(config, host, port, bearer_file, dbserver, db, username, dbpass_file, debug, asgi):  # pylint: disable=invalid-name
     settings = Configuration()
 
     if config and not os.path.isfile(config):
@@ -110,23 +127,38 @@ def cli(config, host, port, bearer_file, dbserver, db, username, dbpass_file, de
                     settings.host = str(toml_server.get("host", settings.host))
                     settings.port = int(toml_server.get("port", settings.port))
                     settings.bearer = toml_server.get("bearer", settings.bearer)
-                    settings.shelve = toml_server["shelve"]
-
-                    try:
-                        with shelve.open(settings.shelve) as shelve_db:
-                            shelve_db["test"] = "test"
-                            del shelve_db["test"]
-                    except Exception as err:
-                        click.echo(f"Unable to open and write to the shelve file: {err}")
+                    settings.attack_store = str(toml_server.get("attacks", settings.attack_store))
+
+                    if settings.attack_store == "shelve":
+                        settings.shelve = toml_server["shelve"]
+
+                        try:
+                            with shelve.open(settings.shelve) as shelve_db:
+                                shelve_db["test"] = "test"
+                                del shelve_db["test"]
+                        except Exception as err:
+                            click.echo(f"Unable to open and write to the shelve file: {err}")
+                            sys.exit(0)
+                    elif settings.attack_store != "database":
+                        click.echo(f"Unknown attack store '{settings.attack_store}', use 'shelve' or 'database'.")
                         sys.exit(0)
 
                     settings.api_debug = bool(toml_server.get("debug", settings.api_debug))
+                    settings.asgi = bool(toml_server.get("asgi", settings.asgi))
                 if toml_db := toml["database"]:
                     settings.db_server = str(toml_db.get("server", settings.db_server))
                     settings.db_name = str(toml_db.get("dbname", settings.db_name))
                     settings.db_username = str(toml_db.get("user", settings.db_username))
                     settings.db_password = str(toml_db.get("pass", settings.db_password))
                     settings.db_debug = bool(toml_db.get("debug", settings.db_debug))
+                    settings.db_pool_size = int(toml_db.get("pool_size", settings.db_pool_size))
+                    settings.db_max_overflow = int(toml_db.get("max_overflow", settings.db_max_overflow))
+                    settings.db_pool_recycle = int(toml_db.get("pool_recycle", settings.db_pool_recycle))
+                    settings.db_pool_pre_ping = bool(toml_db.get("pool_pre_ping", settings.db_pool_pre_ping))
+                    settings.db_statement_timeout = toml_db.get("statement_timeout", settings.db_statement_timeout)
+                    settings.db_pgbouncer = bool(toml_db.get("pgbouncer", settings.db_pgbouncer))
+                    settings.db_driver = str(toml_db.get("driver", settings.db_driver))
+                    settings.db_async_driver = str(toml_db.get("async_driver", settings.db_async_driver))
                 if toml_pushover := toml["pushover"]:
                     settings.pushover_app = str(toml_pushover.get("app", settings.pushover_app))
                     settings.pushover_user = str(toml_pushover.get("user", settings.pushover_user))
@@ -211,6 +243,9 @@ def cli(config, host, port, bearer_file, dbserver, db, username, dbpass_file, de
         settings.api_debug = True
         settings.db_debug = True
 
+    if asgi is True:
+        settings.asgi = True
+
     main(settings)
 
 
@@ -279,26 +314,57 @@ def main(settings: Configuration):
     #  create the database session middleware
     db_config = DBConfiguration(username=settings.db_username, password=settings.db_password,
                                 server=settings.db_server, database=settings.db_name,
-                                enable_debugging=settings.db_debug)
-    engine = db_engine(db_config)
+                                enable_debugging=settings.db_debug, pool_size=settings.db_pool_size,
+                                max_overflow=settings.db_max_overflow, pool_recycle=settings.db_pool_recycle,
+                                pool_pre_ping=settings.db_pool_pre_ping,
+                                statement_timeout=settings.db_statement_timeout, pgbouncer=settings.db_pgbouncer,
+                                driver=settings.db_driver)
+    try:
+        engine = db_engine(db_config)
+    except (ValueError, ImportError) as err:
+        click.echo(f"Unable to use the database driver '{settings.db_driver}': {err}")
+        sys.exit(0)
+    metrics.register("db_pool", PoolMetrics(engine).stats)
     session_middleware = SessionManager(engine).middleware
 
+    #  keep the price attacks in memory, whichever store they are kept in
+    attack_store = AttackCache(create_attack_store(settings.attack_store, settings.shelve, engine))
+    metrics.register("attack_cache", attack_store.stats)
+
+    #  keep the encoded responses of the most requested price ranges, such as the next 24 hours
+    price_cache = TTLCache(maxsize=256, ttl=1800)
+    metrics.register("price_cache", price_cache.stats)
+    metrics.register("schedule_index", schedule_index.stats)
+    metrics.register("home_cache", home_cache.stats)
+
+    # create the resource instances, served by either app
+    resources = {
+        "/heating/mode/": HeatingResource(settings.netatmo_id, settings.netatmo_secret, attack_store, engine),
+        "/heating/valve/": ValveResource(),
+        "/heating/profile/": ProfileResource(),
+        "/heating/historic/": HistoryResource(),
+        "/heating/readings/": ReadingsResource(),
+        "/electricity/prices/": PriceResource(attack_store, price_cache),
+        "/xai/region/": XAIRegionResource(settings.profiles),
+        "/xai/band/": XAIBandResource(settings.profiles),
+        "/xai/scatter/": XAIScatterResource(settings.profiles),
+        "/logs/": LogsResource(),
+        "/schedule/": ScheduleResource(),
+        "/profile/reset/": ProfileResetResource(settings.profiles),
+        "/attack/": AttackResource(attack_store),
+        "/metrics/": MetricsResource(),
+    }
+
+    if settings.asgi:
+        run_asgi(settings, db_config, resources, auth_middleware if bearer is not None else None)
+        return
+
     # instantiate a callable WSGI app
     app = falcon.App(middleware=[auth_middleware, session_middleware] if bearer is not None else [session_middleware])
 
     # create routes to resource instances
-    app.add_route("/heating/mode/", HeatingResource(settings.netatmo_id, settings.netatmo_secret, settings.shelve))
-    app.add_route("/heating/valve/", ValveResource())
-    app.add_route("/heating/profile/", ProfileResource())
-    app.add_route("/heating/historic/", HistoryResource())
-    app.add_route("/electricity/prices/", PriceResource(settings.shelve))
-    app.add_route("/xai/region/", XAIRegionResource(settings.profiles))
-    app.add_route("/xai/band/", XAIBandResource(settings.profiles))
-    app.add_route("/xai/scatter/", XAIScatterResource(settings.profiles))
-    app.add_route("/logs/", LogsResource())
-    app.add_route("/schedule/", ScheduleResource())
-    app.add_route("/profile/reset/", ProfileResetResource(settings.profiles))
-    app.add_route("/attack/", AttackResource(settings.shelve))
+    for (route, resource) in resources.items():
+        app.add_route(route, resource)
 
     app.add_error_handler(Exception, custom_response_handler)  # handle unhandled/unexpected exceptions
     app.add_sink(Sink().on_get)  # route all unknown traffic to the sink
@@ -312,5 +378,39 @@ def main(settings: Configuration):
         send_message(f"Unable to start the CHAI API server: {err}")
 
 
+def run_asgi(settings: Configuration, db_config: DBConfiguration, resources: Dict[str, object],
+             auth_middleware: Optional[FalconAuthMiddleware]):
+    """
+    Serve the resources asynchronously with uvicorn, so that slow requests, such as those waiting for Netatmo, do not
+    hold up the others.
+    :param settings: The configuration settings to use.
+    :param db_config: The database configuration, of which the asyncio driver is used for the sessions of requests.
+    :param resources: The resources to serve, keyed by their route.
+    :param auth_middleware: The token authorisation middleware to use, if any.
+    """
+    try:
+        import uvicorn  # pylint: disable=import-outside-toplevel
+        from chai_api import asgi  # pylint: disable=import-outside-toplevel
+        db_config.driver = settings.db_async_driver
+        engine = db_async_engine(db_config)
+    except (ValueError, ImportError) as err:
+        click.echo(f"Unable to serve the API asynchronously, install the asgi extra: {err}")
+        sys.exit(0)
+    metrics.register("db_pool_async", PoolMetrics(engine.sync_engine).stats)
+
+    # requests to Netatmo are made in a thread, and are given up on when Netatmo is slow to respond
+    resources["/heating/mode/"].netatmo_call = asgi.in_thread(asgi.NETATMO_TIMEOUT)
+
+    app = asgi.create_app(resources, engine, auth_middleware, custom_response_handler, Sink().on_get)
+
+    print(f"backend server running asynchronously at {settings.host}:{settings.port}")
+
+    try:
+        send_message(f"Starting the CHAI API server now.")
+        uvicorn.run(app, host=settings.host, port=int(settings.port), log_level="debug" if settings.api_debug else "info")
+    except OSError as err:
+        send_message(f"Unable to start the CHAI API server: {err}")
+
+
 if __name__ == "__main__":
     cli()
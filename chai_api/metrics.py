@@ -0,0 +1,35 @@
+# pylint: disable=line-too-long, missing-module-docstring
+# pylint: disable=no-member, c-extension-no-member, too-few-public-methods
+# pylint: disable=missing-class-docstring, missing-function-docstring
+
+from typing import Callable, Dict, Any
+
+import falcon
+import ujson as json
+from falcon import Request, Response
+
+_sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def register(name: str, source: Callable[[], Dict[str, Any]]) -> None:
+    """
+    Register a source of metrics, such as the hit and miss counters of a cache.
+    :param name: The name under which the metrics are reported; registering a name again replaces the previous source.
+    :param source: A function that returns the current metrics as a dictionary.
+    """
+    _sources[name] = source
+
+
+def collect() -> Dict[str, Dict[str, Any]]:
+    """
+    Collect the current metrics of every registered source.
+    :return: The metrics of each source, keyed by the name of the source.
+    """
+    return {name: source() for (name, source) in sorted(_sources.items())}
+
+
+class MetricsResource:
+    def on_get(self, req: Request, resp: Response):  # noqa
+        resp.content_type = falcon.MEDIA_JSON
+        resp.status = falcon.HTTP_OK
+        resp.text = json.dumps(collect())
@@ -0,0 +1,323 @@
+# pylint: disable=line-too-long, missing-module-docstring
+# pylint: disable=missing-class-docstring, missing-function-docstring
+
+import os
+import re
+import sys
+import unittest
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+import pendulum
+import tomli
+import ujson as json
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from chai_api.db_definitions import Base, Home, SchemaMigration
+from chai_api.db_definitions import Attack, ValveCommand
+from chai_api.db_definitions import db_engine_manager, current_homes, current_schedules, latest_home_query, Configuration as DBConfiguration
+from chai_api.db_definitions import CurrentHome, NetatmoReading
+from chai_api.db_definitions import TEST_DATABASE, configuration_for_tests, create_tables_for_tests, db_engine
+from chai_api.history import readings_query
+from chai_api.logs import logs_query
+from chai_api.profile import latest_profiles_query
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    statements: List[str]  # each statement runs on its own, as indexes are created concurrently outside a transaction
+
+
+# the migrations are applied in order; applied migrations should never be changed, add a new migration instead
+MIGRATIONS: List[Migration] = [
+    Migration(1, "move duplicate readings to netatmoreading_duplicates and index the readings of a device by room and start", [
+        # the duplicates are kept aside, so that they can be put back with INSERT INTO netatmoreading SELECT ...
+        "CREATE TABLE IF NOT EXISTS netatmoreading_duplicates (LIKE netatmoreading, PRIMARY KEY (id))",
+        """
+        INSERT INTO netatmoreading_duplicates
+        SELECT duplicate.* FROM netatmoreading AS duplicate
+        WHERE EXISTS (
+            SELECT FROM netatmoreading AS original
+            WHERE duplicate.netatmoid = original.netatmoid AND duplicate.roomid = original.roomid
+              AND duplicate.start = original.start AND duplicate.id > original.id
+        )
+        ON CONFLICT (id) DO NOTHING
+        """,
+        "DELETE FROM netatmoreading WHERE id IN (SELECT id FROM netatmoreading_duplicates)",
+        'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_device_reading ON netatmoreading (netatmoid, roomid, start) INCLUDE ("end", reading)',
+    ]),
+    Migration(2, "index the setpoints, schedules, profiles, and logs of a home", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_visible_setpoint ON setpointchange (homeid, expiresat) WHERE hidden IS false",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_day_schedule ON schedule (homeid, day, revision DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_latest_profile ON profile (homeid, profileid, id DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_home_log ON log (homeid, timestamp DESC, category)",
+    ]),
+    Migration(3, "index the revisions of a home by label", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_latest_home ON home (label, revision DESC)",
+    ]),
+    Migration(4, "add the tables of the price attacks and of the commands last sent to the valves", [
+        """
+        CREATE TABLE IF NOT EXISTS attack (
+            id SERIAL NOT NULL,
+            modifier FLOAT NOT NULL,
+            start TIMESTAMP WITH TIME ZONE NOT NULL,
+            "end" TIMESTAMP WITH TIME ZONE NOT NULL,
+            createdat TIMESTAMP WITH TIME ZONE NOT NULL,
+            cancelledat TIMESTAMP WITH TIME ZONE,
+            PRIMARY KEY (id)
+        )
+        """,
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_active_attack ON attack (start, "end") WHERE cancelledat IS NULL',
+        """
+        CREATE TABLE IF NOT EXISTS valvecommand (
+            homeid INTEGER NOT NULL,
+            mode VARCHAR NOT NULL,
+            temperature FLOAT,
+            sentat TIMESTAMP WITH TIME ZONE NOT NULL,
+            holduntil TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (homeid),
+            FOREIGN KEY (homeid) REFERENCES home (id)
+        )
+        """,
+    ]),
+]
+
+# the node types of a query plan that read a table through an index
+INDEX_SCANS = ("Index Scan", "Index Only Scan", "Bitmap Index Scan")
+
+
+class _Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement: Executable):
+        self.statement = statement
+
+
+@compiles(_Explain, "postgresql")
+def _compile_explain(element: _Explain, compiler, **kwargs) -> str:
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kwargs)}"
+
+
+def _drop_invalid_indexes(connection: Connection) -> List[str]:
+    """
+    Drop the indexes that were left invalid by a concurrent index build that failed, so that they are built again.
+    :param connection: A connection in autocommit mode.
+    :return: The names of the dropped indexes.
+    """
+    names = connection.execute(text(
+        "SELECT class.relname FROM pg_index AS index JOIN pg_class AS class ON class.oid = index.indexrelid "
+        "WHERE NOT index.indisvalid AND class.relname LIKE 'ix\\_%'"
+    )).scalars().all()
+    for name in names:
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+    return names
+
+
+def migrate(engine: Engine, dry_run: bool = False) -> List[Migration]:
+    """
+    Apply the migrations that have not been applied to the database yet.
+    Each statement runs in autocommit mode and can safely be run again, so a migration that failed halfway is
+    simply applied again from the start the next time.
+    :param engine: The database engine to migrate.
+    :param dry_run: Whether to only tell which migrations would be applied.
+    :return: The migrations that were (or would be) applied.
+    """
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        applied = set(connection.execute(select(SchemaMigration.version)).scalars())
+    pending = [migration for migration in MIGRATIONS if migration.version not in applied]
+    if dry_run or not pending:
+        return pending
+
+    with engine.connect() as connection:
+        # the pre-ping of a pooled pg8000 connection leaves a transaction open, in which indexes cannot be built concurrently
+        connection.connection.rollback()
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        for name in _drop_invalid_indexes(connection):
+            click.echo(f"dropped the invalid index {name}, which is built again")
+        for migration in pending:
+            click.echo(f"applying migration {migration.version}: {migration.description}")
+            for statement in migration.statements:
+                result = connection.execute(text(statement))
+                if statement.split(None, 1)[0].upper() in ("INSERT", "UPDATE", "DELETE"):
+                    click.echo(f"  {statement.split(None, 1)[0].lower()}: {result.rowcount} row(s)")
+            connection.execute(SchemaMigration.__table__.insert().values(
+                version=migration.version, description=migration.description, appliedat=pendulum.now()
+            ))
+    return pending
+
+
+def _index_scans(plan: Dict[str, Any]) -> List[str]:
+    """
+    Find the indexes used by a query plan.
+    :param plan: A node of a query plan, as given by EXPLAIN (FORMAT JSON).
+    :return: The names of the indexes scanned by the node and its children.
+    """
+    found = [plan["Index Name"]] if plan.get("Node Type", None) in INDEX_SCANS else []
+    for child in plan.get("Plans", []):
+        found += _index_scans(child)
+    return found
+
+
+def _queries(home: CurrentHome) -> Dict[str, Tuple[Executable, Tuple[str, ...]]]:
+    """
+    The hot queries of the endpoints and the heating cron for a given home, built as the endpoints build them.
+    :param home: The home to query for.
+    :return: Each query with the indexes it is expected to use, keyed by where it is used.
+    """
+    # the heating module needs the Netatmo client, which is only needed here when the queries are checked
+    from chai_api.heating import heating_snapshot_query, valve_reading_query  # pylint: disable=import-outside-toplevel
+
+    return {
+        "GET /heating/historic/": (readings_query(home.netatmoID, 2, pendulum.now().subtract(days=1)), ("ix_device_reading",)),
+        "GET /heating/valve/": (valve_reading_query(home.netatmoID), ("ix_device_reading",)),
+        "GET /heating/mode/": (heating_snapshot_query(home.id, 1), (
+            "ix_visible_setpoint", "ix_day_schedule", "ix_latest_profile", "ix_device_reading"
+        )),
+        "GET /heating/profile/": (latest_profiles_query(home.id), ("ix_latest_profile",)),
+        "GET /schedule/": (current_schedules(home.id), ("ix_day_schedule",)),
+        "GET /logs/": (logs_query(home.id).limit(50), ("ix_home_log",)),
+        "get_home": (latest_home_query(home.label), ("ix_latest_home",)),
+        "heating cron": (current_homes().with_only_columns(Home.id, Home.label, Home.netatmoID), ("ix_latest_home",)),
+    }
+
+
+def check_indexes(engine: Engine, home: CurrentHome) -> Dict[str, Tuple[List[str], List[str]]]:
+    """
+    Explain the hot queries of the endpoints to tell whether they use the indexes that were made for them.
+    Sequential scans are disabled while explaining, as the planner rightly prefers them for small tables; a query
+    that still does not use its index has no index that matches its shape.
+    :param engine: The database engine to use.
+    :param home: The home to query for.
+    :return: The names of the indexes used by each query, and of the expected indexes that it does not use.
+    """
+    checked = {}
+    with engine.connect() as connection:
+        with connection.begin():
+            connection.execute(text("SET LOCAL enable_seqscan = off"))
+            for (name, (query, expected)) in _queries(home).items():
+                plan = connection.execute(_Explain(query)).scalar()
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                used = _index_scans(plan[0]["Plan"])
+                checked[name] = (used, [index for index in expected if index not in used])
+    return checked
+
+
+def main(config: DBConfiguration, dry_run: bool, check: bool, label: Optional[str]):
+    with db_engine_manager(config) as engine:
+        pending = migrate(engine, dry_run)
+        if not pending:
+            click.echo("the database is up to date")
+        elif dry_run:
+            for migration in pending:
+                click.echo(f"migration {migration.version} is pending: {migration.description}")
+
+        if check:
+            with Session(engine) as session:
+                query = select(Home.id, Home.label, Home.netatmoID, Home.revision).order_by(Home.revision.desc()).limit(1)
+                row = session.execute(query if label is None else query.where(Home.label == label)).first()
+            if row is None:
+                click.echo("There is no home to check the queries for.")
+                sys.exit(0)
+
+            checked = check_indexes(engine, CurrentHome(*row))
+            for (name, (used, missing)) in checked.items():
+                expected = f" (expected {', '.join(missing)})" if missing else ""
+                click.echo(f"{'ok' if not missing else 'MISSING':<10}{name:<26}{', '.join(used)}{expected}")
+            if any(missing for (_, missing) in checked.values()):
+                sys.exit(1)
+
+
+@click.command()
+@click.option("--config", default=None, help="The TOML configuration file.")
+@click.option("--dry-run", is_flag=True, help="Only list the migrations that have not been applied yet.")
+@click.option("--check", is_flag=True, help="Explain the hot queries of the endpoints and check that they use an index.")
+@click.option("--label", default=None, help="The label of the home to explain the queries for, by default the latest home.")
+def cli(config, dry_run, check, label):  # pylint: disable=invalid-name
+    if not config or not os.path.isfile(config):
+        click.echo("The configuration file is not found. Please provide a valid file path.")
+        sys.exit(0)
+
+    with open(config, "rb") as file:
+        try:
+            toml = tomli.load(file)
+            toml_db = toml["database"]
+            db_config = DBConfiguration(str(toml_db["server"]), str(toml_db["user"]), str(toml_db["pass"]),
+                                        str(toml_db["dbname"]), bool(toml_db.get("debug", False)))
+        except tomli.TOMLDecodeError:
+            click.echo("The configuration file is not valid and cannot be parsed.")
+            sys.exit(0)
+        except KeyError as err:
+            click.echo(f"The configuration file is missing some expected values: {err}.")
+            sys.exit(0)
+
+    main(db_config, dry_run, check, label)
+
+
+class MigrationTests(unittest.TestCase):
+    """
+    Tests to ensure that the migrations create the indexes declared by the models, and that query plans are read correctly.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def testIndexes(self):
+        created = {match for migration in MIGRATIONS for statement in migration.statements
+                   for match in re.findall(r"INDEX CONCURRENTLY IF NOT EXISTS (\w+)", statement)}
+        # the indexes on a single column and ix_one_reading predate the migrations
+        declared = {index.name for table in Base.metadata.tables.values() for index in table.indexes
+                    if len(index.expressions) > 1 and index.name != "ix_one_reading"}
+        self.assertEqual(created, declared)
+        self.assertEqual([migration.version for migration in MIGRATIONS], list(range(1, len(MIGRATIONS) + 1)))
+
+    def testTables(self):
+        # the tables added after the others were created by hand have the columns of their models
+        for table in (Attack.__table__, ValveCommand.__table__):
+            statement = next(statement for migration in MIGRATIONS for statement in migration.statements
+                             if f"CREATE TABLE IF NOT EXISTS {table.name} " in statement)
+            created = re.findall(r"^\s+\"?([a-z]\w*)\"? [A-Z]", statement, re.MULTILINE)
+            self.assertEqual(created, [column.name for column in table.columns])
+
+    @unittest.skipIf(TEST_DATABASE is None, "set CHAI_TEST_DATABASE to user:password@server/database to test the migrations")
+    def testDuplicates(self):
+        engine = db_engine(configuration_for_tests("pg8000"))
+        with engine.connect() as connection:
+            with connection.begin() as transaction:
+                create_tables_for_tests(connection)
+                connection.execute(text("DROP INDEX ix_device_reading"))  # as in a database that predates the migrations
+                rows = connection.execute(select(NetatmoReading.__table__).order_by(NetatmoReading.id).limit(2)).mappings().all()
+                connection.execute(NetatmoReading.__table__.insert(), [
+                    {**row, "id": 1000 + index, "reading": 0.0} for (index, row) in enumerate(rows + rows[:1])
+                ])
+                before = connection.execute(select(func.count()).select_from(NetatmoReading.__table__)).scalar()
+
+                # the index is built concurrently, which cannot be done in a transaction
+                for statement in MIGRATIONS[0].statements[:-1] * 2:
+                    connection.execute(text(statement))
+                moved = connection.execute(text("SELECT id FROM netatmoreading_duplicates ORDER BY id")).scalars().all()
+                self.assertEqual(moved, [1000, 1001, 1002])
+                self.assertNotIn(0.0, connection.execute(select(NetatmoReading.reading)).scalars().all())
+
+                connection.execute(text("INSERT INTO netatmoreading SELECT * FROM netatmoreading_duplicates"))
+                self.assertEqual(connection.execute(select(func.count()).select_from(NetatmoReading.__table__)).scalar(), before)
+                transaction.rollback()
+        engine.dispose()
+
+    def testIndexScans(self):
+        plan = {"Node Type": "Limit", "Plans": [
+            {"Node Type": "Index Scan", "Index Name": "ix_home_log"},
+            {"Node Type": "Bitmap Heap Scan", "Plans": [{"Node Type": "Bitmap Index Scan", "Index Name": "ix_day_schedule"}]},
+        ]}
+        self.assertEqual(_index_scans(plan), ["ix_home_log", "ix_day_schedule"])
+        self.assertEqual(_index_scans({"Node Type": "Seq Scan"}), [])
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,363 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import json
+import threading
+import time
+import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+import requests
+
+from chai_api.db_definitions import NetatmoDevice
+
+_CLIENTS_WITHOUT_TOKEN: Set[str] = set()
+
+
+def _get_refresh_token(client: Any) -> Optional[str]:
+    """
+    The current refresh token of a Netatmo client, which changes whenever Netatmo rotates it.
+    A client that does not expose it is still used, with the stored refresh token kept as it is.
+    """
+    if not hasattr(client, "refresh_token"):
+        name = type(client).__name__
+        if name not in _CLIENTS_WITHOUT_TOKEN:
+            _CLIENTS_WITHOUT_TOKEN.add(name)
+            print(f"{name} has no refresh_token, so rotated Netatmo refresh tokens are not stored")
+        return None
+    return client.refresh_token
+
+
+class NetatmoClientPool:
+    """
+    Keep one Netatmo client per device, so that the access token and the HTTP connection of a client are reused.
+    Clients are made by `factory` from the refresh token of a device, and `refresh_token_of` tells the current refresh
+    token of a client, which is checked as soon as a client is made. A client is only used by one thread at a time.
+    It is created again when the refresh token of its device changes, and dropped when a call with it fails so that
+    the next call starts from the latest refresh token.
+    A refresh token that Netatmo rotated is stored with `store_token`, by the thread that made the call, so that it is
+    kept even when the caller has given up on the call. The token it replaced still leads to the same client, as it
+    may be read by sessions that started before the new token was stored.
+    """
+    factory: Callable[[str], Any]
+    refresh_token_of: Callable[[Any], Optional[str]]
+    store_token: Optional[Callable[[int, str], None]]
+    hits: int = 0
+    misses: int = 0
+    rotations: int = 0
+
+    def __init__(self, factory: Callable[[str], Any],
+                 refresh_token_of: Callable[[Any], Optional[str]] = _get_refresh_token,
+                 store_token: Optional[Callable[[int, str], None]] = None):
+        self.factory = factory
+        self.refresh_token_of = refresh_token_of
+        self.store_token = store_token
+        self._lock = threading.Lock()
+        # the latest refresh token, the client (None once a call with it failed), its lock, and the replaced token
+        self._clients: Dict[int, Tuple[str, Any, threading.Lock, Optional[str]]] = {}
+
+    @contextmanager
+    def client(self, device: NetatmoDevice) -> Iterator[Any]:
+        """
+        Borrow the client of a device.
+        When Netatmo rotated the refresh token during the call, also when the call failed, the new token is stored
+        with `store_token`. Without it the new token is set on the device, and the caller should commit the session
+        that the device belongs to.
+        :param device: The device to get the client for.
+        :return: The client, which should not be kept after the context is left.
+        """
+        (device_id, stored) = (device.id, device.refreshToken)
+        with self._lock:
+            entry = self._clients.get(device_id, None)
+            if entry is None or stored not in (entry[0], entry[3]):
+                entry = (stored, None, threading.Lock(), None)
+            if entry[1] is None:
+                self.misses += 1
+                entry = (entry[0], self.factory(entry[0]), entry[2], entry[3])
+                self._clients[device_id] = entry
+            else:
+                self.hits += 1
+        (_, client, client_lock, _) = entry
+
+        with client_lock:
+            # another thread may have rotated the token of the client while this one waited for it
+            token = self.refresh_token_of(client)
+            failed = False
+            try:
+                yield client
+            except Exception:
+                failed = True
+                raise
+            finally:
+                # the old refresh token no longer works once Netatmo rotated it, even when the call itself failed
+                rotated = self.refresh_token_of(client)
+                with self._lock:
+                    current = self._clients.get(device_id, None)
+                    if rotated is not None and rotated != token:
+                        self.rotations += 1
+                        self._clients[device_id] = (rotated, None if failed else client, client_lock, token)
+                    elif failed and current is not None and current[1] is client:
+                        # the failed client is dropped, but a token that it rotated in an earlier call is kept
+                        self._clients[device_id] = (current[0], None, client_lock, current[3])
+                if rotated is not None and rotated != token:
+                    self._store(device, device_id, rotated)
+
+    def _store(self, device: NetatmoDevice, device_id: int, token: str) -> None:
+        """ Store a rotated refresh token; the pool keeps using it when it cannot be stored. """
+        if self.store_token is None:
+            device.refreshToken = token
+            return
+        try:
+            self.store_token(device_id, token)
+        except Exception as err:  # noqa
+            print(f"unable to store the rotated refresh token of Netatmo device {device_id}: {err}")
+
+    def discard(self, device_id: int) -> None:
+        """
+        Drop the client of a device, if there is one.
+        :param device_id: The ID of the device.
+        """
+        with self._lock:
+            self._clients.pop(device_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        """ The number of pooled clients, how often a client was reused or created, and the number of token rotations. """
+        with self._lock:
+            clients = sum(1 for entry in self._clients.values() if entry[1] is not None)
+        return {"clients": clients, "hits": self.hits, "misses": self.misses, "rotations": self.rotations}
+
+
+class NetatmoClientPoolTests(unittest.TestCase):
+    """
+    Tests to ensure that clients are reused per device and that rotated refresh tokens are stored.
+    """
+
+    # pylint: disable=C0103, C0116, too-few-public-methods
+
+    class FakeClient:
+        def __init__(self, refresh_token: str):
+            self.refresh_token = refresh_token
+
+    def testReuse(self):
+        pool = NetatmoClientPool(self.FakeClient)
+        device = NetatmoDevice(id=1, refreshToken="first")
+        with pool.client(device) as client:
+            first = client
+        with pool.client(device) as client:
+            self.assertIs(client, first)
+        with pool.client(NetatmoDevice(id=2, refreshToken="other")) as client:
+            self.assertIsNot(client, first)
+        self.assertEqual((pool.hits, pool.misses), (1, 2))
+
+    def testRotation(self):
+        pool = NetatmoClientPool(self.FakeClient)
+        device = NetatmoDevice(id=1, refreshToken="first")
+        with pool.client(device) as client:
+            client.refresh_token = "second"
+        self.assertEqual(device.refreshToken, "second")
+        with pool.client(device) as rotated:
+            self.assertIs(rotated, client)
+
+        # a token that was changed elsewhere, e.g. when the device was linked again, results in a new client
+        device.refreshToken = "third"
+        with pool.client(device) as client:
+            self.assertEqual(client.refresh_token, "third")
+        self.assertEqual(pool.stats(), {"clients": 1, "hits": 1, "misses": 2, "rotations": 1})
+
+    def testFailure(self):
+        pool = NetatmoClientPool(self.FakeClient)
+        device = NetatmoDevice(id=1, refreshToken="first")
+        with self.assertRaises(TimeoutError):
+            with pool.client(device):
+                raise TimeoutError
+        self.assertEqual(pool.stats()["clients"], 0)
+
+        # a token rotated before the call failed is still stored
+        with self.assertRaises(TimeoutError):
+            with pool.client(device) as client:
+                client.refresh_token = "second"
+                raise TimeoutError
+        self.assertEqual(device.refreshToken, "second")
+        self.assertEqual(pool.stats(), {"clients": 0, "hits": 0, "misses": 2, "rotations": 1})
+
+    def testStoredRotation(self):
+        stored = {}
+        pool = NetatmoClientPool(self.FakeClient, store_token=stored.__setitem__)
+        device = NetatmoDevice(id=1, refreshToken="first")
+        with pool.client(device) as client:
+            client.refresh_token = "second"
+        self.assertEqual((stored, device.refreshToken), ({1: "second"}, "first"))
+
+        # the replaced token may still be read by sessions that started before the new one was stored
+        for token in ("first", "second"):
+            with pool.client(NetatmoDevice(id=1, refreshToken=token)) as reused:
+                self.assertIs(reused, client)
+
+        # the pool keeps the newest token when it cannot be stored, and after a call with it failed
+        def fail(device_id: int, token: str):
+            raise ConnectionError(f"{device_id} {token}")
+        pool.store_token = fail
+        with self.assertRaises(TimeoutError):
+            with pool.client(device) as client:
+                client.refresh_token = "third"
+                raise TimeoutError
+        with pool.client(NetatmoDevice(id=1, refreshToken="second")) as client:
+            self.assertEqual(client.refresh_token, "third")
+        self.assertEqual(pool.stats(), {"clients": 1, "hits": 3, "misses": 2, "rotations": 2})
+
+    def testMissingToken(self):
+        pool = NetatmoClientPool(lambda refresh_token: object())
+        device = NetatmoDevice(id=1, refreshToken="first")
+        for _ in range(2):
+            with pool.client(device) as client:
+                first = client
+        self.assertEqual(device.refreshToken, "first")
+        self.assertEqual(pool.stats(), {"clients": 1, "hits": 1, "misses": 1, "rotations": 0})
+        with pool.client(device) as client:
+            self.assertIs(client, first)
+
+
+class NetatmoStubServerTests(unittest.TestCase):
+    """
+    Tests of the pool against a local stub of Netatmo, which rotates refresh tokens and rejects replaced ones.
+    """
+
+    # pylint: disable=C0103, C0116, too-few-public-methods
+
+    class StubNetatmo(ThreadingHTTPServer):
+        """
+        A stub of the Netatmo token and valve endpoints. Every token refresh replaces the refresh token of a device,
+        after which the old one is rejected with invalid_grant, and a valve is set with the access token as bearer.
+        """
+        daemon_threads = True
+
+        def __init__(self, tokens: Dict[int, str]):
+            super().__init__(("127.0.0.1", 0), NetatmoStubServerTests.StubHandler)
+            self.lock = threading.Lock()
+            self.refresh_tokens = {token: device_id for (device_id, token) in tokens.items()}
+            self.access_tokens: Dict[str, int] = {}
+            self.busy: Set[int] = set()
+            self.refreshes: Counter = Counter()
+            self.errors: list = []
+            self.calls = 0
+
+        def refresh(self, refresh_token: str) -> Optional[Dict[str, str]]:
+            with self.lock:
+                device_id = self.refresh_tokens.pop(refresh_token, None)
+                if device_id is None:
+                    self.errors.append(f"invalid_grant {refresh_token}")
+                    return None
+                self.refreshes[device_id] += 1
+                tokens = {"refresh_token": f"refresh-{device_id}-{self.refreshes[device_id]}",
+                          "access_token": f"access-{device_id}-{self.refreshes[device_id]}"}
+                self.refresh_tokens[tokens["refresh_token"]] = device_id
+                self.access_tokens[tokens["access_token"]] = device_id
+                return tokens
+
+        def set_state(self, access_token: str) -> bool:
+            with self.lock:
+                device_id = self.access_tokens.get(access_token, None)
+                if device_id is None:
+                    self.errors.append(f"invalid_token {access_token}")
+                    return False
+                if device_id in self.busy:
+                    self.errors.append(f"concurrent use of device {device_id}")
+                self.busy.add(device_id)
+                self.calls += 1
+            time.sleep(0.002)
+            with self.lock:
+                self.busy.discard(device_id)
+            return True
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            if self.path == "/oauth2/token":
+                form = {key: values[0] for (key, values) in parse_qs(body).items()}
+                tokens = self.server.refresh(form.get("refresh_token", ""))
+                self.reply(400, {"error": "invalid_grant"}) if tokens is None else self.reply(200, tokens)
+            elif self.path == "/api/setstate":
+                access_token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+                self.reply(200, {"status": "ok"}) if self.server.set_state(access_token) else self.reply(403, {"error": "invalid_token"})
+            else:
+                self.reply(404, {"error": "not found"})
+
+        def reply(self, status: int, content: Dict[str, str]):
+            data = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    class StubClient:
+        """ A client with the shape of NetatmoClient, which keeps its access token and HTTP session between calls. """
+        base_url: str = ""
+
+        def __init__(self, client_id: str, client_secret: str, refresh_token: str):
+            self.client_id = client_id
+            self.client_secret = client_secret
+            self.refresh_token = refresh_token
+            self.access_token = None
+            self.session = requests.Session()
+
+        def set_device(self, **kwargs):
+            if self.access_token is None:
+                response = self.session.post(f"{self.base_url}/oauth2/token", data={
+                    "grant_type": "refresh_token", "refresh_token": self.refresh_token,
+                    "client_id": self.client_id, "client_secret": self.client_secret
+                })
+                response.raise_for_status()
+                (self.refresh_token, self.access_token) = (response.json()["refresh_token"], response.json()["access_token"])
+            response = self.session.post(f"{self.base_url}/api/setstate", json=kwargs,
+                                         headers={"Authorization": f"Bearer {self.access_token}"})
+            response.raise_for_status()
+
+    def setUp(self):
+        self.tokens = {device_id: f"refresh-{device_id}-0" for device_id in range(1, 4)}
+        self.server = self.StubNetatmo(self.tokens)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client_type = type("Client", (self.StubClient,), {"base_url": f"http://127.0.0.1:{self.server.server_port}"})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_pool(self) -> NetatmoClientPool:
+        return NetatmoClientPool(lambda refresh_token: self.client_type(client_id="id", client_secret="secret", refresh_token=refresh_token),
+                                 store_token=self.tokens.__setitem__)
+
+    def testConcurrentCalls(self):
+        pool = self.make_pool()
+
+        def call(index: int):
+            device_id = index % len(self.tokens) + 1
+            with pool.client(NetatmoDevice(id=device_id, refreshToken=self.tokens[device_id])) as client:
+                client.set_device(device="valve", mode="manual", temperature=20, minutes=60)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(call, range(60)))
+        self.assertEqual(self.server.errors, [])
+        self.assertEqual((self.server.calls, dict(self.server.refreshes)), (60, {1: 1, 2: 1, 3: 1}))
+        self.assertEqual(pool.stats(), {"clients": 3, "hits": 57, "misses": 3, "rotations": 3})
+
+    def testStoredTokens(self):
+        with self.make_pool().client(NetatmoDevice(id=1, refreshToken=self.tokens[1])) as client:
+            client.set_device(device="valve", mode="off", temperature=None, minutes=60)
+        self.assertEqual(self.tokens[1], "refresh-1-1")
+
+        # a new process starts from the stored token, which Netatmo still accepts
+        with self.make_pool().client(NetatmoDevice(id=1, refreshToken=self.tokens[1])) as client:
+            client.set_device(device="valve", mode="off", temperature=None, minutes=60)
+        self.assertEqual((self.tokens[1], self.server.errors), ("refresh-1-2", []))
+
+
+if __name__ == "__main__":
+    unittest.main()
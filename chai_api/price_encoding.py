@@ -0,0 +1,148 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import sys
+import unittest
+from array import array
+from datetime import date
+from typing import Iterator, List
+
+import pendulum
+import ujson as json
+
+from chai_api.energy_loop import PriceSeries, get_price_series, get_energy_values
+
+LONDON = pendulum.timezone("Europe/London")
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# the number of prices that are encoded together, which bounds the memory used by a streamed response
+CHUNK_SIZE = 512
+
+# the media types of the compact representations of a price range
+MEDIA_COLUMNAR = "application/vnd.chai.prices.columnar+json"
+MEDIA_BINARY = "application/octet-stream"
+
+
+def _get_utc_offset(timestamp: int) -> int:
+    """ The offset from UTC in seconds of the Europe/London timezone at the given epoch second. """
+    return pendulum.from_timestamp(timestamp, tz=LONDON).offset
+
+
+def iso_timestamps(start: int, count: int, step: int = 1800) -> Iterator[str]:
+    """
+    Format a run of evenly spaced epoch seconds as ISO 8601 strings in the Europe/London timezone.
+    The output matches DateTime.isoformat(), but only the timezone offset of every day is looked up.
+    :param start: The first epoch second to format.
+    :param count: The number of timestamps to format.
+    :param step: The number of seconds between two timestamps.
+    :return: The formatted timestamps.
+    """
+    day_end = start
+    offset = None
+    zone_text = ""
+    day = None
+    date_text = ""
+    for timestamp in range(start, start + count * step, step):
+        if timestamp >= day_end:
+            # the offset can only change at a BST transition; check the end of the day to see if one happens today
+            current_offset = _get_utc_offset(timestamp)
+            day_end = timestamp + 86400
+            if _get_utc_offset(day_end) != current_offset:
+                day_end = timestamp + step
+            if current_offset != offset:
+                offset = current_offset
+                zone_text = f"{'+' if offset >= 0 else '-'}{abs(offset) // 3600:02d}:{abs(offset) % 3600 // 60:02d}"
+                day = None
+        local = timestamp + offset
+        if local // 86400 != day:
+            day = local // 86400
+            date_text = date.fromordinal(EPOCH_ORDINAL + day).isoformat()
+        seconds = local % 86400
+        yield f"{date_text}T{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}{zone_text}"
+
+
+def encode_prices(series: PriceSeries, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Encode a series of prices as a JSON list of {"start", "end", "rate"} objects, one chunk at a time.
+    :param series: The series of prices to encode.
+    :param chunk_size: The maximum number of prices to encode in each chunk.
+    :return: The chunks of the JSON document, which concatenate to the same document as the list of ElectricityPrice.
+    """
+    timestamps = iso_timestamps(series.start, len(series) + 1, series.step)
+    previous = next(timestamps)
+
+    yield b"["
+    for chunk_start in range(0, len(series), chunk_size):
+        entries = []
+        for price in series.prices[chunk_start:chunk_start + chunk_size]:
+            current = next(timestamps)
+            entries.append({"start": previous, "end": current, "rate": price})
+            previous = current
+        encoded = json.dumps(entries)[1:-1]
+        yield (encoded if chunk_start == 0 else f",{encoded}").encode("utf-8")
+    yield b"]"
+
+
+def encode_columnar(series: PriceSeries) -> bytes:
+    """
+    Encode a series of prices as a single JSON object with the start, the step in minutes, and a flat list of rates.
+    :param series: The series of prices to encode.
+    :return: The JSON document.
+    """
+    start = next(iso_timestamps(series.start, 1))
+    return json.dumps({"start": start, "step": series.step // 60, "rates": series.prices.tolist()}).encode("utf-8")
+
+
+def encode_binary(series: PriceSeries) -> bytes:
+    """
+    Encode the rates of a series of prices as packed little-endian 32-bit floats.
+    The start and step of the series are not included and should be sent alongside, e.g. in the response headers.
+    :param series: The series of prices to encode.
+    :return: The packed rates.
+    """
+    rates = array("f", series.prices)
+    if sys.byteorder != "little":
+        rates.byteswap()
+    return rates.tobytes()
+
+
+class PriceEncodingTests(unittest.TestCase):
+    """
+    Tests to ensure that the encoded prices are identical to encoding the ElectricityPrice instances.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def assertSameEncoding(self, start: pendulum.DateTime, end: pendulum.DateTime, chunk_size: int = CHUNK_SIZE):
+        expected = json.dumps([entry.to_dict() for entry in get_energy_values(start, end)])
+        encoded: List[bytes] = list(encode_prices(get_price_series(start, end), chunk_size))
+        self.assertEqual(b"".join(encoded).decode("utf-8"), expected)
+
+    def testSummerDay(self):
+        self.assertSameEncoding(pendulum.parse("2021-07-22T00:00"), pendulum.parse("2021-07-23T00:00"), chunk_size=5)
+
+    def testTransitions(self):
+        self.assertSameEncoding(pendulum.parse("2023-03-25T10:00"), pendulum.parse("2023-03-27T01:00"))
+        self.assertSameEncoding(pendulum.parse("2023-10-28T23:30"), pendulum.parse("2023-10-29T03:00"), chunk_size=1)
+
+    def testYear(self):
+        self.assertSameEncoding(pendulum.parse("2022-12-31T10:00"), pendulum.parse("2024-01-01T10:00"))
+
+    def testColumnar(self):
+        (start, end) = (pendulum.parse("2023-03-25T10:00"), pendulum.parse("2023-03-27T01:00"))
+        entries = [entry.to_dict() for entry in get_energy_values(start, end)]
+        columnar = json.loads(encode_columnar(get_price_series(start, end)))
+        self.assertEqual(columnar["start"], entries[0]["start"])
+        self.assertEqual(columnar["step"], 30)
+        self.assertEqual(columnar["rates"], [entry["rate"] for entry in entries])
+
+        rates = array("f")
+        rates.frombytes(encode_binary(get_price_series(start, end)))
+        self.assertEqual(len(rates), len(entries))
+        self.assertAlmostEqual(rates[-1], entries[-1]["rate"], places=4)
+
+    def testEmpty(self):
+        self.assertSameEncoding(pendulum.parse("2021-07-22T00:00"), pendulum.parse("2021-07-22T00:00"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,28 +1,79 @@
 # pylint: disable=line-too-long, missing-module-docstring
 # pylint: disable=no-member, c-extension-no-member, too-few-public-methods
 # pylint: disable=missing-class-docstring, missing-function-docstring
+import hashlib
 import math
+import threading
+import unittest
+from typing import Optional, Dict, List, Tuple, Hashable
 
 import falcon
-import ujson as json
+import pendulum
 from dacite import from_dict, DaciteError, Config
 from falcon import Request, Response
 from pendulum import DateTime, parse
 
-from chai_api.expected import PricesGet
-from chai_api.energy_loop import get_energy_values, ElectricityPrice
+from chai_api.attack import PriceAttack
+from chai_api.attack_store import AttackStore
+from chai_api.expected import PricesGet, PricesFormat
+from chai_api.energy_loop import get_price_series, PriceSeries
+from chai_api.price_encoding import encode_prices, encode_columnar, encode_binary, iso_timestamps
+from chai_api.price_encoding import CHUNK_SIZE, MEDIA_COLUMNAR, MEDIA_BINARY
+from chai_api.utilities import TTLCache
+
+# the number of seconds for which clients and proxies may reuse a response without checking its ETag
+MAX_AGE = 60
+
+
+def _get_etag(start: DateTime, end: DateTime, limit: Optional[int], price_format: PricesFormat, version) -> str:
+    """
+    Derive a strong ETag for a price range without computing it.
+    The prices only change per half-hour slot, so every range that covers the same slots has the same ETag.
+    :param start: The start date of the range.
+    :param end: The end date of the range.
+    :param limit: The maximum number of prices in the range.
+    :param price_format: The format in which the prices are encoded.
+    :param version: The version of the attack store.
+    :return: The ETag, without quotes.
+    """
+    first_slot = start.int_timestamp // 1800
+    until_end = (end.int_timestamp - first_slot * 1800) * 1_000_000 + end.microsecond
+    slots = max(0, -(-until_end // 1_800_000_000))
+    key = f"{first_slot}:{slots if limit is None else min(slots, limit)}:{price_format.value}:{version!r}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _encode(series: PriceSeries, price_format: PricesFormat) -> Tuple[str, bytes, Dict[str, str]]:
+    """
+    Encode a series of prices in one go.
+    :param series: The series of prices to encode.
+    :param price_format: The format in which to encode the prices.
+    :return: The content type, the encoded prices, and any additional headers to send along.
+    """
+    if price_format == PricesFormat.COLUMNAR:
+        return MEDIA_COLUMNAR, encode_columnar(series), {}
+    if price_format == PricesFormat.BINARY:
+        return MEDIA_BINARY, encode_binary(series), {
+            "X-Prices-Start": next(iso_timestamps(series.start, 1)),
+            "X-Prices-Step": str(series.step // 60),
+        }
+    return falcon.MEDIA_JSON, b"".join(encode_prices(series)), {}
 
 
 class PriceResource:
-    shelve_db: str = ""
+    attack_store: AttackStore
+    cache: Optional[TTLCache[str, Tuple[str, bytes, Dict[str, str]]]]
 
-    def __init__(self, shelve_location):
-        self.shelve_db = shelve_location
+    def __init__(self, attack_store: AttackStore, cache: Optional[TTLCache] = None):
+        self.attack_store = attack_store
+        self.cache = cache
+        self._cached_version: Hashable = None
+        self._version_lock = threading.Lock()
 
     def on_get(self, req: Request, resp: Response):  # noqa
         try:
             options = req.params
-            request: PricesGet = from_dict(PricesGet, options, config=Config({DateTime: parse}, cast=[int]))
+            request: PricesGet = from_dict(PricesGet, options, config=Config({DateTime: parse}, cast=[int, PricesFormat]))
             print(request)
 
             if request.end is not None and request.default_start:
@@ -47,12 +98,147 @@ class PriceResource:
                 else:
                     request.end = request.start.add(days=math.ceil(request.limit / 48))
 
-            entries: [ElectricityPrice] = get_energy_values(request.start, request.end, request.limit, self.shelve_db)
+            if request.format is None:
+                preferred = req.client_prefers([falcon.MEDIA_JSON, MEDIA_COLUMNAR, MEDIA_BINARY])
+                request.format = PricesFormat.BINARY if preferred == MEDIA_BINARY else (
+                    PricesFormat.COLUMNAR if preferred == MEDIA_COLUMNAR else PricesFormat.LIST
+                )
+
+            # a range that starts now changes with the next slot, any other range only when an attack is made
+            max_age = MAX_AGE
+            if request.default_start:
+                max_age = min(max_age, 1800 - request.start.int_timestamp % 1800)
+            version = self.attack_store.version()
+            etag = _get_etag(request.start, request.end, request.limit, request.format, version)
+            resp.etag = etag
+            resp.cache_control = ["public", f"max-age={max_age}"]
+            resp.vary = ["Accept"]
+
+            if_none_match = req.if_none_match
+            if if_none_match is not None and any(tag in ("*", etag) for tag in if_none_match):
+                resp.status = falcon.HTTP_NOT_MODIFIED
+                return
 
-            resp.content_type = falcon.MEDIA_JSON
             resp.status = falcon.HTTP_OK
-            resp.text = json.dumps([entry.to_dict() for entry in entries])
+            if self.cache is not None:
+                # the ETag covers the attacks, but entries made before an attack are of no more use to anyone
+                with self._version_lock:
+                    if version != self._cached_version:
+                        self.cache.clear()
+                        self._cached_version = version
+                if (cached := self.cache.get(etag)) is not None:
+                    (resp.content_type, resp.data, headers) = cached
+                    resp.set_headers(headers)
+                    return
+
+            series: PriceSeries = get_price_series(request.start, request.end, request.limit, self.attack_store)
+
+            # short ranges are sent in one go, longer ranges are encoded while they are being sent
+            if request.format == PricesFormat.LIST and len(series) > CHUNK_SIZE:
+                resp.content_type = falcon.MEDIA_JSON
+                resp.stream = encode_prices(series)
+                return
+
+            encoded = _encode(series, request.format)
+            if self.cache is not None and len(series) <= CHUNK_SIZE:
+                self.cache.put(etag, encoded)
+            (resp.content_type, resp.data, headers) = encoded
+            resp.set_headers(headers)
         except DaciteError as err:
             resp.content_type = falcon.MEDIA_TEXT
             resp.status = falcon.HTTP_BAD_REQUEST
             resp.text = f"one or more of the parameters was not understood\n{err}"
+        except ValueError as err:
+            resp.content_type = falcon.MEDIA_TEXT
+            resp.status = falcon.HTTP_BAD_REQUEST
+            resp.text = f"one or more of the parameters has an invalid value:\n{err}"
+
+    async def on_get_async(self, req: Request, resp: Response):  # noqa
+        """ The same as on_get for the ASGI app; the prices are not read from the database, so nothing is awaited. """
+        self.on_get(req, resp)
+
+
+class PriceResourceTests(unittest.TestCase):
+    """
+    Tests to ensure that price ranges are sent with the right ETag and Cache-Control, and are cached per attack version.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    class VersionedStore(AttackStore):
+        def __init__(self):
+            self.attacks: List[PriceAttack] = []
+
+        def get_attacks(self, start_date=None, end_date=None):
+            return self.attacks
+
+        def add_attack(self, attack, replace=True):
+            self.attacks = [attack] if replace else self.attacks + [attack]
+
+        def version(self):
+            return len(self.attacks)
+
+    def setUp(self):
+        import falcon.testing  # pylint: disable=import-outside-toplevel
+        self.store = self.VersionedStore()
+        self.cache = TTLCache(ttl=60)
+        app = falcon.App()
+        app.add_route("/prices", PriceResource(self.store, self.cache))
+        self.client = falcon.testing.TestClient(app)
+
+    def tearDown(self):
+        pendulum.set_test_now()
+
+    def testETag(self):
+        result = self.client.simulate_get("/prices", params={"start": "2021-07-22T00:00", "end": "2021-07-22T03:00"})
+        self.assertEqual(result.status, falcon.HTTP_OK)
+        self.assertEqual(len(result.json), 6)
+        self.assertEqual(result.headers["cache-control"], f"public, max-age={MAX_AGE}")
+
+        # the same slots have the same ETag, other slots or another format do not
+        same = self.client.simulate_get("/prices", params={"start": "2021-07-22T00:10", "end": "2021-07-22T02:40"})
+        self.assertEqual(same.headers["etag"], result.headers["etag"])
+        later = self.client.simulate_get("/prices", params={"start": "2021-07-22T00:30", "end": "2021-07-22T03:00"})
+        self.assertNotEqual(later.headers["etag"], result.headers["etag"])
+        columnar = self.client.simulate_get("/prices", params={"start": "2021-07-22T00:00", "end": "2021-07-22T03:00",
+                                                               "format": PricesFormat.COLUMNAR.value})
+        self.assertNotEqual(columnar.headers["etag"], result.headers["etag"])
+
+    def testNotModified(self):
+        params = {"start": "2021-07-22T00:00", "end": "2021-07-22T03:00"}
+        etag = self.client.simulate_get("/prices", params=params).headers["etag"]
+        for if_none_match in (etag, f'"other", {etag}', "*"):
+            result = self.client.simulate_get("/prices", params=params, headers={"If-None-Match": if_none_match})
+            self.assertEqual(result.status, falcon.HTTP_NOT_MODIFIED)
+            self.assertEqual(result.content, b"")
+        result = self.client.simulate_get("/prices", params=params, headers={"If-None-Match": '"other"'})
+        self.assertEqual(result.status, falcon.HTTP_OK)
+
+    def testMaxAge(self):
+        # a range that starts now may only be reused until the next slot starts
+        for (now, max_age) in (("2021-07-22T10:00:00", MAX_AGE), ("2021-07-22T10:29:00", MAX_AGE),
+                               ("2021-07-22T10:29:30", 30), ("2021-07-22T10:59:59", 1)):
+            pendulum.set_test_now(pendulum.parse(now, tz="Europe/London"))
+            result = self.client.simulate_get("/prices")
+            self.assertEqual(result.headers["cache-control"], f"public, max-age={max_age}", now)
+        result = self.client.simulate_get("/prices", params={"start": "2021-07-22T10:59:59"})
+        self.assertEqual(result.headers["cache-control"], f"public, max-age={MAX_AGE}")
+
+    def testVersionChange(self):
+        params = {"start": "2021-07-22T00:00", "end": "2021-07-22T03:00"}
+        before = self.client.simulate_get("/prices", params=params)
+        self.client.simulate_get("/prices", params=params)
+        self.assertEqual((self.cache.hits, len(self.cache)), (1, 1))
+
+        self.store.add_attack(PriceAttack(2, pendulum.parse("2021-07-22T00:00"), pendulum.parse("2021-07-22T01:00")))
+        after = self.client.simulate_get("/prices", params=params)
+        self.assertNotEqual(after.headers["etag"], before.headers["etag"])
+        self.assertEqual([entry["rate"] * (2 if index < 2 else 1) for (index, entry) in enumerate(before.json)],
+                         [entry["rate"] for entry in after.json])
+        self.assertEqual(len(self.cache), 1, "the entries from before the attack are dropped")
+        result = self.client.simulate_get("/prices", params=params, headers={"If-None-Match": before.headers["etag"]})
+        self.assertEqual(result.status, falcon.HTTP_OK)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,10 +2,14 @@
 # pylint: disable=no-member, c-extension-no-member, too-few-public-methods
 # pylint: disable=missing-class-docstring, missing-function-docstring
 
+from typing import Optional
+
 import falcon
 import ujson as json
 from dacite import from_dict, DaciteError, Config
 from falcon import Request, Response
+from sqlalchemy import select
+from sqlalchemy.sql import Select
 from sqlalchemy.sql.expression import func
 
 from chai_api.db_definitions import Profile, get_home
@@ -13,6 +17,34 @@ from chai_api.expected import ProfileGet
 from chai_api.responses import ProfileEntry
 
 
+def latest_profiles_query(home_id: int, profile_id: Optional[int] = None) -> Select:
+    """
+    Select the latest version of each profile of a home, using the ix_latest_profile index.
+    :param home_id: The ID of the home.
+    :param profile_id: The profile to select, or None to select all profiles.
+    :return: A statement that selects the profile ID, slope (mean2), and bias (mean1) of each profile.
+    """
+    #  SELECT *
+    #  FROM profile
+    #  WHERE id IN (SELECT MAX(id) FROM profile GROUP BY profile_id)
+
+    subquery = select(func.max(Profile.id)).where(
+        Profile.home_id == home_id
+    ).group_by(Profile.profile_id)
+
+    query = select(
+        Profile.profile_id, Profile.mean2, Profile.mean1
+    ).where(
+        Profile.id.in_(subquery)
+    ).order_by(
+        Profile.profile_id
+    )
+
+    if profile_id is not None:
+        query = query.where(Profile.profile_id == profile_id)
+    return query
+
+
 class ProfileResource:
     def on_get(self, req: Request, resp: Response):  # noqa
         try:
@@ -35,27 +67,8 @@ class ProfileResource:
                 resp.status = falcon.HTTP_BAD_REQUEST
                 return
 
-            #  SELECT *
-            #  FROM profile
-            #  WHERE id IN (SELECT MAX(id) FROM profile GROUP BY profile_id)
-
-            subquery = db_session.query(func.max(Profile.id)).filter(
-                Profile.home_id == home.id
-            ).group_by(Profile.profile_id).subquery()
-
-            query = db_session.query(
-                Profile
-            ).filter(
-                Profile.id.in_(subquery)
-            )
-
-            if request.profile is not None:
-                query = query.filter(Profile.profile_id == request.profile)
-
-            result: [Profile] = query.all()
-
-            response = sorted([ProfileEntry(result.profile_id, result.mean2, result.mean1) for result in result],
-                              key=lambda x: x.profile)
+            query = latest_profiles_query(home.id, request.profile)
+            response = [ProfileEntry(profile_id, slope, bias) for (profile_id, slope, bias) in db_session.execute(query)]
 
             resp.content_type = falcon.MEDIA_JSON
             resp.text = json.dumps([entry.to_dict() for entry in response])
@@ -0,0 +1,237 @@
+# pylint: disable=line-too-long, missing-module-docstring
+# pylint: disable=no-member, c-extension-no-member, too-few-public-methods
+# pylint: disable=missing-class-docstring, missing-function-docstring
+
+import csv
+import io
+import os
+import sys
+import time
+import unittest
+from dataclasses import dataclass
+from itertools import islice
+from typing import Iterable, Iterator, Dict, Any
+
+import click
+import falcon
+import pendulum
+import tomli
+import ujson as json
+from dacite import from_dict, DaciteError
+from falcon import Request, Response
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from chai_api.db_definitions import NetatmoReading, get_home, Home
+from chai_api.db_definitions import db_engine_manager, db_session_manager, Configuration as DBConfiguration
+from chai_api.expected import ReadingsPut
+
+# the number of readings inserted by a single statement, which stays well below the 32767 parameters pg8000 supports
+BATCH_SIZE = 2000
+
+MEDIA_CSV = "text/csv"
+MEDIA_NDJSON = "application/x-ndjson"
+
+
+@dataclass
+class IngestResult:
+    received: int
+    inserted: int  # readings that were already stored are not inserted again
+    seconds: float
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "received": self.received, "inserted": self.inserted, "seconds": round(self.seconds, 3),
+            "rows_per_second": round(self.received / self.seconds) if self.seconds > 0 else None
+        }
+
+
+def _to_reading(entry: Dict[str, Any], line: int) -> Dict[str, Any]:
+    """
+    Validate a single reading and convert it to the columns of the netatmoreading table.
+    :param entry: The reading with a room_id, start, end, and reading.
+    :param line: The line on which the reading was given, to report errors.
+    :return: The reading as a row of the netatmoreading table, without the netatmoid.
+    """
+    try:
+        room_id = int(entry["room_id"])
+        start = pendulum.parse(str(entry["start"]))
+        end = pendulum.parse(str(entry["end"]))
+        reading = float(entry["reading"])
+    except KeyError as err:
+        raise ValueError(f"the reading on line {line} is missing {err}") from err
+    except (TypeError, ValueError) as err:
+        raise ValueError(f"the reading on line {line} is not valid: {err}") from err
+
+    if room_id not in (1, 2, 3):
+        raise ValueError(f"the reading on line {line} has an unknown room_id of {room_id}")
+    if end < start:
+        raise ValueError(f"the reading on line {line} ends before it starts")
+    return {"roomid": room_id, "start": start, "end": end, "reading": reading}
+
+
+def parse_readings(lines: Iterable[str], media_type: str = MEDIA_NDJSON) -> Iterator[Dict[str, Any]]:
+    """
+    Parse readings given as JSON lines, or as CSV with a header of room_id, start, end, and reading.
+    :param lines: The lines of the document.
+    :param media_type: Either MEDIA_NDJSON or MEDIA_CSV.
+    :return: The readings as rows of the netatmoreading table, without the netatmoid.
+    """
+    if media_type == MEDIA_CSV:
+        for (line, entry) in enumerate(csv.DictReader(lines), start=2):
+            yield _to_reading(entry, line)
+        return
+
+    for (line, text) in enumerate(lines, start=1):
+        if not text.strip():
+            continue
+        try:
+            entry = json.loads(text)
+        except ValueError as err:
+            raise ValueError(f"line {line} is not valid JSON: {err}") from err
+        if not isinstance(entry, dict):
+            raise ValueError(f"line {line} should be a JSON object")
+        yield _to_reading(entry, line)
+
+
+def insert_readings(db_session: Session, netatmo_id: int, readings: Iterable[Dict[str, Any]],
+                    batch_size: int = BATCH_SIZE) -> IngestResult:
+    """
+    Insert readings for a device with multi-row INSERT statements, skipping readings that are already stored.
+    :param db_session: The database session to use; it is committed once all readings are inserted.
+    :param netatmo_id: The ID of the Netatmo device the readings belong to.
+    :param readings: The readings to insert, as rows of the netatmoreading table.
+    :param batch_size: The number of readings inserted by a single statement.
+    :return: How many readings were received and inserted, and how long that took.
+    """
+    started = time.monotonic()
+    (received, inserted) = (0, 0)
+    insert = sqlite.insert if db_session.get_bind().dialect.name == "sqlite" else postgresql.insert
+    readings = iter(readings)
+    while batch := list(islice(readings, batch_size)):
+        for reading in batch:
+            reading["netatmoid"] = netatmo_id
+        # a reading that was stored before conflicts with the unique ix_device_reading index, which is named as the
+        # conflict target so that the insert fails rather than storing duplicates when the index is missing
+        result = db_session.execute(insert(NetatmoReading.__table__).values(batch).on_conflict_do_nothing(
+            index_elements=[NetatmoReading.netatmo_id, NetatmoReading.room_id, NetatmoReading.start]
+        ))
+        received += len(batch)
+        inserted += max(result.rowcount, 0)
+    db_session.commit()
+    return IngestResult(received, inserted, time.monotonic() - started)
+
+
+class ReadingsResource:
+    def on_put(self, req: Request, resp: Response):  # noqa
+        try:
+            request: ReadingsPut = from_dict(ReadingsPut, req.params)
+            db_session = req.context.session
+
+            home = get_home(request.label, db_session, req.context.get("user", "anonymous"))
+
+            if home is None:
+                resp.content_type = falcon.MEDIA_TEXT
+                resp.text = "unknown home label, or invalid home token"
+                resp.status = falcon.HTTP_BAD_REQUEST
+                return
+
+            media_type = MEDIA_CSV if (req.content_type or "").startswith(MEDIA_CSV) else MEDIA_NDJSON
+            lines = io.TextIOWrapper(req.bounded_stream, encoding="utf-8", newline="")
+            result = insert_readings(db_session, home.netatmoID, parse_readings(lines, media_type))
+
+            resp.content_type = falcon.MEDIA_JSON
+            resp.text = json.dumps(result.to_dict())
+            resp.status = falcon.HTTP_OK
+        except (DaciteError, ValueError) as err:
+            req.context.session.rollback()
+            resp.content_type = falcon.MEDIA_TEXT
+            resp.status = falcon.HTTP_BAD_REQUEST
+            resp.text = f"one or more of the readings was not understood\n{err}"
+
+
+def main(config: DBConfiguration, label: str, path: str, media_type: str):
+    with db_engine_manager(config) as engine:
+        with db_session_manager(engine) as session:
+            home = session.query(Home).filter(Home.label == label).order_by(Home.revision.desc()).first()
+            if home is None:
+                click.echo(f"There is no home with the label {label}.")
+                sys.exit(0)
+
+            with open(path, encoding="utf-8", newline="") as file:
+                result = insert_readings(session, home.netatmoID, parse_readings(file, media_type))
+
+            click.echo(f"inserted {result.inserted} of {result.received} readings in {result.seconds:.1f}s "
+                       f"({result.to_dict()['rows_per_second']} readings/s)")
+
+
+@click.command()
+@click.option("--config", default=None, help="The TOML configuration file.")
+@click.option("--label", help="The label of the home whose device the readings belong to.")
+@click.option("--file", "path", help="The readings as JSON lines, or as CSV when the file name ends with .csv.")
+def cli(config, label, path):  # pylint: disable=invalid-name
+    if not config or not os.path.isfile(config):
+        click.echo("The configuration file is not found. Please provide a valid file path.")
+        sys.exit(0)
+
+    if not label:
+        click.echo("The label for the home should be provided and should not be empty.")
+        sys.exit(0)
+
+    if not path or not os.path.isfile(path):
+        click.echo("The file with readings is not found. Please provide a valid file path.")
+        sys.exit(0)
+
+    with open(config, "rb") as file:
+        try:
+            toml = tomli.load(file)
+            toml_db = toml["database"]
+            db_config = DBConfiguration(str(toml_db["server"]), str(toml_db["user"]), str(toml_db["pass"]),
+                                        str(toml_db["dbname"]), bool(toml_db.get("debug", False)))
+        except tomli.TOMLDecodeError:
+            click.echo("The configuration file is not valid and cannot be parsed.")
+            sys.exit(0)
+        except KeyError as err:
+            click.echo(f"The configuration file is missing some expected values: {err}.")
+            sys.exit(0)
+
+    try:
+        main(db_config, label, path, MEDIA_CSV if path.endswith(".csv") else MEDIA_NDJSON)
+    except ValueError as err:
+        click.echo(f"The readings could not be inserted: {err}")
+        sys.exit(0)
+
+
+class ReadingsTests(unittest.TestCase):
+    """
+    Tests to ensure that readings given as JSON lines and CSV are parsed the same.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def testFormats(self):
+        ndjson = ['{"room_id": 2, "start": "2023-01-01T10:00:00Z", "end": "2023-01-01T10:05:00Z", "reading": 19.5}\n', "\n"]
+        csv_lines = ["room_id,start,end,reading\n", "2,2023-01-01T10:00:00Z,2023-01-01T10:05:00Z,19.5\n"]
+        self.assertEqual(list(parse_readings(ndjson)), list(parse_readings(csv_lines, MEDIA_CSV)))
+
+    def testInvalid(self):
+        with self.assertRaisesRegex(ValueError, "line 2"):
+            list(parse_readings(["room_id,start,end,reading\n", "4,2023-01-01T10:00Z,2023-01-01T10:05Z,1\n"], MEDIA_CSV))
+        with self.assertRaisesRegex(ValueError, "missing 'reading'"):
+            list(parse_readings(['{"room_id": 1, "start": "2023-01-01T10:00Z", "end": "2023-01-01T10:05Z"}']))
+
+    def testResubmitted(self):
+        engine = create_engine("sqlite://")
+        NetatmoReading.__table__.create(engine)
+        lines = [json.dumps({"room_id": 2, "start": f"2023-01-01T10:{minute:02}:00Z", "end": f"2023-01-01T10:{minute + 5:02}:00Z",
+                             "reading": 19.5}) for minute in range(0, 50, 5)]
+        with Session(engine) as session:
+            self.assertEqual(insert_readings(session, 1, parse_readings(lines), batch_size=4).inserted, 10)
+            self.assertEqual(insert_readings(session, 1, parse_readings(lines), batch_size=4).inserted, 0)
+            self.assertEqual(insert_readings(session, 2, parse_readings(lines[:3]), batch_size=4).inserted, 3)
+            self.assertEqual(session.query(NetatmoReading).count(), 13)
+
+
+if __name__ == "__main__":
+    cli()
@@ -10,12 +10,10 @@ import pendulum
 import ujson as json
 from dacite import from_dict, DaciteError, Config
 from falcon import Request, Response
-from sqlalchemy import and_
-from sqlalchemy.orm import aliased
-
-from chai_api.db_definitions import get_home, Schedule, Log
+from chai_api.db_definitions import get_home, current_schedules, Schedule, Log
 from chai_api.expected import ScheduleGet
 from chai_api.responses import ScheduleEntry
+from chai_api.schedule_index import invalidate_schedule_index
 
 
 class ScheduleResource:
@@ -38,21 +36,9 @@ class ScheduleResource:
                 resp.status = falcon.HTTP_BAD_REQUEST
                 return
 
-            schedule_alias = aliased(Schedule)
-            schedules = db_session.query(
-                Schedule
-            ).outerjoin(
-                schedule_alias, and_(
-                    Schedule.home_id == schedule_alias.home_id,
-                    Schedule.revision < schedule_alias.revision,
-                    Schedule.day == schedule_alias.day)
-            ).filter(
-                schedule_alias.revision == None  # noqa: E711
-            ).filter(
-                Schedule.home_id == home.id
-            ).filter(
+            schedules = db_session.execute(current_schedules(home.id).where(
                 Schedule.day.op('&')(request.daymask) != 0
-            ).all()
+            )).scalars().all()
 
             response = []
 
@@ -145,19 +131,7 @@ class ScheduleResource:
             # this can come from a previous entry, either from the database or from the schedule that was PUT
 
             # fetch the current schedule from the DB so we can enrich the newly PUT schedule
-            schedule_alias = aliased(Schedule)
-            existing_schedules = db_session.query(
-                Schedule
-            ).outerjoin(
-                schedule_alias, and_(
-                    Schedule.home_id == schedule_alias.home_id,
-                    Schedule.revision < schedule_alias.revision,
-                    Schedule.day == schedule_alias.day)
-            ).filter(
-                schedule_alias.revision == None  # noqa: E711
-            ).filter(
-                Schedule.home_id == home.id
-            ).all()
+            existing_schedules = db_session.execute(current_schedules(home.id)).scalars().all()
 
             # prepare all the existing schedules in a nice looping structure
             day_schedules = [None] * 8
@@ -216,7 +190,7 @@ class ScheduleResource:
                 # store the schedule in the database
                 # noinspection PyTypeChecker
                 # ignore the warnings; DateTime is a datetime.datetime (compatible) instance
-                db_session.add(Schedule(home=home, revision=revision, day=2 ** (index - 1), schedule=schedule_dict))
+                db_session.add(Schedule(home_id=home.id, revision=revision, day=2 ** (index - 1), schedule=schedule_dict))
 
             db_session.add(Log(
                 home_id=home.id,
@@ -225,6 +199,7 @@ class ScheduleResource:
                 parameters=[]
             ))
             db_session.commit()
+            invalidate_schedule_index(home.id)
         except (DaciteError, ValueError) as err:
             resp.content_type = falcon.MEDIA_TEXT
             resp.status = falcon.HTTP_BAD_REQUEST
@@ -0,0 +1,110 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import unittest
+from array import array
+from datetime import datetime
+from typing import Any, Dict, Tuple, Union
+
+from chai_api.utilities import TTLCache
+
+# the number of 15 minute slots in a day
+SLOTS = 96
+
+# the daymask of each day of the week, from Monday to Sunday
+DAYS = (1, 2, 4, 8, 16, 32, 64)
+
+# the largest profile ID that a compiled schedule can hold
+MAX_PROFILE = 65535
+
+# the compiled schedules of the most recently used homes and days; a schedule is compiled again at most once a day
+_indices: TTLCache[Tuple[int, int], Tuple[datetime, array]] = TTLCache(maxsize=7 * 1024, ttl=86400)
+
+
+def compile_schedule(schedule: Dict[str, Union[int, str]]) -> array:
+    """
+    Compile the schedule of a day into the profile that is active in each slot.
+    :param schedule: The schedule as stored in the database, mapping the first slot of each profile to that profile.
+    :return: The profile for each of the 96 slots of the day, or 0 for the slots before the first entry.
+    """
+    index = array("H", bytes(2 * SLOTS))
+    for (slot, profile) in sorted((int(key), int(value)) for (key, value) in schedule.items()):
+        if not 0 <= slot < SLOTS:
+            raise ValueError(f"the slot {slot} of the schedule should be in the range [0, {SLOTS - 1}]")
+        if not 0 <= profile <= MAX_PROFILE:
+            raise ValueError(f"the profile {profile} of the schedule should be in the range [0, {MAX_PROFILE}]")
+        index[slot:] = array("H", [profile]) * (SLOTS - slot)
+    return index
+
+
+def get_schedule_index(home_id: int, day: int, revision: datetime, schedule: Dict[str, Union[int, str]]) -> array:
+    """
+    Get the compiled schedule of a home for a day, compiling it only when its revision has not been seen before.
+    :param home_id: The ID of the home.
+    :param day: The daymask of the day, e.g. 1 for Monday.
+    :param revision: The revision of the schedule.
+    :param schedule: The schedule as stored in the database.
+    :return: The profile for each of the 96 slots of the day.
+    """
+    entry = _indices.get((home_id, day))
+    if entry is not None and entry[0] == revision:
+        return entry[1]
+
+    index = compile_schedule(schedule)
+    _indices.put((home_id, day), (revision, index))
+    return index
+
+
+def invalidate_schedule_index(home_id: int) -> None:
+    """
+    Forget the compiled schedules of a home, e.g. because a new revision of its schedule has been stored.
+    :param home_id: The ID of the home.
+    """
+    for day in DAYS:
+        _indices.discard((home_id, day))
+
+
+def stats() -> Dict[str, Any]:
+    """ The number of compiled schedules, and how often a compiled schedule was reused or compiled. """
+    return _indices.stats()
+
+
+class ScheduleIndexTests(unittest.TestCase):
+    """
+    Tests to ensure that a compiled schedule gives the same profile as looking up the last entry before a slot.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def testCompile(self):
+        schedule = {"0": "2", "27": "1", "43": "3", "90": 4}
+        index = compile_schedule(schedule)
+        entries = sorted(((int(key), int(value)) for (key, value) in schedule.items()), reverse=True)
+        for slot in range(SLOTS):
+            self.assertEqual(index[slot], next(filter(lambda entry: entry[0] <= slot, entries))[1])  # noqa: B023
+        self.assertEqual(list(compile_schedule({"4": 1})[:5]), [0, 0, 0, 0, 1])
+
+    def testLargeProfiles(self):
+        self.assertEqual(compile_schedule({"0": 256, "50": MAX_PROFILE})[49:51].tolist(), [256, MAX_PROFILE])
+        self.assertRaises(ValueError, compile_schedule, {"0": MAX_PROFILE + 1})
+        self.assertRaises(ValueError, compile_schedule, {"0": -1})
+        self.assertRaises(ValueError, compile_schedule, {str(SLOTS): 1})
+
+    def testRevision(self):
+        (first, second) = (datetime(2023, 1, 1), datetime(2023, 1, 2))
+        self.assertEqual(get_schedule_index(-1, 1, first, {"0": 1})[0], 1)
+        self.assertEqual(get_schedule_index(-1, 1, first, {"0": 2})[0], 1)
+        self.assertEqual(get_schedule_index(-1, 1, second, {"0": 2})[0], 2)
+        invalidate_schedule_index(-1)
+        self.assertIsNone(_indices.get((-1, 1)))
+
+    def testBounded(self):
+        self.assertEqual(_indices.maxsize, 7 * 1024)
+        for home_id in range(-1, -2 - _indices.maxsize, -1):
+            get_schedule_index(home_id, 1, datetime(2023, 1, 1), {"0": 1})
+        self.assertEqual(len(_indices), _indices.maxsize)
+        for home_id in range(-1, -2 - _indices.maxsize, -1):
+            invalidate_schedule_index(home_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,12 @@
 # pylint: disable=line-too-long, missing-module-docstring, c-extension-no-member
 # pylint: disable=no-member, missing-function-docstring
 
+import threading
+import time
+import unittest
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, Dict, Callable, Union, TypeVar
+from typing import Optional, Dict, Callable, Union, TypeVar, Generic, Tuple, Any
 
 import falcon
 from falcon import Request, Response
@@ -42,6 +46,87 @@ def optional(source: Optional[Dict[K, V]], key: K, default: V = None,
         return default if mapping is None or default is None else mapping(default)
 
 
+def parse_bool(value: Union[bool, str]) -> bool:
+    """
+    Parse a boolean that may have been given as a query parameter, such as "true", "False", "1" or "0".
+    :param value: The value to parse.
+    :return: The boolean value, or the value unchanged when it is not a recognised boolean (so it fails validation).
+    """
+    if isinstance(value, str) and value.lower() in ("true", "1", "yes"):
+        return True
+    if isinstance(value, str) and value.lower() in ("false", "0", "no"):
+        return False
+    return value
+
+
+class TTLCache(Generic[K, V]):
+    """
+    A thread-safe cache that holds at most `maxsize` entries, each for at most `ttl` seconds.
+    When the cache is full the least recently used entry is evicted.
+    """
+    maxsize: int
+    ttl: float
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, maxsize: int = 128, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[K, Tuple[float, V]]" = OrderedDict()
+
+    def get(self, key: K) -> Optional[V]:
+        """
+        Get the value stored for a key.
+        :param key: The key to look up.
+        :return: The value, or None when the key is not in the cache or its entry has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: K, value: V) -> None:
+        """
+        Store a value for a key, replacing any previous value.
+        :param key: The key to store the value under.
+        :param value: The value to store.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: K) -> None:
+        """
+        Remove the entry of a key, if there is one.
+        :param key: The key to remove.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """ Remove all entries. """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """ The hit and miss counters, the hit ratio, and the number of entries of the cache. """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries), "maxsize": self.maxsize}
+
+
 def _get_header_token(header: Optional[str]) -> Optional[str]:
     prefix = "Bearer "
     if header is None:
@@ -88,5 +173,30 @@ def create_user_token() -> str:
     return hashlib.sha3_256(str(uuid.uuid4()).encode('utf-8')).hexdigest()[:24]
 
 
+class TTLCacheTests(unittest.TestCase):
+    """
+    Tests to ensure that the cache evicts the least recently used and expired entries.
+    """
+
+    # pylint: disable=C0103, C0116
+
+    def testEviction(self):
+        cache: TTLCache[str, int] = TTLCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertEqual(cache.stats()["size"], 2)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def testExpiry(self):
+        cache: TTLCache[str, int] = TTLCache(ttl=0)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+
 if __name__ == "__main__":
-    pass
+    unittest.main()
@@ -9,6 +9,7 @@ import pendulum
 import ujson as json
 from dacite import from_dict, DaciteError, Config
 from falcon import Request, Response
+from sqlalchemy import select
 
 from chai_api.db_definitions import Log, Profile, SetpointChange, get_home
 from chai_api.expected import XAIGet, ProfileResetGet
@@ -35,8 +36,17 @@ class XAIProfileResource:
     def __init__(self, profiles: List[ConfigurationProfile]):
         self.profiles = profiles
 
-    def get_profile(self, req: Request, resp: Response, parameters: XAIGet, all: bool = False) -> (
-    bool, Optional[Profile]):  # noqa
+    def get_profile(self, req: Request, resp: Response, parameters: XAIGet, all: bool = False,
+                    columns: Optional[tuple] = None) -> (bool, Optional[Profile]):  # noqa
+        """
+        Get the latest profile, or all profiles, since the profile was last reset.
+        :param req: The request.
+        :param resp: The response, which is set when the parameters are not valid.
+        :param parameters: The parameters of the request.
+        :param all: Whether to get all profiles instead of only the latest one.
+        :param columns: The columns of the profile and its setpoint change to get instead of the Profile entities.
+        :return: Whether the parameters were valid, and the profile(s), or rows with the given columns when requested.
+        """
         try:
             if parameters.profile < 1 or parameters.profile > 5:
                 resp.content_type = falcon.MEDIA_TEXT
@@ -55,35 +65,35 @@ class XAIProfileResource:
                 resp.status = falcon.HTTP_BAD_REQUEST
                 return False, None
 
-            subquery = db_session.query(
+            # only the profiles since the profile was last reset, which is when it was stored without a region
+            latest_reset = select(
                 Profile.id
-            ).filter(
-                Profile.home_id == home.id
-            ).filter(
-                Profile.profile_id == parameters.profile
-            ).filter(
+            ).where(
+                Profile.home_id == home.id,
+                Profile.profile_id == parameters.profile,
                 Profile.confidence_region.is_(None)
             ).order_by(
                 Profile.id.desc()
-            ).limit(1)
+            ).limit(1).scalar_subquery()
 
-            query = db_session.query(
+            query = select(
                 Profile
-            ).filter(
-                Profile.setpointChange.has(SetpointChange.hidden.is_(False))
-            ).filter(
-                Profile.id >= subquery.as_scalar()
-            ).filter(
-                Profile.home_id == home.id
-            ).filter(
+            ).join_from(
+                Profile, SetpointChange, Profile.setpoint_id == SetpointChange.id
+            ).where(
+                SetpointChange.hidden.is_(False),
+                Profile.id >= latest_reset,
+                Profile.home_id == home.id,
                 Profile.profile_id == parameters.profile
             ).order_by(
                 Profile.id.desc()
             ).offset(parameters.skip)
 
+            if columns is not None:
+                return True, db_session.execute(query.with_only_columns(*columns)).all()
             if all:
-                return True, query.all()
-            return True, query.first()
+                return True, db_session.execute(query).scalars().all()
+            return True, db_session.execute(query.limit(1)).scalars().first()
         except DaciteError as err:
             resp.content_type = falcon.MEDIA_TEXT
             resp.status = falcon.HTTP_BAD_REQUEST
@@ -180,12 +190,13 @@ class XAIScatterResource(XAIProfileResource):
     def on_get(self, req: Request, resp: Response):  # noqa
         try:
             parameters: XAIGet = from_dict(XAIGet, req.params, config=Config(cast=[int]))
-            (success, results) = self.get_profile(req, resp, parameters, all=True)
+            (success, results) = self.get_profile(
+                req, resp, parameters, all=True, columns=(SetpointChange.price, SetpointChange.temperature)
+            )
 
             if success and results is not None:
                 entries = [
-                    XAIScatterEntry(result.setpointChange.price, result.setpointChange.temperature)
-                    for result in results if result.setpointChange and result.setpointChange.temperature is not None
+                    XAIScatterEntry(price, temperature) for (price, temperature) in results if temperature is not None
                 ]
                 response = XAIScatter(entries, len(entries))
                 resp.content_type = falcon.MEDIA_JSON
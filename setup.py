@@ -31,6 +31,8 @@ setup(
     extras_require={
         "compat": ["cheroot", "pylint", "perflint"],  # pure Python WSGI server
         "speed": ["bjoern"],  # fast WSGI server
+        "drivers": ["psycopg2-binary", "asyncpg"],  # PostgreSQL drivers implemented in C, and for asyncio
+        "asgi": ["uvicorn", "asyncpg"],  # ASGI server, and the PostgreSQL driver for asyncio
     },
     classifiers=[],
     include_package_data=True,